@@ -0,0 +1,25 @@
+import os
+import sys
+
+# Скриптът се пуска от директорията на проекта: python app/backfill-review-stats.py
+# (модулите на приложението се импортират като app.*)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.main import SessionLocal, engine
+from app.db.migrations import apply_schema_updates
+from app import crud
+
+# Попълва review_count, rating_sum и avg_rating на книгите от таблицата reviews.
+# Пуска се веднъж след добавянето на колоните; след това create/update/delete_review
+# ги поддържат сами. Може да се пусне отново, ако има съмнение за разминаване.
+
+if __name__ == "__main__":
+    # Колоните трябва да съществуват, преди да се попълнят
+    apply_schema_updates(engine)
+    
+    db = SessionLocal()
+    try:
+        updated = crud.recalculate_review_stats(db)
+        print(f"Статистиката на отзивите е обновена за {updated} книги")
+    finally:
+        db.close()
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+# Бенчмарк за латентност при конкурентни заявки към каталога.
+#
+# Пуска се веднъж срещу версия с синхронни DB заявки (преди) и веднъж срещу
+# версията с async енджина (след), като резултатите се записват в JSON файлове:
+#
+#   python benchmark-async.py --label before --output before.json
+#   python benchmark-async.py --label after --output after.json
+#   python benchmark-async.py --compare before.json after.json
+#
+# Изисква само httpx (pip install httpx). Резултатите зависят от машината и
+# от базата, затова JSON файловете не се пазят в репото - прилагат се към
+# PR-а, който променя достъпа до базата.
+#
+# При синхронните заявки една бавна заявка към Postgres блокира целия worker,
+# което се вижда като рязко нарастване на p95/p99 при по-висока конкурентност.
+
+BASE_URL = "http://127.0.0.1:8000"
+DEFAULT_PATHS = ["/api/books", "/api/books/1", "/api/categories", "/"]
+
+
+async def timed_request(client: httpx.AsyncClient, url: str) -> tuple:
+    """Изпълнява една заявка и връща (латентност в ms, HTTP статус)"""
+    start = time.perf_counter()
+    try:
+        response = await client.get(url)
+        status = response.status_code
+    except httpx.HTTPError:
+        status = 0
+    return (time.perf_counter() - start) * 1000, status
+
+
+async def run_path(base_url: str, path: str, concurrency: int, total: int) -> dict:
+    """Пуска `total` заявки към един path с най-много `concurrency` едновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker():
+            async with semaphore:
+                return await timed_request(client, f"{base_url}{path}")
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(worker() for _ in range(total)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status != 200)
+
+    def percentile(p: float) -> float:
+        index = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    return {
+        "path": path,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "rps": total / elapsed if elapsed else 0.0,
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "max_ms": latencies[-1],
+    }
+
+
+def print_results(label: str, results: list) -> None:
+    print(f"\n=== {label} ===")
+    print(f"{'path':<20} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'err':>5}")
+    for r in results:
+        print(
+            f"{r['path']:<20} {r['rps']:>8.1f} {r['p50_ms']:>8.1f}ms {r['p95_ms']:>8.1f}ms "
+            f"{r['p99_ms']:>8.1f}ms {r['max_ms']:>8.1f}ms {r['errors']:>5}"
+        )
+
+
+def compare(before_file: str, after_file: str) -> None:
+    """Сравнява два записани резултата path по path"""
+    with open(before_file) as f:
+        before = {r["path"]: r for r in json.load(f)["results"]}
+    with open(after_file) as f:
+        after = {r["path"]: r for r in json.load(f)["results"]}
+
+    print(f"{'path':<20} {'metric':<8} {'before':>10} {'after':>10} {'change':>9}")
+    for path in before:
+        if path not in after:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "rps"):
+            b = before[path][metric]
+            a = after[path][metric]
+            change = ((a - b) / b * 100) if b else 0.0
+            print(f"{path:<20} {metric:<8} {b:>10.1f} {a:>10.1f} {change:>8.1f}%")
+
+
+async def main(args) -> None:
+    results = []
+    for path in args.paths:
+        results.append(await run_path(args.url, path, args.concurrency, args.requests))
+
+    print_results(args.label, results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"label": args.label, "results": results}, f, indent=2)
+        print(f"\nРезултатите са записани в {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк за латентност при конкурентни заявки")
+    parser.add_argument("--url", default=BASE_URL)
+    parser.add_argument("--paths", nargs="+", default=DEFAULT_PATHS)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--output")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        asyncio.run(main(args))
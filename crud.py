@@ -1,14 +1,20 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_, func, desc
-from datetime import datetime, timedelta
+from sqlalchemy.orm import Session, selectinload, joinedload, raiseload, with_expression
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, and_, func, desc, select, update, case, cast, Float
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from datetime import datetime, timedelta, date
 import typing as t
+import re
+import json
+import base64
 from fastapi import HTTPException, status
 
 from app.db.models import (
     User, Book, Category, Order, OrderItem, Promotion, Review, 
-    TempUser, UserRole, OrderStatus
+    TempUser, UserRole, OrderStatus, BookSales, BookSalesDaily, book_category, BOOK_SEARCH_CONFIG
 )
 from app.db.security import get_password_hash, verify_password
+from app.db.routing import replica_read
 
 # ---------- User CRUD ----------
 
@@ -119,70 +125,284 @@ def cleanup_temp_users(db: Session, days: int = 3) -> int:
 
 # ---------- Book CRUD ----------
 
+# Профили за зареждане на релациите на Book. Всеки профил зарежда с фиксиран
+# брой заявки точно релациите, които съответният изглед използва, независимо
+# от броя на книгите, и забранява lazy loading на големите колекции.
+BOOK_LOAD_PROFILES = {
+    # Карта на книга в списък/търсене/начална страница
+    "card": (
+        selectinload(Book.promotions),
+        selectinload(Book.categories),
+        raiseload(Book.reviews),
+        raiseload(Book.order_items),
+    ),
+    # Страница с детайли: review_count/avg_rating са в самата книга, а
+    # показваните отзиви се зареждат отделно с лимит
+    "detail": (
+        selectinload(Book.promotions),
+        selectinload(Book.categories),
+        raiseload(Book.reviews),  # последните отзиви - get_latest_book_reviews
+        raiseload(Book.order_items),
+    ),
+    # Админ панел: таблицата с книги показва само колоните на книгата
+    # (заглавие, издател, ISBN, цена, наличност) - без нито една релация
+    "admin": (
+        raiseload(Book.categories),
+        raiseload(Book.promotions),
+        raiseload(Book.reviews),
+        raiseload(Book.order_items),
+    ),
+}
+
+def with_load_profile(query, profile: t.Optional[str]):
+    """
+    Прилага профил за зареждане към select заявка или Query
+
+    Args:
+        query: Заявка, чийто основен обект е Book
+        profile: Име на профил от BOOK_LOAD_PROFILES или None за lazy loading
+    """
+    if profile is None:
+        return query
+    if profile not in BOOK_LOAD_PROFILES:
+        raise ValueError(f"Unknown load profile: {profile}")
+    return query.options(*BOOK_LOAD_PROFILES[profile])
+
 def get_book(db: Session, book_id: int) -> t.Optional[Book]:
     return db.query(Book).filter(Book.id == book_id).first()
 
 def get_book_by_isbn(db: Session, isbn: str) -> t.Optional[Book]:
     return db.query(Book).filter(Book.isbn == isbn).first()
 
-def get_books(
-    db: Session, 
-    skip: int = 0, 
+# Колони, по които може да се сортира каталогът
+BOOK_SORT_COLUMNS = {
+    "title": Book.title,
+    "price": Book.price,
+    "created_at": Book.created_at,
+    "goodreads_rating": Book.goodreads_rating,
+    "avg_rating": Book.avg_rating,
+}
+
+# Сортиране по ts_rank - възможно е само заедно с търсене
+RELEVANCE_SORT = "relevance"
+
+# Думи в заявката за търсене - букви (вкл. кирилица) и цифри
+_SEARCH_WORD_RE = re.compile(r"[^\W_]+")
+
+def _search_tsquery(search: t.Optional[str]) -> t.Optional[str]:
+    """
+    Превръща свободен текст в tsquery с префиксно съвпадение за всяка дума
+    ("война мир" -> "война:* & мир:*"), така че да се намират и склонените форми
+    """
+    if not search:
+        return None
+    words = _SEARCH_WORD_RE.findall(search.lower())
+    if not words:
+        return None
+    return " & ".join(f"{word}:*" for word in words)
+
+def resolve_book_sort(sort_by: t.Optional[str], search: t.Optional[str] = None) -> str:
+    """
+    Връща реалния ключ за сортиране: relevance само при търсене,
+    непознатите ключове стават title
+    """
+    if sort_by == RELEVANCE_SORT:
+        return RELEVANCE_SORT if _search_tsquery(search) else "title"
+    return sort_by if sort_by in BOOK_SORT_COLUMNS else "title"
+
+def _apply_search(query, search: t.Optional[str]):
+    """
+    Добавя пълнотекстово търсене по books.search_vector към заявка за книги
+    Точното съвпадение по ISBN се запазва.
+
+    Returns:
+        (заявката, ts_rank израз или None, ако няма думи за търсене)
+    """
+    if not search:
+        return query, None
+    isbn_match = Book.isbn == search.strip()
+    tsquery = _search_tsquery(search)
+    if tsquery is None:
+        return query.where(isbn_match), None
+    
+    ts_query = func.to_tsquery(BOOK_SEARCH_CONFIG, tsquery)
+    rank = func.ts_rank(Book.search_vector, ts_query)
+    query = query.where(or_(Book.search_vector.bool_op("@@")(ts_query), isbn_match))
+    return query.options(with_expression(Book.search_rank, rank)), rank
+
+def encode_book_cursor(book: Book, sort_by: str = "title", sort_desc: bool = False) -> str:
+    """
+    Създава непрозрачен курсор към позицията след дадена книга
+
+    Курсорът съдържа стойността на ключа за сортиране и ID-то на книгата,
+    така че следващата страница се намира с индекс, а не с OFFSET.
+    """
+    if sort_by == RELEVANCE_SORT:
+        value = book.search_rank
+    else:
+        sort_by = sort_by if sort_by in BOOK_SORT_COLUMNS else "title"
+        value = getattr(book, BOOK_SORT_COLUMNS[sort_by].key)
+    if isinstance(value, datetime):
+        value = {"dt": value.isoformat()}
+    payload = json.dumps(
+        {"s": sort_by, "d": bool(sort_desc), "v": value, "i": book.id},
+        separators=(",", ":"), ensure_ascii=False
+    )
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_book_cursor(cursor: str, sort_by: str = "title", sort_desc: bool = False) -> t.Tuple[t.Any, int]:
+    """
+    Декодира курсор, създаден от encode_book_cursor
+
+    Returns:
+        (стойност на ключа за сортиране, ID на последната книга)
+
+    Raises:
+        HTTPException: При невалиден курсор или курсор за друго сортиране
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        value = data["v"]
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["dt"])
+        last_id = int(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    if data.get("s") != sort_by or data.get("d") != bool(sort_desc):
+        raise HTTPException(status_code=400, detail="Cursor does not match the requested sorting")
+    
+    return value, last_id
+
+def _apply_sort_and_page(query, sort_by="title", sort_desc=False, skip: int = 0, limit: int = 100, cursor: str = None, rank=None):
+    """
+    Прилага сортиране и пагинация към заявка за книги
+
+    С курсор се използва keyset пагинация по (ключ за сортиране, id), която
+    струва еднакво на всяка страница. Без курсор се запазва старото
+    поведение с OFFSET (skip).
+
+    Args:
+        rank: ts_rank израз от _apply_search - нужен за сортиране по relevance
+    """
+    if sort_by == RELEVANCE_SORT and rank is not None:
+        # Най-релевантните винаги са първи, sort_desc само се пази в курсора
+        column, descending, nullable = rank, True, False
+    else:
+        sort_by = sort_by if sort_by in BOOK_SORT_COLUMNS else "title"
+        column, descending = BOOK_SORT_COLUMNS[sort_by], sort_desc
+        nullable = column.nullable
+    
+    if cursor:
+        value, last_id = decode_book_cursor(cursor, sort_by, sort_desc)
+        after_id = Book.id < last_id if descending else Book.id > last_id
+        
+        if value is None:
+            # Вече сме в опашката с NULL стойности
+            query = query.where(column.is_(None), after_id)
+        else:
+            after_value = column < value if descending else column > value
+            after = or_(after_value, and_(column == value, after_id))
+            if nullable:
+                after = or_(after, column.is_(None))
+            query = query.where(after)
+    
+    # NULL стойностите винаги са накрая, за да е подредбата същата като на курсора
+    if descending:
+        order_column = column.desc().nulls_last() if nullable else column.desc()
+        query = query.order_by(order_column, Book.id.desc())
+    else:
+        order_column = column.asc().nulls_last() if nullable else column.asc()
+        query = query.order_by(order_column, Book.id.asc())
+    
+    if limit:
+        query = query.limit(limit) if cursor else query.offset(skip).limit(limit)
+    
+    return query
+
+def _books_statement(
+    skip: int = 0,
     limit: int = 100,
     search: str = None,
     category_id: int = None,
     min_price=None, max_price=None,
     in_stock: bool = None,
-    sort_by="title", sort_desc=False
-) -> t.List[Book]:
-    query = db.query(Book)
-    
-    if search:
-        search_term = f"%{search}%"
-        query = query.filter(
-            or_(
-                Book.title.ilike(search_term),
-                Book.original_title.ilike(search_term),
-                Book.publisher.ilike(search_term),
-                Book.isbn.ilike(search_term)
-            )
-        )
+    sort_by="title", sort_desc=False,
+    cursor: str = None
+):
+    """Изгражда select заявката за get_books - обща за sync и async варианта."""
+    query, rank = _apply_search(select(Book), search)
     
     if category_id:
-        query = query.join(Book.categories).filter(Category.id == category_id)
+        query = query.join(Book.categories).where(Category.id == category_id)
     
     if min_price is not None:
-        query = query.filter(Book.price >= min_price)
+        query = query.where(Book.price >= min_price)
     
     if max_price is not None:
-        query = query.filter(Book.price <= max_price)
+        query = query.where(Book.price <= max_price)
     
     if in_stock is not None:
         if in_stock:
-            query = query.filter(Book.stock_count > 0)
+            query = query.where(Book.stock_count > 0)
         else:
-            query = query.filter(Book.stock_count == 0)
-    
-    # Apply sorting
-    if sort_by == "price":
-        order_column = Book.price
-    elif sort_by == "created_at":
-        order_column = Book.created_at
-    elif sort_by == "goodreads_rating":
-        order_column = Book.goodreads_rating
-    else:  # Default to title
-        order_column = Book.title
-    
-    if sort_desc:
-        query = query.order_by(desc(order_column))
-    else:
-        query = query.order_by(order_column)
+            query = query.where(Book.stock_count == 0)
     
-    # Apply pagination
-    if limit:
-        query = query.offset(skip).limit(limit)
-    
-    return query.all()
+    # Apply sorting and pagination
+    return _apply_sort_and_page(query, sort_by, sort_desc, skip, limit, cursor, rank)
+
+@replica_read
+def get_books(
+    db: Session, 
+    skip: int = 0, 
+    limit: int = 100,
+    search: str = None,
+    category_id: int = None,
+    min_price=None, max_price=None,
+    in_stock: bool = None,
+    sort_by="title", sort_desc=False,
+    profile: t.Optional[str] = "card",
+    cursor: str = None
+) -> t.List[Book]:
+    query = _books_statement(
+        skip, limit, search, category_id, min_price, max_price, in_stock, sort_by, sort_desc, cursor
+    )
+    return db.execute(with_load_profile(query, profile)).scalars().all()
+
+@replica_read
+def get_books_page(
+    db: Session,
+    limit: int = 20,
+    cursor: str = None,
+    sort_by="title", sort_desc=False,
+    profile: t.Optional[str] = "card",
+    **filters
+) -> t.Tuple[t.List[Book], t.Optional[str]]:
+    """
+    Връща една страница от каталога с keyset пагинация
+
+    Args:
+        limit: Брой книги на страница
+        cursor: next_cursor от предишната страница или None за първата
+        filters: search, category_id, min_price, max_price, in_stock
+
+    Returns:
+        (книгите, курсор за следващата страница или None, ако това е последната)
+    """
+    sort_by = resolve_book_sort(sort_by, filters.get("search"))
+    books = get_books(
+        db, limit=limit + 1, sort_by=sort_by, sort_desc=sort_desc,
+        profile=profile, cursor=cursor, **filters
+    )
+    return _split_page(books, limit, sort_by, sort_desc)
+
+def _split_page(books: t.List[Book], limit: int, sort_by: str, sort_desc: bool) -> t.Tuple[t.List[Book], t.Optional[str]]:
+    # Заявката взима limit + 1 книги - допълнителната показва, че има следваща страница
+    if len(books) <= limit:
+        return books, None
+    books = books[:limit]
+    return books, encode_book_cursor(books[-1], sort_by, sort_desc)
 
 def create_book(db: Session, book_data: dict) -> Book:
     db_book = Book(**book_data)
@@ -243,6 +463,7 @@ def get_category(db: Session, category_id: int) -> t.Optional[Category]:
 def get_category_by_name(db: Session, name: str) -> t.Optional[Category]:
     return db.query(Category).filter(Category.name == name).first()
 
+@replica_read
 def get_categories(db: Session, skip: int = 0, limit: int = 100) -> t.List[Category]:
     return db.query(Category).offset(skip).limit(limit).all()
 
@@ -298,20 +519,67 @@ def get_user_orders(db: Session, user_id: int, skip: int = 0, limit: int = 100)
 def get_temp_user_orders(db: Session, temp_user_id: int, skip: int = 0, limit: int = 100) -> t.List[Order]:
     return db.query(Order).filter(Order.temp_user_id == temp_user_id).offset(skip).limit(limit).all()
 
-def create_order(
-    db: Session, 
-    user_id: int = None, 
-    temp_user_id: int = None, 
+def _book_sales_statements(quantities: t.Iterable[t.Tuple[int, int]], day: date, sign: int = 1) -> list:
+    """
+    Upsert заявки, които добавят продадените бройки към book_sales и
+    book_sales_daily (или ги изваждат при sign=-1)
+
+    Args:
+        quantities: Двойки (book_id, бройки) - една книга може да се повтаря
+        day: Датата на поръчката
+        sign: 1 при поръчка, -1 при отказ
+    """
+    totals = {}
+    for book_id, quantity in quantities:
+        totals[book_id] = totals.get(book_id, 0) + quantity
+    
+    statements = []
+    # Фиксиран ред на редовете, за да няма deadlock между паралелни поръчки
+    for book_id in sorted(totals):
+        units = sign * totals[book_id]
+        total = pg_insert(BookSales).values(book_id=book_id, units_sold=units)
+        statements.append(total.on_conflict_do_update(
+            index_elements=[BookSales.book_id],
+            set_={"units_sold": BookSales.units_sold + total.excluded.units_sold}
+        ))
+        daily = pg_insert(BookSalesDaily).values(book_id=book_id, day=day, units_sold=units)
+        statements.append(daily.on_conflict_do_update(
+            index_elements=[BookSalesDaily.book_id, BookSalesDaily.day],
+            set_={"units_sold": BookSalesDaily.units_sold + daily.excluded.units_sold}
+        ))
+    return statements
+
+def _order_sales_statements(db_order: Order, sign: int) -> list:
+    """Заявките за book_sales за всички артикули на съществуваща поръчка"""
+    return _book_sales_statements(
+        ((item.book_id, item.quantity) for item in db_order.items),
+        db_order.created_at.date(),
+        sign
+    )
+
+def _place_order(
+    db: Session,
+    user_id: int = None,
+    temp_user_id: int = None,
     items: t.List[dict] = None,
     shipping_address: dict = None,
     phone: str = None
 ) -> Order:
+    """
+    Създава поръчката с артикулите ѝ, намалява наличностите и обновява
+    продажбите и total_spent на потребителя, без да прави commit
+
+    Обща част на create_order и create_order_async - асинхронната версия я
+    изпълнява през AsyncSession.run_sync.
+    """
     if not items:
         raise HTTPException(status_code=400, detail="Order must contain at least one item")
     
     if not user_id and not temp_user_id:
         raise HTTPException(status_code=400, detail="Order must be associated with a user or temp user")
     
+    user = get_user(db, user_id) if user_id else None
+    
     # Создаём заказ
     total_price = 0.0
     db_order = Order(
@@ -348,26 +616,14 @@ def create_order(
         discount = 0.0
         
         # Проверяем активные акции
-        active_promotion = (
-            db.query(Promotion)
-            .filter(
-                Promotion.book_id == book_id,
-                Promotion.start_date <= datetime.utcnow(),
-                Promotion.end_date >= datetime.utcnow()
-            )
-            .order_by(Promotion.discount_percentage.desc())  # Берём наибольшую скидку
-            .first()
-        )
+        active_promotion = db.execute(_active_promotion_statement(book_id)).scalars().first()
         
         if active_promotion:
             discount = active_promotion.discount_percentage
         
-        # Если пользователь VIP, добавляем дополнительную скидку в 10%
-        if user_id:
-            user = get_user(db, user_id)
-            if user and user.role == UserRole.VIP:
-                # Если уже есть скидка, берём большую
-                discount = max(discount, 10.0)
+        # Если пользователь VIP, берём большую из скидок (VIP - 10%)
+        if user and user.role == UserRole.VIP:
+            discount = max(discount, 10.0)
         
         # Создаём элемент заказа
         db_order_item = OrderItem(
@@ -386,14 +642,30 @@ def create_order(
     # Обновляем общую стоимость заказа
     db_order.total_price = total_price
     
-    # Обновляем total_spent для зарегистрированного пользователя
-    if user_id:
-        user = get_user(db, user_id)
-        if user:
-            user.total_spent += total_price
-            # Проверяем, не стал ли пользователь VIP
-            check_vip_eligibility(db, user_id)
+    # Обновяваме агрегата за продажбите в същата транзакция
+    for statement in _book_sales_statements(
+        ((item["book_id"], item["quantity"]) for item in items), db_order.created_at.date()
+    ):
+        db.execute(statement)
     
+    # Обновляем total_spent и VIP статуса (същото правило като в
+    # check_vip_eligibility, но без отделен commit)
+    if user:
+        user.total_spent += total_price
+        if user.total_spent >= 600.0 and user.role == UserRole.USER:
+            user.role = UserRole.VIP
+    
+    return db_order
+
+def create_order(
+    db: Session, 
+    user_id: int = None, 
+    temp_user_id: int = None, 
+    items: t.List[dict] = None,
+    shipping_address: dict = None,
+    phone: str = None
+) -> Order:
+    db_order = _place_order(db, user_id, temp_user_id, items, shipping_address, phone)
     db.commit()
     db.refresh(db_order)
     return db_order
@@ -403,6 +675,13 @@ def update_order_status(db: Session, order_id: int, new_status: OrderStatus) ->
     if not db_order:
         raise HTTPException(status_code=404, detail="Order not found")
     
+    # Отказ (или възстановяване) през смяна на статуса също променя продажбите
+    was_cancelled = db_order.status == OrderStatus.CANCELLED
+    is_cancelled = new_status == OrderStatus.CANCELLED
+    if was_cancelled != is_cancelled:
+        for statement in _order_sales_statements(db_order, -1 if is_cancelled else 1):
+            db.execute(statement)
+    
     db_order.status = new_status
     db.commit()
     db.refresh(db_order)
@@ -416,10 +695,17 @@ def cancel_order(db: Session, order_id: int) -> Order:
     if db_order.status == OrderStatus.SHIPPED or db_order.status == OrderStatus.DELIVERED:
         raise HTTPException(status_code=400, detail="Cannot cancel an order that has been shipped or delivered")
     
+    if db_order.status == OrderStatus.CANCELLED:
+        raise HTTPException(status_code=400, detail="Order is already cancelled")
+    
     # Возвращаем книги на склад
     for item in db_order.items:
         update_book_stock(db, item.book_id, item.quantity)
     
+    # Изваждаме бройките от агрегата за продажбите
+    for statement in _order_sales_statements(db_order, -1):
+        db.execute(statement)
+    
     # Уменьшаем total_spent для пользователя
     if db_order.user_id:
         user = get_user(db, db_order.user_id)
@@ -435,9 +721,24 @@ def cancel_order(db: Session, order_id: int) -> Order:
 
 # ---------- Promotion CRUD ----------
 
+def _active_promotion_statement(book_id: int):
+    """Заявка за активната промоция с най-голяма отстъпка за дадена книга."""
+    now = datetime.utcnow()
+    return (
+        select(Promotion)
+        .where(
+            Promotion.book_id == book_id,
+            Promotion.start_date <= now,
+            Promotion.end_date >= now
+        )
+        .order_by(Promotion.discount_percentage.desc())  # Берём наибольшую скидку
+        .limit(1)
+    )
+
 def get_promotion(db: Session, promotion_id: int) -> t.Optional[Promotion]:
     return db.query(Promotion).filter(Promotion.id == promotion_id).first()
 
+@replica_read
 def get_active_promotions(db: Session, skip: int = 0, limit: int = 100) -> t.List[Promotion]:
     return (
         db.query(Promotion)
@@ -450,6 +751,7 @@ def get_active_promotions(db: Session, skip: int = 0, limit: int = 100) -> t.Lis
         .all()
     )
 
+@replica_read
 def get_book_promotions(db: Session, book_id: int) -> t.List[Promotion]:
     return (
         db.query(Promotion)
@@ -520,6 +822,7 @@ def delete_promotion(db: Session, promotion_id: int) -> bool:
 def get_review(db: Session, review_id: int) -> t.Optional[Review]:
     return db.query(Review).filter(Review.id == review_id).first()
 
+@replica_read
 def get_book_reviews(db: Session, book_id: int, skip: int = 0, limit: int = 100) -> t.List[Review]:
     return db.query(Review).filter(Review.book_id == book_id).offset(skip).limit(limit).all()
 
@@ -527,6 +830,62 @@ def get_user_reviews(db: Session, user_id: int, skip: int = 0, limit: int = 100)
     return db.query(Review).filter(Review.user_id == user_id).offset(skip).limit(limit).all()
 
 # Продължение на функцията create_review от предишния файл
+def _review_stats_statement(book_id: int, count_delta: int, rating_delta: int):
+    """
+    Атомарно обновява review_count, rating_sum и avg_rating на книга
+
+    Изчислява се от текущите стойности в реда (UPDATE ... SET x = x + delta),
+    така че паралелните отзиви не се губят.
+    """
+    new_count = Book.review_count + count_delta
+    new_sum = Book.rating_sum + rating_delta
+    return (
+        update(Book)
+        .where(Book.id == book_id)
+        .values(
+            review_count=new_count,
+            rating_sum=new_sum,
+            avg_rating=case((new_count > 0, cast(new_sum, Float) / new_count), else_=None)
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+def recalculate_review_stats(db: Session) -> int:
+    """
+    Преизчислява статистиката на отзивите за всички книги от таблицата reviews
+
+    Returns:
+        Брой книги с поне един отзив
+    """
+    stats = (
+        select(
+            Review.book_id,
+            func.count(Review.id).label("review_count"),
+            func.sum(Review.rating).label("rating_sum")
+        )
+        .group_by(Review.book_id)
+        .subquery()
+    )
+    # updated_at=Book.updated_at - преизчисляването не е промяна по книгата
+    db.execute(
+        update(Book)
+        .values(review_count=0, rating_sum=0, avg_rating=None, updated_at=Book.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    result = db.execute(
+        update(Book)
+        .where(Book.id == stats.c.book_id)
+        .values(
+            review_count=stats.c.review_count,
+            rating_sum=stats.c.rating_sum,
+            avg_rating=cast(stats.c.rating_sum, Float) / stats.c.review_count,
+            updated_at=Book.updated_at
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount
+
 def create_review(
     db: Session,
     user_id: int,
@@ -572,6 +931,7 @@ def create_review(
         comment=comment
     )
     db.add(db_review)
+    db.execute(_review_stats_statement(book_id, 1, rating))
     db.commit()
     db.refresh(db_review)
     return db_review
@@ -581,9 +941,13 @@ def update_review(db: Session, review_id: int, update_data: dict) -> Review:
     if not db_review:
         raise HTTPException(status_code=404, detail="Review not found")
     
+    old_rating = db_review.rating
     for key, value in update_data.items():
         setattr(db_review, key, value)
     
+    if db_review.rating != old_rating:
+        db.execute(_review_stats_statement(db_review.book_id, 0, db_review.rating - old_rating))
+    
     db.commit()
     db.refresh(db_review)
     return db_review
@@ -593,6 +957,7 @@ def delete_review(db: Session, review_id: int) -> bool:
     if not db_review:
         raise HTTPException(status_code=404, detail="Review not found")
     
+    db.execute(_review_stats_statement(db_review.book_id, -1, -db_review.rating))
     db.delete(db_review)
     db.commit()
     return True
@@ -619,53 +984,77 @@ def should_update_goodreads_rating(db_book: Book) -> bool:
 
 # ---------- Статистически функции ----------
 
-def get_bestsellers(db: Session, limit: int = 10) -> t.List[Book]:
-    """Връща най-продаваните книги, базирани на брой продажби."""
-    bestsellers = (
-        db.query(Book, func.sum(OrderItem.quantity).label('total_sold'))
-        .join(OrderItem)
-        .join(Order)
-        .filter(Order.status != OrderStatus.CANCELLED)
+def _bestsellers_statement(limit: int, days: int = None):
+    """
+    Top-N по book_sales (индексно четене) или, при days, по продажбите
+    от book_sales_daily за последните days дни
+    """
+    if days is None:
+        return (
+            select(Book, BookSales.units_sold.label('total_sold'))
+            .join(BookSales, BookSales.book_id == Book.id)
+            .where(BookSales.units_sold > 0)
+            .order_by(BookSales.units_sold.desc(), BookSales.book_id)
+            .limit(limit)
+        )
+    
+    since = datetime.utcnow().date() - timedelta(days=days)
+    total_sold = func.sum(BookSalesDaily.units_sold)
+    return (
+        select(Book, total_sold.label('total_sold'))
+        .join(BookSalesDaily, BookSalesDaily.book_id == Book.id)
+        .where(BookSalesDaily.day >= since)
         .group_by(Book.id)
-        .order_by(func.sum(OrderItem.quantity).desc())
+        .having(total_sold > 0)
+        .order_by(total_sold.desc(), Book.id)
         .limit(limit)
-        .all()
     )
+
+@replica_read
+def get_bestsellers(db: Session, limit: int = 10, profile: t.Optional[str] = "card", days: int = None) -> t.List[Book]:
+    """Връща най-продаваните книги, базирани на брой продажби (за всички времена или за последните days дни)."""
+    bestsellers = db.execute(with_load_profile(_bestsellers_statement(limit, days), profile)).all()
     
     return [book for book, _ in bestsellers]
 
-def get_top_rated_books(db: Session, limit: int = 10) -> t.List[Book]:
-    """Връща най-високо оценените книги, базирани на рейтинги от потребители."""
-    top_rated = (
-        db.query(Book, func.avg(Review.rating).label('avg_rating'))
-        .join(Review)
-        .group_by(Book.id)
-        .having(func.count(Review.id) >= 3)  # Книги с поне 3 отзива
-        .order_by(func.avg(Review.rating).desc())
+# Минимален брой отзиви, за да влезе книга в най-високо оценените
+TOP_RATED_MIN_REVIEWS = 3
+
+def _top_rated_statement(limit: int):
+    # Обхожда ix_books_avg_rating_id отгоре надолу
+    return (
+        select(Book)
+        .where(Book.review_count >= TOP_RATED_MIN_REVIEWS)
+        .order_by(Book.avg_rating.desc().nulls_last(), Book.id.desc())
         .limit(limit)
-        .all()
     )
-    
-    return [book for book, _ in top_rated]
 
-def get_revenue_by_period(db: Session, start_date: datetime, end_date: datetime) -> float:
-    """Изчислява общите приходи за определен период от време."""
-    revenue = (
-        db.query(func.sum(Order.total_price))
-        .filter(
+@replica_read
+def get_top_rated_books(db: Session, limit: int = 10) -> t.List[Book]:
+    """Връща най-високо оценените книги, базирани на рейтинги от потребители."""
+    return db.execute(_top_rated_statement(limit)).scalars().all()
+
+def _revenue_by_period_statement(start_date: datetime, end_date: datetime):
+    return (
+        select(func.sum(Order.total_price))
+        .where(
             Order.created_at >= start_date,
             Order.created_at <= end_date,
             Order.status != OrderStatus.CANCELLED
         )
-        .scalar() or 0.0  # В случай че няма поръчки, връщаме 0
     )
+
+@replica_read
+def get_revenue_by_period(db: Session, start_date: datetime, end_date: datetime) -> float:
+    """Изчислява общите приходи за определен период от време."""
+    # В случай че няма поръчки, връщаме 0
+    revenue = db.execute(_revenue_by_period_statement(start_date, end_date)).scalar() or 0.0
     
     return revenue
 
-def get_revenue_by_category(db: Session, start_date: datetime, end_date: datetime) -> t.List[t.Tuple[Category, float]]:
-    """Изчислява приходите по категории за определен период от време."""
-    revenues = (
-        db.query(
+def _revenue_by_category_statement(start_date: datetime, end_date: datetime):
+    return (
+        select(
             Category,
             func.sum(
                 OrderItem.quantity * OrderItem.price_per_item * (1 - OrderItem.discount / 100)
@@ -674,15 +1063,19 @@ def get_revenue_by_category(db: Session, start_date: datetime, end_date: datetim
         .join(Category.books)
         .join(Book.order_items)
         .join(OrderItem.order)
-        .filter(
+        .where(
             Order.created_at >= start_date,
             Order.created_at <= end_date,
             Order.status != OrderStatus.CANCELLED
         )
         .group_by(Category.id)
         .order_by(func.sum(OrderItem.quantity * OrderItem.price_per_item).desc())
-        .all()
     )
+
+@replica_read
+def get_revenue_by_category(db: Session, start_date: datetime, end_date: datetime) -> t.List[t.Tuple[Category, float]]:
+    """Изчислява приходите по категории за определен период от време."""
+    revenues = db.execute(_revenue_by_category_statement(start_date, end_date)).all()
     
     return revenues
 
@@ -700,6 +1093,7 @@ def get_user_purchase_history(db: Session, user_id: int, skip: int = 0, limit: i
         .all()
     )
 
+@replica_read
 def search_books_complex(
     db: Session,
     search_query: str = None,
@@ -710,7 +1104,9 @@ def search_books_complex(
     sort_by: str = "title",
     sort_desc: bool = False,
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    profile: t.Optional[str] = "card",
+    cursor: str = None
 ) -> t.List[Book]:
     """
     Комплексно търсене на книги с множество филтри и сортиране.
@@ -721,28 +1117,20 @@ def search_books_complex(
         min_price: Минимална цена
         max_price: Максимална цена
         in_stock: Филтър за наличност
-        sort_by: Поле за сортиране (title, price, etc.)
+        sort_by: Поле за сортиране (title, price, etc. или relevance при търсене)
         sort_desc: Възходящо или низходящо сортиране
         skip: Офсет за пагинация
         limit: Лимит за брой резултати
+        profile: Профил за зареждане на релациите (card, detail, admin)
+        cursor: Курсор от encode_book_cursor за keyset пагинация вместо skip
     """
-    query = db.query(Book)
-    
     # Прилагаме филтрите
-    if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(
-            or_(
-                Book.title.ilike(search_term),
-                Book.original_title.ilike(search_term),
-                Book.publisher.ilike(search_term),
-                Book.isbn.ilike(search_term)
-            )
-        )
+    query, rank = _apply_search(with_load_profile(db.query(Book), profile), search_query)
     
     if category_ids:
-        # Използваме distinct() за да избегнем дублиране на резултати при множество категории
-        query = query.join(Book.categories).filter(Category.id.in_(category_ids)).distinct()
+        # EXISTS вместо join + distinct(), за да няма дублиране на резултати при
+        # множество категории и да може да се сортира по ts_rank
+        query = query.filter(Book.categories.any(Category.id.in_(category_ids)))
     
     if min_price is not None:
         query = query.filter(Book.price >= min_price)
@@ -756,35 +1144,275 @@ def search_books_complex(
         else:
             query = query.filter(Book.stock_count == 0)
     
-    # Прилагаме сортирането
-    if sort_by:
-        sort_column = getattr(Book, sort_by, Book.title)
-        if sort_desc:
-            query = query.order_by(sort_column.desc())
-        else:
-            query = query.order_by(sort_column)
-    
-    return query.offset(skip).limit(limit).all()
+    # Прилагаме сортирането и пагинацията
+    return _apply_sort_and_page(query, sort_by, sort_desc, skip, limit, cursor, rank).all()
 
+@replica_read
 def get_book_with_promotions(db: Session, book_id: int) -> t.Tuple[Book, t.Optional[Promotion]]:
     """
     Връща книга заедно с активната промоция, ако има такава.
     Полезно за страницата на книгата, където показваме информация за книгата и промоция.
     """
-    book = get_book(db, book_id)
+    book = db.execute(
+        with_load_profile(select(Book).where(Book.id == book_id), "detail")
+    ).scalars().first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
     
     # Намираме активна промоция, ако има такава
-    active_promotion = (
-        db.query(Promotion)
-        .filter(
-            Promotion.book_id == book_id,
-            Promotion.start_date <= datetime.utcnow(),
-            Promotion.end_date >= datetime.utcnow()
-        )
-        .order_by(Promotion.discount_percentage.desc())
-        .first()
-    )
+    active_promotion = db.execute(_active_promotion_statement(book_id)).scalars().first()
     
     return book, active_promotion
+
+@replica_read
+def get_new_books(db: Session, limit: int = 6, profile: t.Optional[str] = "card") -> t.List[Book]:
+    """Връща най-новите книги в каталога."""
+    query = with_load_profile(db.query(Book), profile)
+    return query.order_by(Book.created_at.desc()).limit(limit).all()
+
+
+# ---------- Async варианти ----------
+#
+# Асинхронни варианти на горните функции за AsyncSession (asyncpg драйвер).
+# Използват се от async endpoint-ите, за да не блокират event loop-а докато
+# заявката към базата е в изпълнение. При AsyncSession lazy loading не работи,
+# затова релациите, които endpoint-ите използват, се зареждат предварително.
+
+async def get_user_async(db: AsyncSession, user_id: int) -> t.Optional[User]:
+    result = await db.execute(select(User).where(User.id == user_id))
+    return result.scalars().first()
+
+async def create_temp_user_async(db: AsyncSession, email: str, phone: str, full_name: str = None) -> TempUser:
+    db_temp_user = TempUser(
+        email=email,
+        phone=phone,
+        full_name=full_name
+    )
+    db.add(db_temp_user)
+    await db.commit()
+    await db.refresh(db_temp_user)
+    return db_temp_user
+
+async def get_book_async(db: AsyncSession, book_id: int) -> t.Optional[Book]:
+    result = await db.execute(select(Book).where(Book.id == book_id))
+    return result.scalars().first()
+
+@replica_read
+async def get_books_async(
+    db: AsyncSession,
+    skip: int = 0,
+    limit: int = 100,
+    search: str = None,
+    category_id: int = None,
+    min_price=None, max_price=None,
+    in_stock: bool = None,
+    sort_by="title", sort_desc=False,
+    profile: t.Optional[str] = "card",
+    cursor: str = None
+) -> t.List[Book]:
+    query = _books_statement(
+        skip, limit, search, category_id, min_price, max_price, in_stock, sort_by, sort_desc, cursor
+    )
+    result = await db.execute(with_load_profile(query, profile))
+    return result.scalars().all()
+
+@replica_read
+async def get_books_page_async(
+    db: AsyncSession,
+    limit: int = 20,
+    cursor: str = None,
+    sort_by="title", sort_desc=False,
+    profile: t.Optional[str] = "card",
+    **filters
+) -> t.Tuple[t.List[Book], t.Optional[str]]:
+    sort_by = resolve_book_sort(sort_by, filters.get("search"))
+    books = await get_books_async(
+        db, limit=limit + 1, sort_by=sort_by, sort_desc=sort_desc,
+        profile=profile, cursor=cursor, **filters
+    )
+    return _split_page(books, limit, sort_by, sort_desc)
+
+@replica_read
+async def suggest_books_async(db: AsyncSession, prefix: str, limit: int = 10) -> t.List[t.Any]:
+    """
+    Предложения за заглавия при писане в полето за търсене
+
+    Използва word_similarity от pg_trgm, така че съвпадат и началото на дума,
+    и заглавия с правописна грешка. Операторът %> се обслужва от trigram
+    GIN индексите на title и original_title.
+
+    Returns:
+        Редове (id, title, original_title, score), подредени по сходство
+    """
+    score = func.greatest(
+        func.word_similarity(prefix, Book.title),
+        func.coalesce(func.word_similarity(prefix, Book.original_title), 0)
+    ).label("score")
+    result = await db.execute(
+        select(Book.id, Book.title, Book.original_title, score)
+        .where(or_(Book.title.op("%>")(prefix), Book.original_title.op("%>")(prefix)))
+        .order_by(score.desc(), Book.title)
+        .limit(limit)
+    )
+    return result.all()
+
+@replica_read
+async def get_new_books_async(db: AsyncSession, limit: int = 6, profile: t.Optional[str] = "card") -> t.List[Book]:
+    result = await db.execute(
+        with_load_profile(select(Book), profile)
+        .order_by(Book.created_at.desc())
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+@replica_read
+async def get_books_by_ids_async(db: AsyncSession, book_ids: t.List[int], profile: t.Optional[str] = "card") -> t.List[Book]:
+    """Зарежда книги по ID - редът не е гарантиран, липсващите се пропускат"""
+    if not book_ids:
+        return []
+    result = await db.execute(
+        with_load_profile(select(Book), profile).where(Book.id.in_(book_ids))
+    )
+    return result.scalars().all()
+
+@replica_read
+async def get_book_with_promotions_async(db: AsyncSession, book_id: int) -> t.Tuple[Book, t.Optional[Promotion]]:
+    result = await db.execute(
+        with_load_profile(select(Book).where(Book.id == book_id), "detail")
+    )
+    book = result.scalars().first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    
+    result = await db.execute(_active_promotion_statement(book_id))
+    return book, result.scalars().first()
+
+@replica_read
+async def get_categories_async(db: AsyncSession, skip: int = 0, limit: int = 100) -> t.List[Category]:
+    result = await db.execute(
+        select(Category)
+        .options(selectinload(Category.subcategories))
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+@replica_read
+async def get_category_book_counts_async(db: AsyncSession) -> t.Dict[int, int]:
+    """Брой книги по категория с една агрегираща заявка вместо зареждане на всички книги."""
+    result = await db.execute(
+        select(book_category.c.category_id, func.count(book_category.c.book_id))
+        .group_by(book_category.c.category_id)
+    )
+    return {category_id: count for category_id, count in result.all()}
+
+async def create_order_async(
+    db: AsyncSession,
+    user_id: int = None,
+    temp_user_id: int = None,
+    items: t.List[dict] = None,
+    shipping_address: dict = None,
+    phone: str = None
+) -> Order:
+    db_order = await db.run_sync(_place_order, user_id, temp_user_id, items, shipping_address, phone)
+    await db.commit()
+    await db.refresh(db_order)
+    return db_order
+
+async def get_order_async(db: AsyncSession, order_id: int) -> t.Optional[Order]:
+    """Поръчка заедно с артикулите и книгите в тях"""
+    result = await db.execute(
+        select(Order)
+        .options(selectinload(Order.items).joinedload(OrderItem.book))
+        .where(Order.id == order_id)
+    )
+    return result.scalars().first()
+
+@replica_read
+async def get_user_orders_async(db: AsyncSession, user_id: int, skip: int = 0, limit: int = 100) -> t.List[Order]:
+    result = await db.execute(
+        select(Order)
+        .options(selectinload(Order.items))
+        .where(Order.user_id == user_id)
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+async def cancel_order_async(db: AsyncSession, order_id: int) -> Order:
+    return await db.run_sync(cancel_order, order_id)
+
+@replica_read
+async def get_active_promotions_async(db: AsyncSession, skip: int = 0, limit: int = 100) -> t.List[Promotion]:
+    now = datetime.utcnow()
+    result = await db.execute(
+        select(Promotion)
+        .options(joinedload(Promotion.book))
+        .where(Promotion.start_date <= now, Promotion.end_date >= now)
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+@replica_read
+async def get_book_promotions_async(db: AsyncSession, book_id: int) -> t.List[Promotion]:
+    result = await db.execute(
+        select(Promotion)
+        .where(Promotion.book_id == book_id)
+        .order_by(Promotion.start_date.desc())
+    )
+    return result.scalars().all()
+
+@replica_read
+async def get_book_reviews_async(db: AsyncSession, book_id: int, skip: int = 0, limit: int = 100) -> t.List[Review]:
+    result = await db.execute(
+        select(Review)
+        .options(joinedload(Review.user))
+        .where(Review.book_id == book_id)
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+async def create_review_async(
+    db: AsyncSession,
+    user_id: int,
+    book_id: int,
+    rating: int,
+    comment: str = None
+) -> Review:
+    return await db.run_sync(create_review, user_id, book_id, rating, comment)
+
+@replica_read
+async def get_bestsellers_async(db: AsyncSession, limit: int = 10, profile: t.Optional[str] = "card", days: int = None) -> t.List[Book]:
+    result = await db.execute(
+        with_load_profile(_bestsellers_statement(limit, days), profile)
+    )
+    return [book for book, _ in result.all()]
+
+@replica_read
+async def get_top_rated_books_async(db: AsyncSession, limit: int = 10) -> t.List[Book]:
+    result = await db.execute(_top_rated_statement(limit))
+    return result.scalars().all()
+
+@replica_read
+async def get_latest_book_reviews_async(db: AsyncSession, book_id: int, limit: int = 10) -> t.List[Review]:
+    """Последните отзиви за книга заедно с авторите им"""
+    result = await db.execute(
+        select(Review)
+        .options(joinedload(Review.user))
+        .where(Review.book_id == book_id)
+        .order_by(Review.created_at.desc(), Review.id.desc())
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+@replica_read
+async def get_revenue_by_period_async(db: AsyncSession, start_date: datetime, end_date: datetime) -> float:
+    result = await db.execute(_revenue_by_period_statement(start_date, end_date))
+    return result.scalar() or 0.0
+
+@replica_read
+async def get_revenue_by_category_async(db: AsyncSession, start_date: datetime, end_date: datetime) -> t.List[t.Tuple[Category, float]]:
+    result = await db.execute(_revenue_by_category_statement(start_date, end_date))
+    return result.all()
@@ -1,31 +1,646 @@
+import os
 import json
+import math
+import fnmatch
+import hashlib
+import time
+import uuid
+import zlib
+import random
+import asyncio
 import redis
-from typing import Optional, List, Any, Dict, Union
+import redis.asyncio as aioredis
+from collections import OrderedDict
+from typing import Optional, List, Any, Dict, Union, Callable, Awaitable, NamedTuple
 from datetime import timedelta
 import logging
 from fastapi import Depends
 
+# Незадължителни бързи сериализатори и компресия за CacheCodec
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
 # Конфигуриране на логера
 logger = logging.getLogger(__name__)
 
+# Pub/sub канал, по който worker-ите си съобщават кои ключове да изтрият от L1
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+# Префикс на ключовете за single-flight lock при преизчисляване
+LOCK_PREFIX = "lock:"
+# Паузи (в секунди) между опитите за повторно свързване с Redis в degraded режим
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+# Колко изтрити в degraded режим ключа се помнят поотделно
+MAX_PENDING_INVALIDATIONS = 10000
+# Колко дълго (в секунди) останалите заявки чакат lock-холдъра при празен кеш
+LOCK_WAIT_SECONDS = 2.0
+LOCK_POLL_INTERVAL = 0.05
+# Освобождава lock-а само ако още е наш (не е изтекъл и взет от друг)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class LocalCache:
+    """
+    Ограничен in-process LRU кеш с TTL (L1 пред Redis)
+    
+    Пази вече десериализираните стойности, затова върнатите обекти се
+    споделят между заявките и не бива да се променят.
+    """
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        max_bytes: Optional[int] = None,
+        sizeof: Optional[Callable[[Any], int]] = None
+    ):
+        """
+        Args:
+            max_entries: Максимален брой записи
+            ttl: Максимално време (в секунди) на запис
+            max_bytes: Максимален общ размер на записите според sizeof
+                (None - без ограничение по размер)
+            sizeof: Размер на стойност в байтове (напр. кодираната дължина)
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0  # Общ размер на записите в байтове
+        self._entries = OrderedDict()  # {key: (време на изтичане, стойност, размер)}
+    
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value, _ = entry
+        if expires_at <= time.monotonic():
+            self.delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key: str, value: Any, expires: Optional[float] = None) -> None:
+        ttl = self.ttl if expires is None else min(expires, self.ttl)
+        size = self.sizeof(value) if self.max_bytes is not None and self.sizeof is not None else 0
+        self.delete(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Стойност над целия бюджет би изместила всичко останало
+            return
+        self._entries[key] = (time.monotonic() + ttl, value, size)
+        self.size += size
+        # Изместваме най-отдавна използваните записи
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+    
+    def delete(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+    
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+    
+    def keys(self) -> List[str]:
+        return list(self._entries)
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Формат на записа се пази в първия байт (header): битове 0-2 - сериализация,
+# битове 3-4 - компресия. Стойностите са под 0x20, а старите записи без header
+# са JSON текст, който винаги започва с печатим символ - така кодекът може да
+# се сменя без изчистване на кеша.
+SERIALIZERS = {"json": 1, "orjson": 2, "msgpack": 3}
+COMPRESSIONS = {"none": 0, "zlib": 1, "lz4": 2}
+LEGACY_HEADER_LIMIT = 0x20
+
+class CacheCodec:
+    """
+    Сериализира стойностите за Redis с избран формат и компресира
+    записите над даден размер
+    
+    Чете записи във всички формати (ако библиотеката им е инсталирана),
+    независимо с кой формат пише.
+    """
+    def __init__(self, serializer: str = "json", compression: str = "zlib", compress_min_bytes: int = 1024):
+        """
+        Args:
+            serializer: json, orjson или msgpack
+            compression: none, zlib или lz4
+            compress_min_bytes: Записи под този размер не се компресират
+        """
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unknown cache serializer: {serializer}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown cache compression: {compression}")
+        if (serializer == "orjson" and orjson is None) or (serializer == "msgpack" and msgpack is None):
+            logger.warning(f"Cache serializer {serializer} is not installed, falling back to json")
+            serializer = "json"
+        if compression == "lz4" and lz4_frame is None:
+            logger.warning("lz4 is not installed, falling back to zlib cache compression")
+            compression = "zlib"
+        self.serializer = serializer
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+    
+    def _dumps(self, value: Any) -> bytes:
+        if self.serializer == "orjson":
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        if self.serializer == "msgpack":
+            return msgpack.packb(value, use_bin_type=True)
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+    
+    def encode(self, value: Any) -> tuple:
+        """
+        Returns:
+            (записът с header, размер преди компресия, дали е компресиран)
+        """
+        payload = self._dumps(value)
+        raw_size = len(payload)
+        compression = "none"
+        if self.compression != "none" and raw_size >= self.compress_min_bytes:
+            compressed = zlib.compress(payload, 6) if self.compression == "zlib" else lz4_frame.compress(payload)
+            # Некомпресируемите данни остават както са
+            if len(compressed) < raw_size:
+                payload = compressed
+                compression = self.compression
+        header = SERIALIZERS[self.serializer] | (COMPRESSIONS[compression] << 3)
+        return bytes([header]) + payload, raw_size, compression != "none"
+    
+    def decode(self, data: bytes) -> Any:
+        header = data[0]
+        if header >= LEGACY_HEADER_LIMIT:
+            # Стар запис от json.dumps без header
+            return json.loads(data)
+        
+        payload = data[1:]
+        compression = header >> 3
+        if compression == COMPRESSIONS["zlib"]:
+            payload = zlib.decompress(payload)
+        elif compression == COMPRESSIONS["lz4"]:
+            payload = lz4_frame.decompress(payload)
+        elif compression != COMPRESSIONS["none"]:
+            raise ValueError(f"Unknown cache entry header: {header:#x}")
+        
+        serializer = header & 0x07
+        if serializer == SERIALIZERS["json"]:
+            return json.loads(payload)
+        if serializer == SERIALIZERS["orjson"]:
+            return orjson.loads(payload)
+        if serializer == SERIALIZERS["msgpack"]:
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        raise ValueError(f"Unknown cache entry header: {header:#x}")
+
+class CacheSizeStats:
+    """Размер на записаните стойности за един префикс на ключовете"""
+    def __init__(self):
+        self.writes = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.max_stored_bytes = 0
+    
+    def record(self, raw_size: int, stored_size: int, compressed: bool) -> None:
+        self.writes += 1
+        self.compressed += int(compressed)
+        self.raw_bytes += raw_size
+        self.stored_bytes += stored_size
+        self.max_stored_bytes = max(self.max_stored_bytes, stored_size)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "writes": self.writes,
+            "compressed": self.compressed,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "avg_stored_bytes": self.stored_bytes / self.writes if self.writes else 0.0,
+            "max_stored_bytes": self.max_stored_bytes,
+            "compression_ratio": self.stored_bytes / self.raw_bytes if self.raw_bytes else 1.0,
+        }
+
+# Граници (в ms) на кофите в хистограмата за латентност на операциите
+LATENCY_BUCKETS_MS = [0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000]
+
+class CacheOpStats:
+    """Брой, грешки, попадения и хистограма на латентността за една операция и префикс"""
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.hits = 0
+        self.l1_hits = 0
+        self.misses = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    
+    def record(self, elapsed_ms: float, hits: int, l1_hits: int, misses: int, error: bool) -> None:
+        self.count += 1
+        self.errors += int(error)
+        self.hits += hits
+        self.l1_hits += l1_hits
+        self.misses += misses
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "hits": self.hits,
+            "l1_hits": self.l1_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "avg_ms": self.total_ms / self.count if self.count else 0.0,
+            "max_ms": self.max_ms,
+            "latency_histogram": [{"bucket": label, "count": count} for label, count in zip(labels, self.buckets)],
+        }
+
+class CacheMetrics:
+    """
+    Статистика за кеша по префикс на ключа: операции, попадения,
+    латентност и размер на записаните стойности
+    
+    Кешът се използва само от event loop-а, затова не са нужни lock-ове.
+    """
+    def __init__(self):
+        self.ops = {}  # {(префикс, операция): CacheOpStats}
+        self.sizes = {}  # {префикс: CacheSizeStats}
+        self.degraded = False
+        self.degraded_since = None  # time.time() на последното влизане в degraded режим
+        self.mode_switches = 0
+    
+    def record(self, op: str, key: str, started: float, hits: int = 0, l1_hits: int = 0, misses: int = 0, error: bool = False) -> None:
+        """
+        Args:
+            op: Операция (get, get_many, set, set_many, delete, clear_pattern)
+            key: Ключ (или шаблон) - по него се определя префиксът
+            started: time.perf_counter() в началото на операцията
+            hits: Намерени ключове (включително в L1)
+            l1_hits: От тях - намерени в L1
+            misses: Липсващи ключове
+            error: Дали операцията е завършила с грешка
+        """
+        index = (get_key_prefix(key), op)
+        if index not in self.ops:
+            self.ops[index] = CacheOpStats()
+        self.ops[index].record((time.perf_counter() - started) * 1000, hits, l1_hits, misses, error)
+    
+    def record_size(self, key: str, raw_size: int, stored_size: int, compressed: bool) -> None:
+        prefix = get_key_prefix(key)
+        if prefix not in self.sizes:
+            self.sizes[prefix] = CacheSizeStats()
+        self.sizes[prefix].record(raw_size, stored_size, compressed)
+    
+    def record_mode(self, degraded: bool) -> None:
+        """Отбелязва влизане или излизане от degraded режим (без Redis)"""
+        if degraded == self.degraded:
+            return
+        self.degraded = degraded
+        self.degraded_since = time.time() if degraded else None
+        self.mode_switches += 1
+    
+    def mode(self) -> Dict[str, Any]:
+        return {
+            "degraded": self.degraded,
+            "degraded_since": self.degraded_since,
+            "mode_switches": self.mode_switches,
+        }
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Статистиката, групирана по префикс"""
+        result = {}
+        for (prefix, op), stats in sorted(self.ops.items()):
+            result.setdefault(prefix, {"operations": {}})["operations"][op] = stats.snapshot()
+        for prefix, stats in sorted(self.sizes.items()):
+            result.setdefault(prefix, {"operations": {}})["size"] = stats.snapshot()
+        return result
+    
+    def prometheus(self, namespace: str = "bookstore_cache") -> str:
+        """Статистиката във формата на Prometheus (text exposition format)"""
+        lines = [
+            f"# HELP {namespace}_degraded Whether the cache is running on the local fallback without Redis",
+            f"# TYPE {namespace}_degraded gauge",
+            f"{namespace}_degraded {int(self.degraded)}",
+            f"# HELP {namespace}_mode_switches_total Switches between Redis and the local fallback",
+            f"# TYPE {namespace}_mode_switches_total counter",
+            f"{namespace}_mode_switches_total {self.mode_switches}",
+            f"# HELP {namespace}_operations_total Cache operations by key prefix",
+            f"# TYPE {namespace}_operations_total counter",
+        ]
+        ops = sorted(self.ops.items())
+        for (prefix, op), stats in ops:
+            lines.append(f'{namespace}_operations_total{{prefix="{prefix}",op="{op}"}} {stats.count}')
+        
+        lines += [f"# HELP {namespace}_errors_total Failed cache operations", f"# TYPE {namespace}_errors_total counter"]
+        for (prefix, op), stats in ops:
+            lines.append(f'{namespace}_errors_total{{prefix="{prefix}",op="{op}"}} {stats.errors}')
+        
+        lines += [f"# HELP {namespace}_hits_total Keys found in the cache", f"# TYPE {namespace}_hits_total counter"]
+        for (prefix, op), stats in ops:
+            if stats.hits or stats.misses:
+                lines.append(f'{namespace}_hits_total{{prefix="{prefix}",op="{op}",layer="l1"}} {stats.l1_hits}')
+                lines.append(f'{namespace}_hits_total{{prefix="{prefix}",op="{op}",layer="redis"}} {stats.hits - stats.l1_hits}')
+        
+        lines += [f"# HELP {namespace}_misses_total Keys not found in the cache", f"# TYPE {namespace}_misses_total counter"]
+        for (prefix, op), stats in ops:
+            if stats.hits or stats.misses:
+                lines.append(f'{namespace}_misses_total{{prefix="{prefix}",op="{op}"}} {stats.misses}')
+        
+        name = f"{namespace}_operation_duration_seconds"
+        lines += [f"# HELP {name} Cache operation latency", f"# TYPE {name} histogram"]
+        for (prefix, op), stats in ops:
+            labels = f'prefix="{prefix}",op="{op}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS_MS, stats.buckets):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound / 1000:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {stats.count}')
+            lines.append(f"{name}_sum{{{labels}}} {stats.total_ms / 1000:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {stats.count}")
+        
+        sizes = sorted(self.sizes.items())
+        for metric, attribute, help_text in (
+            ("raw_bytes_total", "raw_bytes", "Serialized size of written values before compression"),
+            ("stored_bytes_total", "stored_bytes", "Size of written values as stored in Redis"),
+        ):
+            lines += [f"# HELP {namespace}_{metric} {help_text}", f"# TYPE {namespace}_{metric} counter"]
+            for prefix, stats in sizes:
+                lines.append(f'{namespace}_{metric}{{prefix="{prefix}"}} {getattr(stats, attribute)}')
+        
+        return "\n".join(lines) + "\n"
+
+class Expiring(NamedTuple):
+    """
+    Стойност от compute за get_or_compute, която не бива да се връща след
+    until (unix време) - напр. цена, която се сменя с началото или края на
+    промоция. Записът в кеша изтича най-късно тогава, без stale период.
+    """
+    value: Any
+    until: Optional[float] = None
+
+def capped_ttl(expires: int, until: Optional[float]) -> int:
+    """
+    Ограничава времето за изтичане (в секунди) до момента until
+    
+    Args:
+        expires: Обичайното време за изтичане
+        until: Unix време, след което стойността е невалидна (None - без ограничение)
+        
+    Returns:
+        Времето за изтичане, но поне 1 секунда
+    """
+    if until is None:
+        return expires
+    return max(1, min(expires, int(until - time.time())))
+
+def _remaining_seconds(pttl: int) -> Optional[float]:
+    """
+    Остатъкът от TTL-а според PTTL в секунди: None, ако ключът не изтича
+    (-1), и 0, ако е изтекъл между двете команди (-2)
+    """
+    if pttl == -1:
+        return None
+    return max(pttl, 0) / 1000
+
+def _unwrap(value: Any) -> Any:
+    return value.value if isinstance(value, Expiring) else value
+
 class RedisCache:
-    def __init__(self, redis_url: str = "redis://localhost:6379/0"):
+    def __init__(
+        self,
+        redis_url: str = "redis://localhost:6379/0",
+        local_max_entries: int = 0,
+        local_ttl: float = 30,
+        codec: Optional[CacheCodec] = None,
+        fallback_max_entries: int = 5000,
+        fallback_ttl: float = 60,
+        fallback_max_bytes: int = 64 * 1024 * 1024
+    ):
         """
-        Инициализира Redis кеш клиент
+        Инициализира asyncio Redis кеш клиент
+        Връзката се проверява с connect() при стартиране на приложението
+        
+        Докато Redis е недостъпен, self.redis е None и кешът работи в degraded
+        режим: стойностите се пазят в ограничен локален кеш на worker-а, а
+        връзката се възстановява във фонов task с нарастваща пауза.
         
         Args:
             redis_url: Връзка към Redis сървъра
+            local_max_entries: Размер на in-process L1 кеша (0 - без L1)
+            local_ttl: Максимално време (в секунди) на запис в L1
+            codec: Сериализация на стойностите (по подразбиране JSON + zlib)
+            fallback_max_entries: Размер на локалния кеш в degraded режим (0 - без кеш)
+            fallback_ttl: Максимално време (в секунди) на запис в локалния кеш
+                в degraded режим - останалите worker-и не виждат инвалидирането
+            fallback_max_bytes: Максимален общ размер (в байтове) на кодираните
+                стойности в локалния кеш в degraded режим - пази и цели HTML страници
         """
-        self.redis = redis.from_url(redis_url)
-        # Проверяваме връзката при стартиране
+        self.client = aioredis.from_url(redis_url)
+        self.redis = self.client
+        self.codec = codec or CacheCodec()
+        self.metrics = CacheMetrics()
+        self.local = LocalCache(local_max_entries, local_ttl) if local_max_entries > 0 else None
+        self.fallback = LocalCache(
+            fallback_max_entries, fallback_ttl, fallback_max_bytes, self._encoded_size
+        ) if fallback_max_entries > 0 else None
+        self._listener = None
+        self._reconnect_task = None
+        self._scripts = {}  # {текст на Lua скрипт: AsyncScript}
+        self._inflight = {}  # {key: asyncio.Task} - текущите преизчисления в този worker
+        # Инвалидирания по време на degraded режим - прилагат се в Redis след възстановяване
+        self._pending_keys = set()
+        self._pending_generations = set()
+        self._pending_overflow = False
+    
+    @property
+    def degraded(self) -> bool:
+        return self.redis is None
+    
+    async def connect(self) -> None:
+        """Проверява връзката с Redis и пуска слушателя за инвалидиране на L1"""
         try:
-            self.redis.ping()
+            await self.client.ping()
             logger.info("Successfully connected to Redis")
-        except redis.ConnectionError:
-            logger.error("Could not connect to Redis")
-            self.redis = None
+        except (redis.ConnectionError, redis.TimeoutError, OSError) as e:
+            self._enter_degraded(e)
+            return
+        
+        if self.local is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen_for_invalidations())
     
-    def get(self, key: str) -> Optional[Any]:
+    async def close(self) -> None:
+        """Спира фоновите задачи и затваря връзките към Redis"""
+        for task in (self._listener, self._reconnect_task):
+            if task is not None:
+                task.cancel()
+        self._listener = None
+        self._reconnect_task = None
+        await self.client.aclose()
+    
+    @staticmethod
+    async def _unlink_matching(client: aioredis.Redis, pattern: str) -> int:
+        """
+        Изтрива ключовете по шаблон на порции от по 500 с една UNLINK команда
+        на порция - паметта се освобождава във фонов thread на Redis
+        
+        Args:
+            client: Redis клиент
+            pattern: Шаблон на ключовете
+            
+        Returns:
+            Брой изтрити ключове
+        """
+        deleted = 0
+        batch = []
+        async for key in client.scan_iter(match=pattern, count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                deleted += await client.unlink(*batch)
+                batch = []
+        if batch:
+            deleted += await client.unlink(*batch)
+        return deleted
+    
+    def _handle_error(self, error: Exception) -> None:
+        """Минава в degraded режим, ако грешката е от загубена връзка с Redis"""
+        if isinstance(error, (redis.ConnectionError, redis.TimeoutError, OSError)) and self.redis is not None:
+            self._enter_degraded(error)
+    
+    def _enter_degraded(self, error: Exception) -> None:
+        logger.warning(f"Redis is unavailable ({error}) - cache switched to degraded mode with a local fallback")
+        self.redis = None
+        self.metrics.record_mode(degraded=True)
+        if self._reconnect_task is None or self._reconnect_task.done():
+            try:
+                self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+            except RuntimeError:
+                # Извън event loop-а (напр. при импортиране) - няма какво да пуснем
+                self._reconnect_task = None
+    
+    async def _reconnect(self) -> None:
+        """Опитва да се свърже отново с Redis с експоненциално нарастваща пауза"""
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.client.ping()
+            except Exception as e:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                logger.info(f"Redis reconnect failed ({e}), next attempt in {delay:.0f}s")
+                continue
+            await self._leave_degraded()
+            return
+    
+    async def _leave_degraded(self) -> None:
+        """Прилага в Redis инвалидиранията от degraded режима и се връща към Redis"""
+        try:
+            if self._pending_overflow:
+                # Твърде много изтрити ключове - изтриваме всички кеширани обекти
+                for prefix in METRIC_PREFIXES:
+                    await self._unlink_matching(self.client, f"{prefix}*")
+            elif self._pending_keys:
+                await self.client.delete(*self._pending_keys)
+            for key in self._pending_generations:
+                await self.client.incr(key)
+        except Exception as e:
+            # Връзката пак е прекъснала - остаме в degraded режим и опитваме отново
+            logger.warning(f"Could not replay cache invalidations after reconnect: {e}")
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+            return
+        
+        self._pending_keys.clear()
+        self._pending_generations.clear()
+        self._pending_overflow = False
+        if self.fallback is not None:
+            self.fallback.clear()
+        if self.local is not None:
+            self.local.clear()
+        self.redis = self.client
+        self.metrics.record_mode(degraded=False)
+        logger.info("Reconnected to Redis - cache left degraded mode")
+        
+        if self.local is not None and self._listener is None:
+            self._listener = asyncio.create_task(self._listen_for_invalidations())
+    
+    def _remember_invalidation(self, key: str) -> None:
+        """Запомня изтрит в degraded режим ключ, за да се изтрие и от Redis"""
+        if len(self._pending_keys) >= MAX_PENDING_INVALIDATIONS:
+            self._pending_overflow = True
+        else:
+            self._pending_keys.add(key)
+    
+    async def _listen_for_invalidations(self) -> None:
+        """Слуша INVALIDATION_CHANNEL и трие получените ключове от L1"""
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    key = message["data"].decode()
+                    if key == "*":
+                        self.local.clear()
+                    else:
+                        self.local.delete(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Докато няма връзка, L1 може да е остарял - изчистваме го
+                logger.error(f"Cache invalidation listener error: {e}")
+                self.local.clear()
+                await asyncio.sleep(1)
+    
+    async def _invalidate_local(self, key: str) -> None:
+        """Изтрива ключ ("*" - всички) от L1 на този worker и го съобщава на останалите"""
+        if self.local is None:
+            return
+        if key == "*":
+            self.local.clear()
+        else:
+            self.local.delete(key)
+        if not self.redis:
+            # Останалите worker-и изчистват L1 сами, докато нямат връзка
+            return
+        try:
+            await self.redis.publish(INVALIDATION_CHANNEL, key)
+        except Exception as e:
+            logger.error(f"Error publishing cache invalidation: {e}")
+    
+    def _encoded_size(self, value: Any) -> int:
+        """Размерът на стойността така, както би се записала в Redis"""
+        return len(self.codec.encode(value)[0])
+    
+    def _encode(self, key: str, value: Any) -> bytes:
+        """Сериализира стойността и отчита размера й за префикса на ключа"""
+        data, raw_size, compressed = self.codec.encode(value)
+        self.metrics.record_size(key, raw_size, len(data), compressed)
+        return data
+    
+    async def get(self, key: str) -> Optional[Any]:
         """
         Извлича данни от кеша по ключ
         
@@ -35,42 +650,168 @@ class RedisCache:
         Returns:
             Кешираната стойност или None, ако ключът не е намерен
         """
+        started = time.perf_counter()
         if not self.redis:
-            return None
+            value = self.fallback.get(key) if self.fallback is not None else None
+            self.metrics.record("get", key, started, hits=int(value is not None), l1_hits=int(value is not None), misses=int(value is None))
+            return value
+        
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                self.metrics.record("get", key, started, hits=1, l1_hits=1)
+                return value
         
         try:
-            data = self.redis.get(key)
+            if self.local is not None:
+                # Остатъкът от TTL-а идва в същата заявка - L1 не бива да пази
+                # записа по-дълго от Redis (напр. цена до края на промоция)
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.get(key)
+                pipe.pttl(key)
+                data, pttl = await pipe.execute()
+            else:
+                data = await self.redis.get(key)
             if data:
-                return json.loads(data)
+                value = self.codec.decode(data)
+                if self.local is not None:
+                    self.local.set(key, value, _remaining_seconds(pttl))
+                self.metrics.record("get", key, started, hits=1)
+                return value
+            self.metrics.record("get", key, started, misses=1)
             return None
         except Exception as e:
             logger.error(f"Error retrieving from cache: {e}")
+            self._handle_error(e)
+            self.metrics.record("get", key, started, misses=1, error=True)
             return None
     
-    def set(self, key: str, value: Any, expires: int = 3600) -> bool:
+    async def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """
+        Извлича няколко ключа наведнъж - ключовете, които не са в L1, се
+        взимат с една MGET заявка
+        
+        Args:
+            keys: Ключове за търсене в кеша (статистиката се води по
+                префикса на първия)
+            
+        Returns:
+            Стойностите в реда на ключовете (None за липсващите)
+        """
+        if not keys:
+            return []
+        
+        started = time.perf_counter()
+        if not self.redis:
+            values = [self.fallback.get(key) if self.fallback is not None else None for key in keys]
+            found = sum(1 for value in values if value is not None)
+            self.metrics.record("get_many", keys[0], started, hits=found, l1_hits=found, misses=len(keys) - found)
+            return values
+        
+        values = [self.local.get(key) if self.local is not None else None for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        l1_hits = len(keys) - len(missing)
+        if not missing:
+            self.metrics.record("get_many", keys[0], started, hits=l1_hits, l1_hits=l1_hits)
+            return values
+        
+        error = False
+        try:
+            if self.local is not None:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.mget([keys[i] for i in missing])
+                for i in missing:
+                    pipe.pttl(keys[i])
+                found, *pttls = await pipe.execute()
+            else:
+                found = await self.redis.mget([keys[i] for i in missing])
+            for n, (i, data) in enumerate(zip(missing, found)):
+                if data:
+                    values[i] = self.codec.decode(data)
+                    if self.local is not None:
+                        self.local.set(keys[i], values[i], _remaining_seconds(pttls[n]))
+        except Exception as e:
+            logger.error(f"Error retrieving many from cache: {e}")
+            self._handle_error(e)
+            error = True
+        
+        misses = sum(1 for value in values if value is None)
+        self.metrics.record("get_many", keys[0], started, hits=len(keys) - misses, l1_hits=l1_hits, misses=misses, error=error)
+        return values
+    
+    async def set(self, key: str, value: Any, expires: int = 3600) -> bool:
         """
         Записва данни в кеша
         
         Args:
             key: Ключ за записване
-            value: Стойност за записване (ще бъде сериализирана до JSON)
+            value: Стойност за записване (сериализира се с self.codec)
             expires: Време за изтичане в секунди (по подразбиране 1 час)
             
         Returns:
             True ако операцията е успешна, иначе False
         """
         if not self.redis:
-            return False
+            if self.fallback is None:
+                return False
+            self.fallback.set(key, value, expires)
+            return True
         
+        started = time.perf_counter()
         try:
-            serialized_value = json.dumps(value)
-            self.redis.setex(key, expires, serialized_value)
+            await self.redis.setex(key, expires, self._encode(key, value))
+            if self.local is not None:
+                self.local.set(key, value, expires)
+            self.metrics.record("set", key, started)
             return True
         except Exception as e:
             logger.error(f"Error setting cache: {e}")
+            self._handle_error(e)
+            self.metrics.record("set", key, started, error=True)
+            return False
+    
+    async def set_many(self, items: Dict[str, Any], expires: int = 3600, ttls: Optional[Dict[str, int]] = None) -> bool:
+        """
+        Записва няколко ключа с един pipeline (едно отиване до Redis)
+        
+        Args:
+            items: Речник {ключ: стойност}
+            expires: Време за изтичане в секунди за всички ключове
+            ttls: Различно време за изтичане на някои от ключовете
+            
+        Returns:
+            True ако операцията е успешна, иначе False
+        """
+        if not items:
+            return False
+        
+        ttls = ttls or {}
+        if not self.redis:
+            if self.fallback is None:
+                return False
+            for key, value in items.items():
+                self.fallback.set(key, value, ttls.get(key, expires))
+            return True
+        
+        started = time.perf_counter()
+        first_key = next(iter(items))
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for key, value in items.items():
+                pipeline.setex(key, ttls.get(key, expires), self._encode(key, value))
+            await pipeline.execute()
+            if self.local is not None:
+                for key, value in items.items():
+                    self.local.set(key, value, ttls.get(key, expires))
+            self.metrics.record("set_many", first_key, started)
+            return True
+        except Exception as e:
+            logger.error(f"Error setting many in cache: {e}")
+            self._handle_error(e)
+            self.metrics.record("set_many", first_key, started, error=True)
             return False
     
-    def delete(self, key: str) -> bool:
+    async def delete(self, key: str) -> bool:
         """
         Изтрива запис от кеша
         
@@ -81,18 +822,30 @@ class RedisCache:
             True ако ключът е изтрит, иначе False
         """
         if not self.redis:
-            return False
+            if self.fallback is not None:
+                self.fallback.delete(key)
+            self._remember_invalidation(key)
+            return True
         
+        started = time.perf_counter()
         try:
-            self.redis.delete(key)
+            await self.redis.delete(key)
+            await self._invalidate_local(key)
+            self.metrics.record("delete", key, started)
             return True
         except Exception as e:
             logger.error(f"Error deleting from cache: {e}")
+            self._handle_error(e)
+            self._remember_invalidation(key)
+            self.metrics.record("delete", key, started, error=True)
             return False
     
-    def clear_pattern(self, pattern: str) -> int:
+    async def clear_pattern(self, pattern: str) -> int:
         """
         Изтрива всички ключове, които съвпадат с даден шаблон
+        Обхожда ключовете на порции със SCAN, а не с KEYS, за да не блокира
+        Redis сървъра. За инвалидиране на групи ключове използвайте
+        bump_generation - тази операция е O(брой ключове).
         
         Args:
             pattern: Шаблон за съвпадение (напр. "book:*")
@@ -101,18 +854,307 @@ class RedisCache:
             Брой изтрити ключове
         """
         if not self.redis:
-            return 0
-            
+            deleted = 0
+            if self.fallback is not None:
+                for key in [key for key in self.fallback.keys() if fnmatch.fnmatchcase(key, pattern)]:
+                    self.fallback.delete(key)
+                    deleted += 1
+            # Шаблонът не може да се запомни като отделни ключове
+            self._pending_overflow = True
+            return deleted
+        
+        started = time.perf_counter()
         try:
-            keys = self.redis.keys(pattern)
-            if keys:
-                return self.redis.delete(*keys)
-            return 0
+            deleted = await self._unlink_matching(self.redis, pattern)
+            await self._invalidate_local("*")
+            self.metrics.record("clear_pattern", pattern, started)
+            return deleted
         except Exception as e:
             logger.error(f"Error clearing pattern from cache: {e}")
+            self._handle_error(e)
+            self.metrics.record("clear_pattern", pattern, started, error=True)
             return 0
     
-    def increment(self, key: str, amount: int = 1) -> Optional[int]:
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        expires: int = 3600,
+        stale: int = 300,
+        lock_timeout: int = 30,
+        beta: float = 1.0
+    ) -> Any:
+        """
+        Връща стойността от кеша, като я преизчислява най-много веднъж
+        едновременно (single-flight) при изтичане
+        
+        Записът пази стойността, времето за изчисляването й и "мекото" изтичане.
+        В Redis той живее expires + stale секунди. След мекото изтичане (или по-рано
+        с вероятност, която расте към него - XFetch) един worker взима lock и
+        преизчислява стойността във фонов task, а всички заявки дотогава получават
+        старата стойност. При празен кеш останалите заявки изчакват lock-холдъра
+        до LOCK_WAIT_SECONDS, вместо да пускат същата заявка към базата.
+        
+        Args:
+            key: Ключ в кеша
+            compute: Async функция без аргументи, която изчислява стойността.
+                Може да се изпълни след края на заявката, затова трябва сама
+                да отваря сесия към базата. Ако върне Expiring, записът
+                изтича най-късно в Expiring.until.
+            expires: Време (в секунди), за което стойността е свежа
+            stale: Колко секунди след това може да се връща старата стойност
+            lock_timeout: Максимално време (в секунди) на lock-а за преизчисляване
+            beta: Колко агресивно да се преизчислява преди изтичане (0 - изключено)
+            
+        Returns:
+            Кешираната или новоизчислената стойност
+        """
+        if not self.redis and self.fallback is None:
+            return _unwrap(await compute())
+        
+        entry = await self.get(key)
+        if isinstance(entry, dict) and "e" in entry:
+            # XFetch: -log(U) е експоненциално разпределено, така че по-бавните
+            # за изчисляване стойности започват да се обновяват по-рано
+            early = entry["d"] * beta * -math.log(1.0 - random.random())
+            if time.time() + early >= entry["e"] and key not in self._inflight:
+                self._start_recompute(key, compute, expires, stale, lock_timeout, wait=False)
+            return entry["v"]
+        
+        # Празен кеш - заявките в този worker чакат едно и също изчисление
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._start_recompute(key, compute, expires, stale, lock_timeout, wait=True)
+        return await asyncio.shield(task)
+    
+    def _start_recompute(self, key: str, compute, expires: int, stale: int, lock_timeout: int, wait: bool) -> asyncio.Task:
+        task = asyncio.ensure_future(self._recompute(key, compute, expires, stale, lock_timeout, wait))
+        self._inflight[key] = task
+        
+        def done(finished):
+            if self._inflight.get(key) is finished:
+                del self._inflight[key]
+            if not wait and not finished.cancelled() and finished.exception():
+                logger.error(f"Error refreshing cache key {key}: {finished.exception()}")
+        
+        task.add_done_callback(done)
+        return task
+    
+    async def _recompute(self, key: str, compute, expires: int, stale: int, lock_timeout: int, wait: bool) -> Any:
+        """
+        Преизчислява стойността под lock в Redis
+        
+        Args:
+            wait: True при празен кеш - ако lock-ът е зает, изчакваме стойността
+                от lock-холдъра; False при фоново обновяване - тогава просто се отказваме
+        """
+        if not self.redis:
+            # В degraded режим е достатъчен single-flight-ът в рамките на worker-а
+            return await self._store(key, compute, expires, stale)
+        
+        lock_key = f"{LOCK_PREFIX}{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self.redis.set(lock_key, token, nx=True, px=lock_timeout * 1000)
+        except Exception as e:
+            # Без lock е по-добре да изчислим стойността, отколкото да не отговорим
+            logger.error(f"Error acquiring cache lock: {e}")
+            self._handle_error(e)
+            acquired = True
+            token = None
+        
+        if not acquired:
+            if not wait:
+                return None
+            deadline = time.monotonic() + LOCK_WAIT_SECONDS
+            while time.monotonic() < deadline:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+                entry = await self.get(key)
+                if isinstance(entry, dict) and "e" in entry:
+                    return entry["v"]
+            logger.warning(f"Timed out waiting for cache lock {lock_key}")
+        
+        try:
+            return await self._store(key, compute, expires, stale)
+        finally:
+            if acquired and token is not None:
+                try:
+                    await self.client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+                except Exception as e:
+                    # Lock-ът така или иначе изтича след lock_timeout
+                    logger.error(f"Error releasing cache lock: {e}")
+    
+    async def _store(self, key: str, compute, expires: int, stale: int) -> Any:
+        """Изчислява стойността и я записва заедно с времето за изчисление и мекото изтичане"""
+        start = time.monotonic()
+        value = await compute()
+        duration = time.monotonic() - start
+        
+        ttl = expires + stale
+        soft_expiry = time.time() + expires
+        if isinstance(value, Expiring):
+            # Стойността е валидна само до until - без stale период след това
+            value, until = value
+            if until is not None:
+                ttl = capped_ttl(ttl, until)
+                soft_expiry = min(soft_expiry, until)
+        
+        entry = {"v": value, "d": duration, "e": soft_expiry}
+        await self.set(key, entry, expires=ttl)
+        return value
+    
+    async def refresh(self, key: str, compute: Callable[[], Awaitable[Any]], expires: int = 3600, stale: int = 300) -> Any:
+        """
+        Преизчислява и презаписва стойност за get_or_compute, дори ако е свежа
+        Използва се при подгряване на кеша.
+        
+        Args:
+            key: Ключ в кеша
+            compute: Async функция без аргументи, която изчислява стойността
+            expires: Време (в секунди), за което стойността е свежа
+            stale: Колко секунди след това може да се връща старата стойност
+            
+        Returns:
+            Новата стойност
+        """
+        if not self.redis and self.fallback is None:
+            return _unwrap(await compute())
+        return await self._store(key, compute, expires, stale)
+    
+    async def increment_score(
+        self, key: str, member: Union[str, int], amount: float = 1, max_members: Optional[int] = None
+    ) -> None:
+        """
+        Увеличава резултата на елемент в sorted set (напр. брой прегледи на книга)
+        
+        Args:
+            key: Ключ на sorted set-а
+            member: Елемент
+            amount: Стойност за добавяне
+            max_members: Ако е зададено, set-ът се подрязва до толкова елемента
+                с най-висок резултат
+        """
+        if not self.redis:
+            return
+        
+        try:
+            if max_members is None:
+                await self.redis.zincrby(key, amount, member)
+                return
+            
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zincrby(key, amount, member)
+            pipe.zremrangebyrank(key, 0, -(max_members + 1))
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Error incrementing score: {e}")
+    
+    async def top_members(self, key: str, limit: int) -> List[str]:
+        """
+        Връща елементите с най-голям резултат от sorted set
+        
+        Args:
+            key: Ключ на sorted set-а
+            limit: Брой елементи
+            
+        Returns:
+            Елементите, подредени по резултат (низходящо)
+        """
+        if not self.redis or limit <= 0:
+            return []
+        
+        try:
+            return [member.decode() for member in await self.redis.zrevrange(key, 0, limit - 1)]
+        except Exception as e:
+            logger.error(f"Error retrieving top members: {e}")
+            return []
+    
+    async def run_script(self, script: str, keys: List[str], args: List[Any]) -> Any:
+        """
+        Изпълнява Lua скрипт атомарно в Redis
+        Скриптът се зарежда веднъж, след което се вика по SHA (EVALSHA).
+        
+        Args:
+            script: Текст на Lua скрипта
+            keys: Ключовете, които скриптът използва (KEYS)
+            args: Аргументи на скрипта (ARGV)
+            
+        Returns:
+            Резултатът от скрипта или None, ако Redis не е достъпен
+        """
+        if not self.redis:
+            return None
+        
+        try:
+            registered = self._scripts.get(script)
+            if registered is None:
+                registered = self._scripts[script] = self.client.register_script(script)
+            return await registered(keys=keys, args=args)
+        except Exception as e:
+            logger.error(f"Error running cache script: {e}")
+            self._handle_error(e)
+            return None
+    
+    async def get_generations(self, *namespaces: str) -> List[int]:
+        """
+        Връща текущото поколение на няколко namespace-а с една MGET заявка
+        
+        Поколението се вгражда в кеш ключовете на namespace-а, така че
+        след bump_generation старите записи просто не се четат повече и
+        изтичат сами чрез TTL.
+        
+        Args:
+            namespaces: Имена на namespace-и (напр. SEARCH_GENERATION)
+            
+        Returns:
+            Списък с поколенията в същия ред (0, ако още няма инвалидиране)
+        """
+        keys = [f"{GENERATION_PREFIX}{namespace}" for namespace in namespaces]
+        if not self.redis:
+            # В degraded режим поколенията са локални за worker-а
+            return [(self.fallback.get(key) if self.fallback is not None else None) or 0 for key in keys]
+        generations = [self.local.get(key) if self.local is not None else None for key in keys]
+        missing = [i for i, generation in enumerate(generations) if generation is None]
+        if not missing:
+            return generations
+        
+        try:
+            values = await self.redis.mget([keys[i] for i in missing])
+            for i, value in zip(missing, values):
+                generations[i] = int(value) if value else 0
+                if self.local is not None:
+                    self.local.set(keys[i], generations[i])
+            return generations
+        except Exception as e:
+            logger.error(f"Error retrieving cache generations: {e}")
+            self._handle_error(e)
+            return [0] * len(namespaces)
+    
+    async def get_generation(self, namespace: str) -> int:
+        """Връща текущото поколение на един namespace"""
+        return (await self.get_generations(namespace))[0]
+    
+    async def bump_generation(self, namespace: str) -> Optional[int]:
+        """
+        Инвалидира всички ключове на namespace с една INCR операция
+        
+        Args:
+            namespace: Име на namespace
+            
+        Returns:
+            Новото поколение или None при грешка
+        """
+        key = f"{GENERATION_PREFIX}{namespace}"
+        if not self.redis:
+            self._pending_generations.add(key)
+        generation = await self.increment(key)
+        if generation is None and self.redis is None:
+            # Връзката е прекъснала по време на INCR
+            self._pending_generations.add(key)
+        await self._invalidate_local(key)
+        return generation
+    
+    async def increment(self, key: str, amount: int = 1) -> Optional[int]:
         """
         Увеличава стойност на ключ с определена стойност
         Полезно за броене на посещения/импресии
@@ -125,12 +1167,17 @@ class RedisCache:
             Новата стойност след увеличаването или None при грешка
         """
         if not self.redis:
-            return None
+            if self.fallback is None:
+                return None
+            value = (self.fallback.get(key) or 0) + amount
+            self.fallback.set(key, value)
+            return value
             
         try:
-            return self.redis.incrby(key, amount)
+            return await self.redis.incrby(key, amount)
         except Exception as e:
             logger.error(f"Error incrementing key: {e}")
+            self._handle_error(e)
             return None
 
 # Функции за кеширане на конкретни сценарии в приложението
@@ -138,25 +1185,111 @@ class RedisCache:
 # Префикси за кеш ключове
 BOOK_DETAIL_PREFIX = "book:detail:"
 BOOK_SEARCH_PREFIX = "book:search:"
+BOOK_CARD_PREFIX = "book:card:"
+BOOK_SUGGEST_PREFIX = "book:suggest:"
 CATEGORY_PREFIX = "category:"
 BESTSELLERS_KEY = "bestsellers"
 TOP_RATED_KEY = "top_rated"
+HOME_KEY = "home"
+PAGE_PREFIX = "page:"
+USER_PREFIX = "user:"
+# Sorted set с броя прегледи на всяка книга - за подгряване на кеша
+BOOK_VIEWS_KEY = "book:views"
+
+# Поколения (generation counters) на групите ключове. Стойностите се пазят
+# в Redis под "gen:<namespace>" без TTL.
+GENERATION_PREFIX = "gen:"
+SEARCH_GENERATION = "book:search"
+SUGGEST_GENERATION = "book:suggest"
+BESTSELLERS_GENERATION = "bestsellers"
+# Всяка промяна в книга или категория - за кеша на HTML страниците
+CATALOG_GENERATION = "catalog"
+# Всяка промяна в картите на книгите (вкл. наличност след поръчка) - за ETag на списъците
+CARDS_GENERATION = "book:cards"
+
+# Префикси, по които се групира статистиката за кеша
+METRIC_PREFIXES = (
+    BOOK_DETAIL_PREFIX, BOOK_SEARCH_PREFIX, BOOK_CARD_PREFIX, BOOK_SUGGEST_PREFIX,
+    CATEGORY_PREFIX, BESTSELLERS_KEY, TOP_RATED_KEY, HOME_KEY, PAGE_PREFIX, USER_PREFIX,
+)
+
+def get_key_prefix(key: str) -> str:
+    """Префикс на ключа за статистиката - познат префикс или частта до първото ":" """
+    for prefix in METRIC_PREFIXES:
+        if key.startswith(prefix):
+            return prefix.rstrip(":")
+    return key.split(":", 1)[0]
+
+def get_category_search_generation(category_id: int) -> str:
+    """Namespace на резултатите от търсене, филтрирани по категория"""
+    return f"{SEARCH_GENERATION}:cat{category_id}"
 
 def get_book_cache_key(book_id: int) -> str:
     """Генерира кеш ключ за детайли на книга"""
     return f"{BOOK_DETAIL_PREFIX}{book_id}"
 
-def get_book_search_cache_key(query: str, category_id: Optional[int] = None, in_stock: Optional[bool] = None) -> str:
+def get_book_card_cache_key(book_id: int) -> str:
+    """Генерира кеш ключ за картата на книга в списъците (без описание и отзиви)"""
+    return f"{BOOK_CARD_PREFIX}{book_id}"
+
+async def get_book_search_cache_key(cache: RedisCache, query: str, category_id: Optional[int] = None, **params: Any) -> str:
     """
-    Генерира кеш ключ за резултати от търсене
-    Включва всички параметри на търсенето в ключа
+    Генерира кеш ключ за подредения списък с ID-та от търсене
+    
+    Параметрите на заявката се сериализират канонично (сортирани ключове) и
+    се хешират, така че всяка комбинация от филтри, сортиране, размер и
+    курсор/offset има собствен ключ. Текущите поколения остават в ключа, за
+    да може списъците да се инвалидират с bump_generation.
+    
+    Args:
+        cache: Redis кеш клиент (за поколенията)
+        query: Текст за търсене
+        category_id: Категория - има собствено поколение
+        params: Всички останали филтри и параметри на страницата
     """
-    key = f"{BOOK_SEARCH_PREFIX}{query}"
+    namespaces = [SEARCH_GENERATION]
+    if category_id is not None:
+        namespaces.append(get_category_search_generation(category_id))
+    generations = await cache.get_generations(*namespaces)
+    
+    canonical = json.dumps({"query": query, "category_id": category_id, **params}, sort_keys=True, default=str)
+    key = f"{BOOK_SEARCH_PREFIX}g{generations[0]}"
     if category_id is not None:
-        key += f":cat{category_id}"
-    if in_stock is not None:
-        key += f":stock{int(in_stock)}"
-    return key
+        key += f":cat{category_id}v{generations[1]}"
+    return f"{key}:{hashlib.sha1(canonical.encode()).hexdigest()}"
+
+async def get_book_suggest_cache_key(cache: RedisCache, prefix: str, limit: int) -> str:
+    """Генерира кеш ключ за предложенията при писане в полето за търсене"""
+    return f"{BOOK_SUGGEST_PREFIX}g{await cache.get_generation(SUGGEST_GENERATION)}:{limit}:{prefix}"
+
+async def get_bestsellers_cache_key(cache: RedisCache, limit: int, days: Optional[int] = None) -> str:
+    """Генерира кеш ключ за бестселърите (за всички времена или за последните days дни)"""
+    return f"{BESTSELLERS_KEY}:g{await cache.get_generation(BESTSELLERS_GENERATION)}:{limit}:{days or 'all'}"
+
+async def get_page_cache_key(cache: RedisCache, path: str, params: List[tuple]) -> str:
+    """
+    Генерира кеш ключ за рендерирана HTML страница
+    
+    Ключът включва поколението на каталога и това на картите на книгите,
+    така че страниците се сменят и при промяна само в наличността (поръчки
+    и откази).
+    
+    Args:
+        cache: Redis кеш клиент (за поколенията на каталога и картите)
+        path: Път на страницата
+        params: Query параметрите като (име, стойност) двойки
+    """
+    canonical = json.dumps(sorted(params))
+    catalog, cards = await cache.get_generations(CATALOG_GENERATION, CARDS_GENERATION)
+    return f"{PAGE_PREFIX}g{catalog}.{cards}:{path}:{hashlib.sha1(canonical.encode()).hexdigest()}"
+
+def get_user_generation(user_id: int) -> str:
+    """Namespace (версия) на кешираните данни за потребител"""
+    return f"{USER_PREFIX}{user_id}"
+
+async def get_user_cache_key(cache: RedisCache, user_id: int) -> str:
+    """Генерира кеш ключ за потребителя на заявката (ID + версия)"""
+    return f"{USER_PREFIX}{user_id}:v{await cache.get_generation(get_user_generation(user_id))}"
 
 def get_category_cache_key(category_id: Optional[int] = None) -> str:
     """Генерира кеш ключ за категории"""
@@ -165,26 +1298,79 @@ def get_category_cache_key(category_id: Optional[int] = None) -> str:
     return f"{CATEGORY_PREFIX}all"
 
 # Функции за инвалидиране на кеша при обновяване
-def invalidate_book_cache(cache: RedisCache, book_id: int) -> None:
+async def invalidate_book_cards(cache: RedisCache, book_ids: List[int]) -> None:
+    """
+    Изтрива детайлите и картите на книги, без да пипа резултатите от търсене
+    
+    За промени, които не местят книгите в/от списъците (цена, наличност,
+    отзиви, промоции). Кешираните списъци с ID-та остават валидни и при
+    следващото четене зареждат новите карти.
+    
+    Args:
+        cache: Redis кеш клиент
+        book_ids: ID-та на променените книги
+    """
+    for book_id in set(book_ids):
+        await cache.delete(get_book_cache_key(book_id))
+        await cache.delete(get_book_card_cache_key(book_id))
+    await cache.bump_generation(CARDS_GENERATION)
+
+async def invalidate_book_cache(cache: RedisCache, book_id: int, search: bool = True) -> None:
     """
     Инвалидира кеша за книга, когато книгата се промени
     
     Args:
         cache: Redis кеш клиент
         book_id: ID на книгата, която е обновена
+        search: False, ако промяната засяга само картата на книгата -
+            тогава резултатите от търсене не се инвалидират
     """
-    # Изтриваме конкретната книга от кеша
-    cache.delete(get_book_cache_key(book_id))
+    # Изтриваме детайлите и картата на книгата от кеша
+    await invalidate_book_cards(cache, [book_id])
     
-    # Изтриваме свързани резултати от търсенето
-    # Използваме wildcard подход, тъй като не знаем в кои търсения участва книгата
-    cache.clear_pattern(f"{BOOK_SEARCH_PREFIX}*")
+    if search:
+        # Инвалидираме свързаните резултати от търсенето
+        # Не знаем в кои търсения участва книгата, затова сменяме поколението
+        await cache.bump_generation(SEARCH_GENERATION)
+        await cache.bump_generation(SUGGEST_GENERATION)
+        # Новите книги на началната страница
+        await cache.delete(HOME_KEY)
     
     # Инвалидираме бестселъри и най-оценени книги
-    cache.delete(BESTSELLERS_KEY)
-    cache.delete(TOP_RATED_KEY)
+    await cache.bump_generation(BESTSELLERS_GENERATION)
+    await cache.delete(TOP_RATED_KEY)
+    
+    # Рендерираните страници показват цени, промоции и отзиви
+    await cache.bump_generation(CATALOG_GENERATION)
+
+async def invalidate_book_ratings(cache: RedisCache, book_ids: List[int]) -> None:
+    """
+    Инвалидира кеша след обновяване на рейтингите на няколко книги (Goodreads)
+    
+    Картите и детайлите на книгите се изтриват, а списъците, подредени по
+    рейтинг, и рендерираните страници се сменят с едно ново поколение.
+    
+    Args:
+        cache: Redis кеш клиент
+        book_ids: ID-та на книгите с нов рейтинг
+    """
+    await invalidate_book_cards(cache, book_ids)
+    await cache.bump_generation(SEARCH_GENERATION)
+    await cache.delete(TOP_RATED_KEY)
+    await cache.bump_generation(CATALOG_GENERATION)
+
+async def invalidate_user_cache(cache: RedisCache, user_id: int) -> None:
+    """
+    Сменя версията на потребителя при промяна на ролята или активността му,
+    така че следващата заявка да го прочете наново от базата
+    
+    Args:
+        cache: Redis кеш клиент
+        user_id: ID на потребителя
+    """
+    await cache.bump_generation(get_user_generation(user_id))
 
-def invalidate_category_cache(cache: RedisCache, category_id: int) -> None:
+async def invalidate_category_cache(cache: RedisCache, category_id: int) -> None:
     """
     Инвалидира кеша за категория при промяна
     
@@ -193,16 +1379,34 @@ def invalidate_category_cache(cache: RedisCache, category_id: int) -> None:
         category_id: ID на категорията, която е обновена
     """
     # Изтриваме конкретната категория
-    cache.delete(get_category_cache_key(category_id))
+    await cache.delete(get_category_cache_key(category_id))
     
     # Изтриваме целия списък категории
-    cache.delete(get_category_cache_key())
+    await cache.delete(get_category_cache_key())
     
-    # Изтриваме свързани резултати от търсенето
-    cache.clear_pattern(f"{BOOK_SEARCH_PREFIX}*:cat{category_id}*")
+    # Инвалидираме резултатите от търсене в категорията
+    await cache.bump_generation(get_category_search_generation(category_id))
+    await cache.bump_generation(CATALOG_GENERATION)
 
 # Създаваме глобален RedisCache обект
-redis_cache = RedisCache()
+# CACHE_L1_MAX_ENTRIES > 0 включва in-process L1 кеша във всеки worker
+# CACHE_CODEC, CACHE_COMPRESSION и CACHE_COMPRESS_MIN_BYTES избират формата
+# на новите записи - старите се четат и след смяна
+# CACHE_FALLBACK_MAX_ENTRIES, CACHE_FALLBACK_MAX_BYTES и CACHE_FALLBACK_TTL
+# ограничават локалния кеш, който се използва, докато Redis е недостъпен
+# (CACHE_FALLBACK_MAX_ENTRIES=0 - без кеш в този случай)
+redis_cache = RedisCache(
+    local_max_entries=int(os.getenv("CACHE_L1_MAX_ENTRIES", "0")),
+    local_ttl=float(os.getenv("CACHE_L1_TTL", "30")),
+    fallback_max_entries=int(os.getenv("CACHE_FALLBACK_MAX_ENTRIES", "5000")),
+    fallback_ttl=float(os.getenv("CACHE_FALLBACK_TTL", "60")),
+    fallback_max_bytes=int(os.getenv("CACHE_FALLBACK_MAX_BYTES", str(64 * 1024 * 1024))),
+    codec=CacheCodec(
+        serializer=os.getenv("CACHE_CODEC", "json"),
+        compression=os.getenv("CACHE_COMPRESSION", "zlib"),
+        compress_min_bytes=int(os.getenv("CACHE_COMPRESS_MIN_BYTES", "1024"))
+    )
+)
 
 # Dependency за инжектиране в endpoints
 def get_cache() -> RedisCache:
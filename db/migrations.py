@@ -0,0 +1,115 @@
+import logging
+from sqlalchemy import text, select, func, cast, Date
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Engine
+
+from app.db.models import (
+    Base, Order, OrderItem, OrderStatus, BookSales, BookSalesDaily, BOOK_SEARCH_VECTOR_SQL
+)
+
+# Конфигуриране на логера
+logger = logging.getLogger(__name__)
+
+
+def ensure_indexes(engine: Engine) -> None:
+    """
+    Създава липсващите индекси от моделите
+
+    Base.metadata.create_all създава индексите само заедно с нова таблица,
+    затова индексите, добавени към вече съществуващи таблици, се създават тук.
+
+    Args:
+        engine: Енджин към primary базата
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def add_book_search_vector(engine: Engine) -> None:
+    """
+    Добавя генерираната tsvector колона books.search_vector към съществуваща база
+    Postgres я попълва за всички редове при добавянето и я поддържа сам
+
+    Args:
+        engine: Енджин към primary базата
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            "ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector "
+            f"GENERATED ALWAYS AS ({BOOK_SEARCH_VECTOR_SQL}) STORED"
+        ))
+
+
+def add_book_review_stats(engine: Engine) -> None:
+    """
+    Добавя колоните със статистиката на отзивите към books
+    Стойностите се попълват с backfill-review-stats.py
+
+    Args:
+        engine: Енджин към primary базата
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            "ALTER TABLE books "
+            "ADD COLUMN IF NOT EXISTS review_count integer NOT NULL DEFAULT 0, "
+            "ADD COLUMN IF NOT EXISTS rating_sum integer NOT NULL DEFAULT 0, "
+            "ADD COLUMN IF NOT EXISTS avg_rating double precision"
+        ))
+
+
+def backfill_book_sales(engine: Engine) -> None:
+    """
+    Попълва book_sales и book_sales_daily от историята на поръчките
+    Изпълнява се само докато book_sales е празна - след това агрегатите
+    се поддържат от create_order / cancel_order.
+
+    Args:
+        engine: Енджин към primary базата
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        if connection.execute(select(BookSales.book_id).limit(1)).first() is not None:
+            return
+        
+        units = func.sum(OrderItem.quantity)
+        day = cast(Order.created_at, Date)
+        sold_items = (
+            select(OrderItem.book_id)
+            .join(Order, Order.id == OrderItem.order_id)
+            .where(Order.status != OrderStatus.CANCELLED, OrderItem.book_id.isnot(None))
+        )
+        # ON CONFLICT DO NOTHING - няколко worker-а може да стартират едновременно
+        connection.execute(
+            pg_insert(BookSales)
+            .from_select(["book_id", "units_sold"], sold_items.add_columns(units).group_by(OrderItem.book_id))
+            .on_conflict_do_nothing()
+        )
+        connection.execute(
+            pg_insert(BookSalesDaily)
+            .from_select(
+                ["book_id", "day", "units_sold"],
+                sold_items.add_columns(day, units).group_by(OrderItem.book_id, day)
+            )
+            .on_conflict_do_nothing()
+        )
+
+
+def apply_schema_updates(engine: Engine) -> None:
+    """
+    Прилага идемпотентните промени по схемата върху съществуваща база
+    Извиква се при стартиране, след Base.metadata.create_all
+
+    Args:
+        engine: Енджин към primary базата
+    """
+    add_book_search_vector(engine)
+    add_book_review_stats(engine)
+    ensure_indexes(engine)
+    backfill_book_sales(engine)
+    logger.info("Database schema is up to date")
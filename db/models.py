@@ -1,11 +1,19 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Table, Text, DateTime, Enum, JSON
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Table, Text, DateTime, Date, Enum, JSON, Index, Computed, DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred, query_expression
 from datetime import datetime
 import enum
 
 Base = declarative_base()
 
+# Trigram индексите на заглавията изискват pg_trgm - включваме го преди create_all
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
+
 # Междинна таблица за връзка между книги и категории
 book_category = Table(
     'book_category',
@@ -89,6 +97,20 @@ class Category(Base):
     )
 
 
+# Конфигурация за пълнотекстовото търсене. Postgres няма речник за български,
+# а руският stemmer поврежда българските думи, затова думите се индексират
+# без stemming ('simple') и се търсят с префиксно съвпадение.
+BOOK_SEARCH_CONFIG = "simple"
+
+# Израз за генерираната колона books.search_vector - заглавията са с най-голяма
+# тежест, след тях издателството и накрая описанието
+BOOK_SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(original_title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(publisher, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'C')"
+)
+
 class Book(Base):
     __tablename__ = 'books'
     
@@ -109,9 +131,18 @@ class Book(Base):
     goodreads_id = Column(String, nullable=True)
     goodreads_rating = Column(Float, nullable=True)
     goodreads_rating_updated = Column(DateTime, nullable=True)
+    # Статистика на отзивите - поддържа се от create/update/delete_review
+    review_count = Column(Integer, nullable=False, default=0, server_default="0")
+    rating_sum = Column(Integer, nullable=False, default=0, server_default="0")
+    avg_rating = Column(Float, nullable=True)  # NULL, докато няма отзиви
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Пълнотекстов индекс, поддържан от Postgres (не се зарежда с обекта)
+    search_vector = deferred(Column(TSVECTOR, Computed(BOOK_SEARCH_VECTOR_SQL, persisted=True)))
+    # ts_rank спрямо текущото търсене - попълва се само от заявките за търсене
+    search_rank = query_expression()
+    
     # Отношения
     categories = relationship("Category", secondary=book_category, back_populates="books")
     promotions = relationship("Promotion", back_populates="book")
@@ -119,6 +150,20 @@ class Book(Base):
     order_items = relationship("OrderItem", back_populates="book")
 
 
+# Индекси за keyset пагинацията на каталога - (ключ за сортиране, id) в реда,
+# в който се чете. Колоните без NULL се обхождат и в обратна посока.
+Index("ix_books_title_id", Book.title, Book.id)
+Index("ix_books_price_id", Book.price, Book.id)
+Index("ix_books_created_at_id", Book.created_at.desc().nulls_last(), Book.id.desc())
+Index("ix_books_goodreads_rating_id", Book.goodreads_rating.desc().nulls_last(), Book.id.desc())
+Index("ix_books_avg_rating_id", Book.avg_rating.desc().nulls_last(), Book.id.desc())
+# GIN индекс за пълнотекстовото търсене
+Index("ix_books_search_vector", Book.search_vector, postgresql_using="gin")
+# Trigram индекси за предложенията при писане
+Index("ix_books_title_trgm", Book.title, postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"})
+Index("ix_books_original_title_trgm", Book.original_title, postgresql_using="gin", postgresql_ops={"original_title": "gin_trgm_ops"})
+
+
 class Review(Base):
     __tablename__ = 'reviews'
     
@@ -134,6 +179,10 @@ class Review(Base):
     book = relationship("Book", back_populates="reviews")
 
 
+# Последните отзиви за книга на страницата с детайли
+Index("ix_reviews_book_id_created_at", Review.book_id, Review.created_at.desc())
+
+
 class Promotion(Base):
     __tablename__ = 'promotions'
     
@@ -182,3 +231,30 @@ class OrderItem(Base):
     # Отношения
     order = relationship("Order", back_populates="items")
     book = relationship("Book", back_populates="order_items")
+
+
+class BookSales(Base):
+    """
+    Общ брой продадени бройки на книга (без отказаните поръчки)
+    Поддържа се от create_order / cancel_order, за да не се сумира цялата
+    история на поръчките при всяко показване на бестселърите.
+    """
+    __tablename__ = 'book_sales'
+    
+    book_id = Column(Integer, ForeignKey('books.id', ondelete="CASCADE"), primary_key=True)
+    units_sold = Column(Integer, nullable=False, default=0)
+
+
+class BookSalesDaily(Base):
+    """Продадени бройки на книга за един ден (по датата на поръчката)"""
+    __tablename__ = 'book_sales_daily'
+    
+    book_id = Column(Integer, ForeignKey('books.id', ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    units_sold = Column(Integer, nullable=False, default=0)
+
+
+# Top-N на бестселърите се чете директно от индекса
+Index("ix_book_sales_units_sold", BookSales.units_sold.desc(), BookSales.book_id)
+# Продажбите за последните N дни
+Index("ix_book_sales_daily_day", BookSalesDaily.day, BookSalesDaily.book_id)
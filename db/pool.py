@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+import logging
+from typing import Dict, Any, List
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# Конфигуриране на логера
+logger = logging.getLogger(__name__)
+
+# Граници (в ms) на кофите в хистограмата за време на изчакване при checkout
+WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000]
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def pool_settings_from_env() -> Dict[str, Any]:
+    """
+    Чете настройките на connection pool-а от environment променливи
+
+    Returns:
+        Речник с аргументи за create_engine / create_async_engine
+    """
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_pre_ping": _env_bool("DB_POOL_PRE_PING", True),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    }
+
+
+class PoolMonitor:
+    """
+    Събира статистика за checkout-ите от даден pool:
+    хистограма на времето за изчакване и брой изтекли checkout-и (QueuePool limit)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def record_checkout(self, wait_ms: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            for i, bound in enumerate(WAIT_BUCKETS_MS):
+                if wait_ms <= bound:
+                    self.buckets[i] += 1
+                    break
+            else:
+                self.buckets[-1] += 1
+
+    def record_timeout(self, wait_ms: float) -> None:
+        with self._lock:
+            self.timeouts += 1
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def histogram(self) -> List[Dict[str, Any]]:
+        labels = [f"<={bound}ms" for bound in WAIT_BUCKETS_MS] + [f">{WAIT_BUCKETS_MS[-1]}ms"]
+        return [{"bucket": label, "count": count} for label, count in zip(labels, self.buckets)]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkout_timeouts": self.timeouts,
+                "avg_wait_ms": self.total_wait_ms / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": self.max_wait_ms,
+                "wait_histogram": self.histogram(),
+            }
+
+
+def monitored_pool_class(base=QueuePool):
+    """
+    Създава наследник на даден pool клас, който измерва времето за checkout
+
+    Всеки извикан клас има собствен PoolMonitor, който се запазва и при
+    engine.dispose() (тогава SQLAlchemy пресъздава pool-а от същия клас).
+
+    Args:
+        base: QueuePool за sync енджина или AsyncAdaptedQueuePool за async енджина
+
+    Returns:
+        Pool клас за аргумента poolclass на create_engine
+    """
+    class MonitoredPool(base):
+        monitor = PoolMonitor()
+
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except exc.TimeoutError:
+                wait_ms = (time.perf_counter() - start) * 1000
+                self.monitor.record_timeout(wait_ms)
+                logger.warning(f"Database pool checkout timed out after {wait_ms:.0f} ms: {self.status()}")
+                raise
+            self.monitor.record_checkout((time.perf_counter() - start) * 1000)
+            return connection
+
+    MonitoredPool.__name__ = f"Monitored{base.__name__}"
+    return MonitoredPool
+
+
+def pool_stats(engine) -> Dict[str, Any]:
+    """
+    Връща текущото състояние на pool-а на даден енджин
+
+    Args:
+        engine: Sync Engine или AsyncEngine
+
+    Returns:
+        Речник с live статистика
+    """
+    pool = getattr(engine, "sync_engine", engine).pool
+    stats = {
+        "pool_class": type(pool).__name__,
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": getattr(pool, "_max_overflow", None),
+        "timeout": pool.timeout() if hasattr(pool, "timeout") else None,
+        "status": pool.status(),
+    }
+    monitor = getattr(pool, "monitor", None)
+    if monitor is not None:
+        stats.update(monitor.snapshot())
+    return stats
@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import asyncio
+import functools
+import logging
+from contextvars import ContextVar
+from typing import Optional, List
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+# Конфигуриране на логера
+logger = logging.getLogger(__name__)
+
+# Реплики за четене - списък от postgresql:// URL-и, разделени със запетая
+REPLICA_URLS = [url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(",") if url.strip()]
+# Колко секунди след собствен запис потребителят чете само от primary
+READ_YOUR_WRITES_SECONDS = int(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+
+# Идентификатор на текущия потребител (user ID или IP) за заявката
+_request_principal: ContextVar[Optional[str]] = ContextVar("db_request_principal", default=None)
+# True, ако текущата заявка трябва да чете от primary (read-your-writes)
+_force_primary: ContextVar[bool] = ContextVar("db_force_primary", default=False)
+
+
+def to_async_url(url: str) -> str:
+    """Превръща postgresql:// URL в URL за asyncpg драйвера"""
+    if url.startswith("postgresql+asyncpg://"):
+        return url
+    return "postgresql+asyncpg://" + url.split("://", 1)[1]
+
+
+class ReadYourWrites:
+    """
+    Помни кои потребители са писали наскоро, за да четат от primary,
+    докато репликите наваксат. Пази записите локално и, ако е подаден,
+    в Redis кеша, за да важи прозорецът и за останалите worker-и.
+    """
+    MAX_LOCAL_ENTRIES = 10000
+
+    def __init__(self, window_seconds: int = READ_YOUR_WRITES_SECONDS, cache=None):
+        self.window_seconds = window_seconds
+        self.cache = cache
+        self._local = {}  # {principal: време на изтичане}
+        self._pending = set()  # незавършените записи в Redis
+
+    def _key(self, principal: str) -> str:
+        return f"db:primary:{principal}"
+
+    def mark(self, principal: str) -> None:
+        """Отбелязва, че потребителят току-що е записал нещо"""
+        if len(self._local) >= self.MAX_LOCAL_ENTRIES:
+            now = time.monotonic()
+            self._local = {p: until for p, until in self._local.items() if until > now}
+        self._local[principal] = time.monotonic() + self.window_seconds
+        if self.cache is None:
+            return
+        # mark се вика от sync after_commit събитие, затова записът в Redis
+        # се изпълнява като отделен task в event loop-а
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self.cache.set(self._key(principal), 1, expires=self.window_seconds))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def is_recent(self, principal: str) -> bool:
+        """Проверява дали потребителят е в прозореца след собствен запис"""
+        until = self._local.get(principal)
+        if until is not None:
+            if until > time.monotonic():
+                return True
+            self._local.pop(principal, None)
+        if self.cache is not None:
+            return bool(await self.cache.get(self._key(principal)))
+        return False
+
+
+read_your_writes = ReadYourWrites()
+
+
+async def begin_request(principal: Optional[str]) -> tuple:
+    """
+    Задава контекста за маршрутизиране на текущата заявка
+
+    Args:
+        principal: ID на потребителя или IP адрес на клиента
+
+    Returns:
+        Токените за end_request
+    """
+    return (
+        _request_principal.set(principal),
+        _force_primary.set(bool(principal) and await read_your_writes.is_recent(principal)),
+    )
+
+
+def end_request(tokens: tuple) -> None:
+    """Връща контекста за маршрутизиране отпреди begin_request"""
+    principal_token, primary_token = tokens
+    _force_primary.reset(primary_token)
+    _request_principal.reset(principal_token)
+
+
+def detach_request_context() -> None:
+    """
+    Изчиства контекста на заявката във фонов task
+
+    Task-овете копират контекста, в който са създадени - без това подгряване,
+    пуснато от заявка, би наследило нейния потребител и read-your-writes флаг.
+    """
+    _request_principal.set(None)
+    _force_primary.set(False)
+
+
+def replica_read(func):
+    """
+    Декоратор за crud функции, които само четат. Заявките им отиват към
+    реплика (ако има конфигурирани), освен ако сесията вече е писала или
+    потребителят е в read-your-writes прозореца. Първият аргумент на
+    функцията трябва да бъде Session или AsyncSession.
+    """
+    def _sync_session(db):
+        return getattr(db, "sync_session", db)
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(db, *args, **kwargs):
+            info = _sync_session(db).info
+            info["replica_reads"] = info.get("replica_reads", 0) + 1
+            try:
+                return await func(db, *args, **kwargs)
+            finally:
+                info["replica_reads"] -= 1
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(db, *args, **kwargs):
+        info = _sync_session(db).info
+        info["replica_reads"] = info.get("replica_reads", 0) + 1
+        try:
+            return func(db, *args, **kwargs)
+        finally:
+            info["replica_reads"] -= 1
+    return wrapper
+
+
+class RoutingSession(Session):
+    """
+    Сесия, която избира енджин за всяка заявка: записите и всичко след
+    първия flush отиват към primary, а четенията от replica_read функции -
+    към случайна реплика.
+    """
+    primary = None
+    replicas: List = []
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if isinstance(clause, UpdateBase):
+            # INSERT/UPDATE/DELETE, изпълнени директно през session.execute()
+            self.info["has_writes"] = True
+            return self.primary
+        if (
+            self.replicas
+            and self.info.get("replica_reads")
+            and not self.info.get("has_writes")
+            and not self._flushing
+            and not _force_primary.get()
+        ):
+            return random.choice(self.replicas)
+        return self.primary
+
+
+def routing_session_class(primary, replicas: List):
+    """
+    Създава RoutingSession клас за даден primary и реплики
+
+    Args:
+        primary: Engine (или AsyncEngine) за записи
+        replicas: Списък от енджини само за четене
+
+    Returns:
+        Клас за sessionmaker(class_=...) или sync_session_class на AsyncSession
+    """
+    # AsyncSession работи върху sync Session, затова тя получава sync енджините
+    def sync(engine):
+        return getattr(engine, "sync_engine", engine)
+
+    return type("RoutingSession", (RoutingSession,), {
+        "primary": sync(primary),
+        "replicas": [sync(replica) for replica in replicas],
+    })
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _mark_session_writes(session, flush_context):
+    if session.new or session.dirty or session.deleted:
+        session.info["has_writes"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _start_read_your_writes(session):
+    if not session.info.pop("has_writes", False):
+        return
+    # Извън заявка (фонови task-ове) няма потребител, който да чака своя
+    # запис - иначе флагът би останал в контекста на task-а завинаги
+    principal = _request_principal.get()
+    if not principal:
+        return
+    # Останалата част от заявката и следващите заявки на потребителя в
+    # прозореца четат от primary
+    _force_primary.set(True)
+    if session.replicas:
+        read_your_writes.mark(principal)
@@ -7,6 +7,8 @@ import re
 from urllib.parse import quote_plus
 from datetime import datetime, timedelta
 
+from app.db.routing import detach_request_context
+
 # Конфигуриране на логера
 logger = logging.getLogger(__name__)
 
@@ -344,7 +346,7 @@ async def update_book_from_goodreads(db, book_id: int) -> bool:
     logger.warning(f"Could not fetch rating for book {book.title} (ID: {book_id})")
     return False
 
-async def update_books_ratings(db) -> Tuple[int, int]:
+async def update_books_ratings(db) -> Tuple[List[int], int]:
     """
     Обновява рейтинги за всички книги, които се нуждаят от обновяване
     
@@ -352,7 +354,7 @@ async def update_books_ratings(db) -> Tuple[int, int]:
         db: Сесия към базата данни
         
     Returns:
-        Tuple със (брой успешни обновявания, общ брой книги за обновяване)
+        Tuple със (ID-та на успешно обновените книги, общ брой книги за обновяване)
     """
     from app.crud import get_books  # Избягваме цикличен импорт
     from app.db.models import Book
@@ -373,17 +375,17 @@ async def update_books_ratings(db) -> Tuple[int, int]:
     ).all()
     
     total_books = len(books_to_update)
-    success_count = 0
+    updated_ids = []
     
     for book in books_to_update:
         success = await update_book_from_goodreads(db, book.id)
         if success:
-            success_count += 1
+            updated_ids.append(book.id)
         
         # Малка пауза между заявките, за да избегнем rate limiting
         await asyncio.sleep(1)
     
-    return success_count, total_books
+    return updated_ids, total_books
 
 # Планировчик за периодично обновяване на рейтинги
 class GoodreadsUpdater:
@@ -391,16 +393,20 @@ class GoodreadsUpdater:
     Клас за периодично обновяване на рейтинги от Goodreads
     """
     
-    def __init__(self, db_function, interval_hours: int = 24):
+    def __init__(self, db_function, interval_hours: int = 24, on_update=None):
         """
         Инициализира планировчика
         
         Args:
             db_function: Функция, която предоставя DB сесия
             interval_hours: Интервал в часове между обновяванията
+            on_update: Async функция, която получава ID-тата на обновените
+                книги след всеки цикъл с обновени книги (напр. за
+                инвалидиране и подгряване на кеша)
         """
         self.db_function = db_function
         self.interval_hours = interval_hours
+        self.on_update = on_update
         self.is_running = False
         self.task = None
     
@@ -409,19 +415,25 @@ class GoodreadsUpdater:
         Основен цикъл за периодично обновяване
         Изпълнява се в безкраен цикъл, докато self.is_running е True
         """
+        # Цикълът не е част от заявка - четенията не се пренасочват към primary
+        detach_request_context()
+        
         while self.is_running:
             try:
                 # Получаваме DB сесия
                 db = self.db_function()
                 
                 # Обновяваме книгите
-                success_count, total_count = await update_books_ratings(db)
+                updated_ids, total_count = await update_books_ratings(db)
                 
-                logger.info(f"Updated {success_count}/{total_count} books from Goodreads")
+                logger.info(f"Updated {len(updated_ids)}/{total_count} books from Goodreads")
                 
                 # Затваряме сесията
                 db.close()
                 
+                if updated_ids and self.on_update is not None:
+                    await self.on_update(updated_ids)
+                
                 # Изчакваме до следващото обновяване
                 await asyncio.sleep(self.interval_hours * 3600)
             except Exception as e:
@@ -588,15 +600,17 @@ async def debug_goodreads_search(title: str, author: str = None) -> dict:
 
 
 # Функция за инициализация
-def init_goodreads_updater(db_function):
+def init_goodreads_updater(db_function, on_update=None):
     """
     Инициализира и връща GoodreadsUpdater
     
     Args:
         db_function: Функция, която връща DB сесия
+        on_update: Async функция, която получава ID-тата на обновените книги
+            след всеки цикъл с обновени книги
         
     Returns:
         GoodreadsUpdater обект
     """
-    updater = GoodreadsUpdater(db_function)
+    updater = GoodreadsUpdater(db_function, on_update=on_update)
     return updater
@@ -1,6 +1,9 @@
 from datetime import datetime, timedelta
 from typing import List, Optional, Union, Dict, Any
+from collections import OrderedDict
 import os
+import time
+import fnmatch
 import secrets
 import pyotp
 import qrcode
@@ -9,6 +12,7 @@ import base64
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 
@@ -36,6 +40,36 @@ class TokenData:
         self.username = username
         self.role = role
 
+# Автентикираният потребител на заявката
+class Principal:
+    """
+    Полетата на потребителя, нужни за проверка на достъпа
+    Кешира се като речник, за да не се чете потребителят от базата при всяка заявка.
+    """
+    def __init__(self, id: int, username: str, email: str, role: UserRole, is_active: bool = True):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.role = role
+        self.is_active = is_active
+    
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        return cls(user.id, user.username, user.email, user.role, user.is_active)
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Principal":
+        return cls(data["id"], data["username"], data["email"], UserRole(data["role"]), data["is_active"])
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "username": self.username,
+            "email": self.email,
+            "role": self.role.value,
+            "is_active": self.is_active
+        }
+
 # Функции за работа с пароли
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Проверява дали текстовата парола съвпада с хеширания вариант"""
@@ -117,6 +151,31 @@ def decode_token(token: str) -> TokenData:
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+def get_request_token(request: Request) -> Optional[TokenData]:
+    """
+    Декодира Bearer токена на заявката
+    Резултатът се пази в request.state, така че middleware-ите и endpoint-ите
+    декодират токена само веднъж на заявка.
+    
+    Args:
+        request: Заявката
+        
+    Returns:
+        TokenData или None, ако няма валиден токен
+    """
+    if hasattr(request.state, "token_data"):
+        return request.state.token_data
+    
+    token_data = None
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "):
+        try:
+            token_data = decode_token(auth_header.split(" ")[1])
+        except HTTPException:
+            pass
+    request.state.token_data = token_data
+    return token_data
+
 # 2FA функции
 def generate_totp_secret() -> str:
     """Генерира случаен secret key за TOTP"""
@@ -248,53 +307,203 @@ check_vip = check_role([UserRole.ADMIN, UserRole.MODERATOR, UserRole.VIP])
 check_authenticated = check_role([UserRole.ADMIN, UserRole.MODERATOR, UserRole.VIP, UserRole.USER])
 
 # Rate limiting функционалност
+
+# Колко неактивни адреса най-много се изхвърлят при една проверка
+RATE_LIMIT_EVICT_BATCH = 4
+
+# Лимитът се смята по плъзгащ се прозорец: броят в текущия прозорец плюс броя
+# в предходния, претеглен с частта от него, която още е в последните
+# window секунди. Проверката и увеличаването са един атомарен Lua скрипт.
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local weight = tonumber(ARGV[2])
+local cost = tonumber(ARGV[4])
+local current = tonumber(redis.call("GET", KEYS[1]) or "0")
+local previous = tonumber(redis.call("GET", KEYS[2]) or "0")
+if previous * weight + current + cost > limit then
+    return 0
+end
+redis.call("INCRBY", KEYS[1], cost)
+redis.call("PEXPIRE", KEYS[1], ARGV[3])
+return 1
+"""
+
 class RateLimiter:
     """
-    Проста имплементация на rate limiting с използване на in-memory dict.
-    За production среда е по-добре да се използва Redis.
+    Rate limiting по плъзгащ се прозорец с два брояча на клиент
+    
+    Броячите се пазят в Redis (ако е подаден кеш), така че лимитът е общ за
+    всички worker-и и сървъри. Докато Redis не е достъпен, всеки worker
+    брои заявките локално - в шардове по hash на IP адреса, с общ таван на
+    следените адреси. Всеки шард е подреден по последна заявка, така че
+    неактивните адреси се изхвърлят от началото му, а при пълен шард -
+    най-отдавна неактивният. Паметта и цената на проверката остават
+    постоянни и при наплив от много различни адреси.
     """
-    def __init__(self, requests_per_minute: int = 60):
+    def __init__(
+        self,
+        requests_per_minute: int = 60,
+        cache=None,
+        window_seconds: int = 60,
+        max_tracked: int = 100000,
+        shards: int = 16
+    ):
         self.requests_per_minute = requests_per_minute
-        self.requests = {}  # {ip: [(timestamp, count), ...]}
-    
-    def is_allowed(self, ip: str) -> bool:
+        self.window_seconds = window_seconds
+        self.cache = cache
+        self.shard_capacity = max(1, max_tracked // shards)
+        # [{ip: [номер на прозореца, брой в него, брой в предходния]}]
+        self.shards = [OrderedDict() for _ in range(shards)]
+        self.evictions = 0
+    
+    @property
+    def tracked(self) -> int:
+        """Брой клиенти с локални броячи"""
+        return sum(len(shard) for shard in self.shards)
+    
+    def _key(self, client: str, window: int) -> str:
+        # {client} е hash tag - двата ключа на клиента са в един слот на Redis Cluster
+        return f"ratelimit:{{{client}}}:{window}"
+    
+    async def is_allowed(self, client: str, limit: Optional[int] = None, cost: int = 1) -> bool:
         """
-        Проверява дали заявката е в рамките на лимита
+        Проверява дали заявката е в рамките на лимита и я отчита
         
         Args:
-            ip: IP адрес на клиента
+            client: Идентификатор на клиента (IP адрес или политика + потребител)
+            limit: Лимит за прозореца (по подразбиране requests_per_minute)
+            cost: Колко единици от лимита струва заявката
             
         Returns:
             Булева стойност дали заявката е разрешена
         """
-        now = datetime.utcnow()
-        minute_ago = now - timedelta(minutes=1)
-        
-        # Премахване на стари записи
-        if ip in self.requests:
-            self.requests[ip] = [r for r in self.requests[ip] if r[0] > minute_ago]
+        limit = self.requests_per_minute if limit is None else limit
+        now = time.time()
+        window = int(now // self.window_seconds)
+        # Частта от предходния прозорец, която още е в последните window_seconds
+        weight = 1 - (now % self.window_seconds) / self.window_seconds
+        
+        if self.cache is not None:
+            allowed = await self.cache.run_script(
+                SLIDING_WINDOW_SCRIPT,
+                keys=[self._key(client, window), self._key(client, window - 1)],
+                args=[limit, weight, self.window_seconds * 2 * 1000, cost]
+            )
+            if allowed is not None:
+                return bool(allowed)
+        
+        return self._is_allowed_local(client, window, weight, limit, cost)
+    
+    def _is_allowed_local(self, client: str, window: int, weight: float, limit: int, cost: int = 1) -> bool:
+        """Същата проверка с броячи в паметта на worker-а"""
+        shard = self.shards[hash(client) % len(self.shards)]
+        entry = shard.get(client)
+        if entry is None:
+            self._evict(shard, window)
+            entry = shard[client] = [window, 0, 0]
         else:
-            self.requests[ip] = []
+            shard.move_to_end(client)
         
-        # Броене на заявки за последната минута
-        count = sum(r[1] for r in self.requests[ip])
+        if entry[0] != window:
+            # Нов прозорец - текущият брояч става предходен (или се нулира, ако
+            # последната заявка е била преди повече от един прозорец)
+            entry[2] = entry[1] if entry[0] == window - 1 else 0
+            entry[0] = window
+            entry[1] = 0
         
-        if count >= self.requests_per_minute:
+        if entry[2] * weight + entry[1] + cost > limit:
             return False
         
-        # Добавяне на текущата заявка
-        self.requests[ip].append((now, 1))
+        entry[1] += cost
         return True
+    
+    def _evict(self, shard: OrderedDict, window: int) -> None:
+        """
+        Освобождава място в шарда преди добавяне на нов клиент
+        
+        Клиентите без заявки в текущия и предходния прозорец не влияят на
+        лимита и се махат (най-много няколко наведнъж, за да е проверката
+        O(1)). Ако шардът пак е пълен, се маха най-отдавна активният клиент.
+        """
+        for _ in range(RATE_LIMIT_EVICT_BATCH):
+            if not shard:
+                return
+            oldest = next(iter(shard.values()))
+            if oldest[0] >= window - 1:
+                break
+            shard.popitem(last=False)
+        
+        if len(shard) >= self.shard_capacity:
+            shard.popitem(last=False)
+            self.evictions += 1
 
-# Инстанция на rate limiter
-rate_limiter = RateLimiter()
+# Инстанция на rate limiter - кешът се задава при стартиране на приложението
+rate_limiter = RateLimiter(
+    requests_per_minute=int(os.getenv("RATE_LIMIT_PER_MINUTE", "60")),
+    max_tracked=int(os.getenv("RATE_LIMIT_MAX_TRACKED", "100000"))
+)
 
-# Продължение на предходния файл security.py
+class RateLimitPolicy:
+    """
+    Лимит за група заявки, избрана по път (fnmatch шаблон) и HTTP метод
+    
+    Всяка политика има собствен брояч за клиента, така че скъпите endpoint-и
+    се ограничават отделно от евтините кеширани четения. Лимитът е в
+    единици за минута, а всяка заявка струва cost единици. role_limits
+    задава различен лимит според ролята в JWT токена; None - без лимит.
+    """
+    def __init__(
+        self,
+        name: str,
+        pattern: str,
+        limit: Optional[int],
+        cost: int = 1,
+        methods: Optional[List[str]] = None,
+        role_limits: Optional[Dict[str, Optional[int]]] = None
+    ):
+        self.name = name
+        self.pattern = pattern
+        self.limit = limit
+        self.cost = cost
+        self.methods = set(methods) if methods else None
+        self.role_limits = role_limits or {}
+    
+    def matches(self, method: str, path: str) -> bool:
+        return (self.methods is None or method in self.methods) and fnmatch.fnmatchcase(path, self.pattern)
+    
+    def limit_for(self, role: Optional[str]) -> Optional[int]:
+        return self.role_limits.get(role, self.limit)
+
+# Политиките се проверяват по ред - прилага се първата, която съвпада
+RATE_LIMIT_POLICIES = [
+    RateLimitPolicy("static", "/static/*", limit=None),
+    # bcrypt проверката на паролата е умишлено бавна
+    RateLimitPolicy("login", "/api/token*", limit=10, methods=["POST"]),
+    RateLimitPolicy("orders", "/api/orders*", limit=20, methods=["POST", "PUT"]),
+    # Поръчките без регистрация се броят само по IP - по-строг лимит
+    RateLimitPolicy("guest-orders", "/api/guest-orders*", limit=5, methods=["POST"]),
+    # Агрегациите по поръчки - 6 отчета в минута
+    RateLimitPolicy(
+        "reports", "/api/admin/revenue*", limit=60, cost=10,
+        role_limits={UserRole.ADMIN.value: 120}
+    ),
+    RateLimitPolicy(
+        "default", "*", limit=rate_limiter.requests_per_minute,
+        role_limits={UserRole.ADMIN.value: 600, UserRole.MODERATOR.value: 300, UserRole.VIP.value: 120}
+    ),
+]
+
+def get_rate_limit_policy(method: str, path: str) -> Optional[RateLimitPolicy]:
+    """Връща първата политика, която съвпада със заявката"""
+    for policy in RATE_LIMIT_POLICIES:
+        if policy.matches(method, path):
+            return policy
+    return None
 
 # Rate limit middleware
 async def rate_limit_middleware(request: Request, call_next):
     """
-    Middleware за ограничаване на заявките по IP адрес
+    Middleware за ограничаване на заявките според RATE_LIMIT_POLICIES
     
     Args:
         request: FastAPI Request обект
@@ -303,19 +512,25 @@ async def rate_limit_middleware(request: Request, call_next):
     Returns:
         Response обект
         
-    Забележка: Този middleware се прилага на ниво приложение и 
-    ограничава всички заявки, идващи от един и същ IP адрес.
-    За по-сложни случаи може да се имплементира различен лимит за
-    различните endpoint-и или по-сложна логика.
+    Броячите са по потребител за заявките с валиден токен и по IP адрес
+    за останалите, отделно за всяка политика.
     """
-    client_ip = request.client.host
-    
-    # Пропускаме static файлове
-    if request.url.path.startswith("/static"):
+    policy = get_rate_limit_policy(request.method, request.url.path)
+    
+    # Ролята и потребителят се взимат от токена без заявка към базата
+    role = None
+    client = f"ip:{request.client.host}"
+    token_data = get_request_token(request)
+    if token_data is not None:
+        role = token_data.role
+        client = f"user:{token_data.user_id}"
+    
+    limit = policy.limit_for(role) if policy is not None else None
+    if limit is None:
         return await call_next(request)
     
     # Проверяваме дали заявката е в рамките на лимита
-    if not rate_limiter.is_allowed(client_ip):
+    if not await rate_limiter.is_allowed(f"{policy.name}:{client}", limit=limit, cost=policy.cost):
         from fastapi.responses import JSONResponse
         return JSONResponse(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
@@ -526,7 +741,9 @@ async def authenticate_endpoint(
     Raises:
         HTTPException: При неуспешна автентикация
     """
-    user = SecurityUtils.authenticate_user(db, username, password)
+    # Заявката към базата и bcrypt проверката блокират - изпълняват се в
+    # thread pool-а, за да не спират event loop-а
+    user = await run_in_threadpool(SecurityUtils.authenticate_user, db, username, password)
     
     if not user:
         raise HTTPException(
@@ -565,7 +782,7 @@ async def authenticate_endpoint(
     # Ако ролята изисква 2FA, но потребителят не го е активирал
     if requires_2fa and not user.two_factor_enabled:
         # Подготвяме 2FA настройки
-        twofa_setup = SecurityUtils.setup_2fa(user, db)
+        twofa_setup = await run_in_threadpool(SecurityUtils.setup_2fa, user, db)
         
         # Връщаме временен токен и данни за 2FA настройка
         token_data = {
@@ -619,7 +836,7 @@ async def verify_2fa_endpoint(
         
         from app.crud import get_user  # Избягваме цикличен импорт
         
-        user = get_user(db, int(user_id))
+        user = await run_in_threadpool(get_user, db, int(user_id))
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -675,7 +892,7 @@ async def setup_2fa_endpoint(
         
         from app.crud import get_user  # Избягваме цикличен импорт
         
-        user = get_user(db, int(user_id))
+        user = await run_in_threadpool(get_user, db, int(user_id))
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -691,7 +908,7 @@ async def setup_2fa_endpoint(
         
         # Активираме 2FA
         user.two_factor_enabled = True
-        db.commit()
+        await run_in_threadpool(db.commit)
         
         # Връщаме нормални токени за достъп
         return SecurityUtils.generate_tokens(user)
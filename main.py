@@ -4,9 +4,10 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.routing import Route
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response
 from starlette.requests import Request
 from sqlalchemy.orm import Session
 from app.db.security import decode_token
@@ -24,9 +25,14 @@ from app.schemas import (
 )
 from typing import Optional, List, Dict, Any
 import asyncio
+import functools
+import hashlib
+import ipaddress
+import json
 import os
+import time
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 # Импортираме нашите модули
 from app.db.models import (
@@ -34,11 +40,11 @@ from app.db.models import (
 	Promotion, Review, UserRole, OrderStatus
 )
 from app.db.security import (
-	rate_limit_middleware, get_current_user, 
+	rate_limit_middleware, rate_limiter, get_current_user, get_request_token, Principal,
 	check_admin, check_moderator, check_authenticated,
 	authenticate_endpoint, verify_2fa_endpoint, setup_2fa_endpoint
 )
-from app.db.cache import get_cache, RedisCache
+from app.db.cache import get_cache, RedisCache, Expiring
 from app.db.scraping import init_goodreads_updater, manual_update_book, fetch_book_details
 
 # Импортираме CRUD операции
@@ -48,6 +54,14 @@ import app.crud as crud
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from app.db.pool import pool_settings_from_env, monitored_pool_class, pool_stats
+from app.db.routing import (
+	REPLICA_URLS, to_async_url, routing_session_class, begin_request, end_request, detach_request_context,
+	read_your_writes
+)
+from app.db.migrations import apply_schema_updates
 
 # Настройки за базата данни от environment променливи
 POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
@@ -57,10 +71,38 @@ POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
 POSTGRES_DB = os.getenv("POSTGRES_DB", "bookshop")
 
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# Същата база през asyncpg драйвера - за async endpoint-ите
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
+
+# Настройки на connection pool-а (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_PRE_PING,
+# DB_POOL_RECYCLE, DB_POOL_TIMEOUT)
+POOL_SETTINGS = pool_settings_from_env()
 
 # Създаваме енджин за базата данни
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_engine(
+	DATABASE_URL, poolclass=monitored_pool_class(QueuePool), **POOL_SETTINGS
+)
+
+# Реплики само за четене (DB_REPLICA_URLS). Сесиите изпращат към тях заявките
+# на crud функциите, маркирани с @replica_read, а всички записи - към primary.
+replica_engines = [create_engine(url, **POOL_SETTINGS) for url in REPLICA_URLS]
+SessionLocal = sessionmaker(
+	autocommit=False, autoflush=False, class_=routing_session_class(engine, replica_engines)
+)
+
+# Async енджин - заявките не блокират event loop-а на uvicorn worker-а
+async_engine = create_async_engine(
+	ASYNC_DATABASE_URL, poolclass=monitored_pool_class(AsyncAdaptedQueuePool), **POOL_SETTINGS
+)
+async_replica_engines = [
+	create_async_engine(to_async_url(url), **POOL_SETTINGS) for url in REPLICA_URLS
+]
+AsyncSessionLocal = sessionmaker(
+	class_=AsyncSession,
+	sync_session_class=routing_session_class(async_engine, async_replica_engines),
+	autoflush=False,
+	expire_on_commit=False
+)
 
 # Зависимост за инжектиране на DB сесия
 def get_db():
@@ -70,6 +112,11 @@ def get_db():
 	finally:
 		db.close()
 
+# Зависимост за инжектиране на async DB сесия
+async def get_async_db():
+	async with AsyncSessionLocal() as db:
+		yield db
+
 # Настройваме логовете
 logging.basicConfig(
 	level=logging.INFO,
@@ -97,6 +144,8 @@ app.add_middleware(
 	allow_credentials=True,
 	allow_methods=["*"],
 	allow_headers=["*"],
+	# Курсорът за следващата страница на /api/books е в header-ите
+	expose_headers=["X-Next-Cursor", "Link"],
 )
 
 # Добавяме rate limiting middleware
@@ -104,6 +153,85 @@ app.add_middleware(
 async def rate_limit(request: Request, call_next):
 	return await rate_limit_middleware(request, call_next)
 
+def get_request_principal(request: Request) -> str:
+	"""Идентифицира клиента по user ID от токена или, ако няма такъв, по IP"""
+	token_data = get_request_token(request)
+	if token_data is not None:
+		return f"user:{token_data.user_id}"
+	return f"ip:{request.client.host}"
+
+# Маршрутизиране към репликите с read-your-writes прозорец за всеки потребител
+@app.middleware("http")
+async def db_routing(request: Request, call_next):
+	if not REPLICA_URLS:
+		return await call_next(request)
+	
+	tokens = await begin_request(get_request_principal(request))
+	try:
+		return await call_next(request)
+	finally:
+		end_request(tokens)
+
+# Колко секунди се пази потребителят на заявката в кеша
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+
+async def load_principal(user_id: int) -> Optional[Principal]:
+	"""
+	Зарежда потребителя за проверка на достъпа - от кеша или от базата
+	Ключът съдържа версията на потребителя, която се сменя при промяна на
+	ролята или активността му (invalidate_user_cache).
+	"""
+	from app.db.cache import get_user_cache_key
+	
+	cache = get_cache()
+	cache_key = await get_user_cache_key(cache, user_id)
+	data = await cache.get(cache_key)
+	if data is None:
+		async with AsyncSessionLocal() as db:
+			user = await crud.get_user_async(db, user_id)
+		if user is None:
+			return None
+		data = Principal.from_user(user).to_dict()
+		await cache.set(cache_key, data, expires=PRINCIPAL_CACHE_TTL)
+	return Principal.from_dict(data)
+
+async def get_request_user(request: Request) -> Optional[Principal]:
+	"""
+	Връща потребителя на заявката (None без валиден токен)
+	Зарежда се най-много веднъж на заявка и се пази в request.state.principal.
+	"""
+	if not hasattr(request.state, "principal"):
+		token_data = get_request_token(request)
+		request.state.principal = await load_principal(int(token_data.user_id)) if token_data else None
+	return request.state.principal
+
+async def require_principal(request: Request, roles: Optional[List[UserRole]] = None) -> Optional[JSONResponse]:
+	"""
+	Проверява достъпа до ръчно регистрираните Route-ове
+	
+	Args:
+		request: Заявката
+		roles: Позволените роли (None - всеки активен потребител)
+		
+	Returns:
+		None, ако достъпът е разрешен - потребителят е в request.state.principal,
+		иначе отговор с 401 или 403
+	"""
+	if get_request_token(request) is None:
+		return JSONResponse({"detail": "Not authenticated"}, status_code=401)
+	
+	principal = await get_request_user(request)
+	if principal is None:
+		return JSONResponse({"detail": "User not found"}, status_code=401)
+	if not principal.is_active:
+		return JSONResponse({"detail": "Inactive user"}, status_code=401)
+	
+	if roles is not None and principal.role not in roles:
+		if roles == [UserRole.ADMIN]:
+			return JSONResponse({"detail": "Not authorized - admin role required"}, status_code=403)
+		return JSONResponse({"detail": "Not authorized - moderator or admin role required"}, status_code=403)
+	return None
+
 # Свързваме с папките за статични файлове и шаблони
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
@@ -113,12 +241,20 @@ templates = Jinja2Templates(directory="app/templates")
 async def startup_event():
 	# Създаваме таблиците в базата данни, ако не съществуват
 	Base.metadata.create_all(bind=engine)
+	# create_all не променя съществуващи таблици - добавяме новите индекси отделно
+	apply_schema_updates(engine)
 	
 	# Инициализираме Redis кеша
 	cache = get_cache()
+	await cache.connect()
 	
-	# Стартираме Goodreads updater
-	goodreads_updater = init_goodreads_updater(lambda: SessionLocal())
+	# Read-your-writes прозорецът се споделя между worker-ите през Redis
+	read_your_writes.cache = cache
+	# Лимитът на заявките е общ за всички worker-и
+	rate_limiter.cache = cache
+	
+	# Стартираме Goodreads updater - след всеки цикъл рейтингите в кеша се обновяват
+	goodreads_updater = init_goodreads_updater(lambda: SessionLocal(), on_update=refresh_book_ratings_cache)
 	goodreads_updater.start()
 	
 	# Създаваме admin потребител, ако не съществува
@@ -145,12 +281,120 @@ async def startup_event():
 	# Затваряме сесията
 	db.close()
 	
+	# Подгряваме кеша във фонов режим - /health/ready чака да приключи
+	schedule_cache_warmup(delay=0)
+	
 	logger.info("Application startup complete")
 
 @app.on_event("shutdown")
 async def shutdown_event():
+	# Затваряме връзките на async енджина
+	await async_engine.dispose()
+	for replica in async_replica_engines:
+		await replica.dispose()
+	
+	# Затваряме връзките към Redis
+	await get_cache().close()
+	
 	logger.info("Application shutdown")
 
+# --- Подгряване на кеша ---
+
+# Брой най-гледани книги, чиито детайли се зареждат в кеша при подгряване
+WARMUP_TOP_BOOKS = int(os.getenv("CACHE_WARMUP_TOP_BOOKS", "50"))
+# Максимален брой книги в класацията по прегледи - останалите се изрязват
+BOOK_VIEWS_MAX_MEMBERS = int(os.getenv("CACHE_BOOK_VIEWS_MAX", "10000"))
+# Колко секунди след последната промяна в каталога се пуска подгряването
+WARMUP_DEBOUNCE_SECONDS = 5
+
+# False до края на първото подгряване - дотогава /health/ready връща 503
+app.state.cache_warm = False
+_warmup_task = None
+# Task-ът, който в момента е в warm_cache - него не прекъсваме
+_warmup_running = None
+
+async def warm_cache() -> None:
+	"""
+	Зарежда в кеша списъка с категории, началната страница и детайлите на
+	най-гледаните книги, за да не ги плащат първите посетители след deploy,
+	рестарт на Redis или промяна в каталога
+	"""
+	from app.db.cache import get_category_cache_key, get_book_cache_key, HOME_KEY, BOOK_VIEWS_KEY
+	
+	cache = get_cache()
+	started = time.monotonic()
+	try:
+		if cache.redis:
+			await cache.refresh(get_category_cache_key(), compute_categories, expires=3600, stale=300)
+			await cache.refresh(HOME_KEY, compute_home_page, expires=600, stale=60)
+			
+			book_ids = [int(book_id) for book_id in await cache.top_members(BOOK_VIEWS_KEY, WARMUP_TOP_BOOKS)]
+			for book_id in book_ids:
+				try:
+					await cache.refresh(
+						get_book_cache_key(book_id), lambda: compute_book_detail(book_id), expires=BOOK_DETAIL_TTL, stale=300
+					)
+				except HTTPException:
+					# Книгата е изтрита след последния преглед
+					continue
+			
+			logger.info(f"Cache warm-up finished in {time.monotonic() - started:.2f}s ({len(book_ids)} book details)")
+	except asyncio.CancelledError:
+		# Прекъснатото подгряване (напр. при спиране) не прави worker-а готов
+		raise
+	except Exception as e:
+		logger.error(f"Cache warm-up failed: {e}")
+	
+	# Готовността зависи от завършването, а не от успеха - иначе при
+	# проблем с Redis или базата worker-ът никога не би станал готов
+	app.state.cache_warm = True
+
+async def _delayed_warmup(delay: float, previous: Optional[asyncio.Task]) -> None:
+	global _warmup_running
+	# Task-ът може да е създаден от заявка - не наследяваме нейния контекст
+	detach_request_context()
+	# Не пускаме две подгрявания едновременно - изчакваме текущото
+	if previous is not None:
+		await asyncio.wait([previous])
+	await asyncio.sleep(delay)
+	
+	_warmup_running = asyncio.current_task()
+	try:
+		await warm_cache()
+	finally:
+		_warmup_running = None
+
+def schedule_cache_warmup(delay: float = WARMUP_DEBOUNCE_SECONDS) -> None:
+	"""
+	Пуска подгряване на кеша във фонов task след delay секунди
+	
+	Ново извикване преди старта отлага чакащото подгряване, така че поредица
+	от промени в каталога води до едно подгряване. Вече започнало подгряване
+	не се прекъсва - новото се пуска delay секунди след него.
+	"""
+	global _warmup_task
+	if _warmup_task is not None and not _warmup_task.done() and _warmup_task is not _warmup_running:
+		_warmup_task.cancel()
+	
+	previous = _warmup_running if _warmup_running is not None and not _warmup_running.done() else None
+	_warmup_task = asyncio.ensure_future(_delayed_warmup(delay, previous))
+
+async def refresh_book_ratings_cache(book_ids: List[int]) -> None:
+	"""
+	Инвалидира кешираните карти, детайли и списъци на книгите с нов рейтинг
+	от Goodreads и пуска подгряване - иначе то би прочело старите стойности
+	"""
+	from app.db.cache import invalidate_book_ratings
+	await invalidate_book_ratings(get_cache(), book_ids)
+	schedule_cache_warmup()
+
+@app.get("/health/ready")
+async def readiness():
+	"""Readiness проба - 503, докато не завърши първото подгряване на кеша"""
+	if not app.state.cache_warm:
+		return JSONResponse({"status": "warming up"}, status_code=503)
+	return {"status": "ready"}
+
 # Обработка на грешки
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
@@ -222,7 +466,7 @@ async def register_user(
 ):
 	"""Регистрация на нов потребител"""
 	# Проверяваме дали потребителското име е заето
-	db_user = crud.get_user_by_username(db, username)
+	db_user = await run_in_threadpool(crud.get_user_by_username, db, username)
 	if db_user:
 		raise HTTPException(
 			status_code=status.HTTP_400_BAD_REQUEST,
@@ -230,7 +474,7 @@ async def register_user(
 		)
 	
 	# Проверяваме дали email адресът е зает
-	db_user = crud.get_user_by_email(db, email)
+	db_user = await run_in_threadpool(crud.get_user_by_email, db, email)
 	if db_user:
 		raise HTTPException(
 			status_code=status.HTTP_400_BAD_REQUEST,
@@ -245,8 +489,9 @@ async def register_user(
 			detail="Password is too weak. It must be at least 8 characters long and contain uppercase, lowercase, digits and special characters."
 		)
 	
-	# Създаваме потребителя
-	user = crud.create_user(db, email, username, password, phone, full_name)
+	# Създаваме потребителя - хеширането на паролата (bcrypt) и заявките към
+	# базата са блокиращи, затова се изпълняват в thread pool-а
+	user = await run_in_threadpool(crud.create_user, db, email, username, password, phone, full_name)
 	
 	# Връщаме данните без паролата
 	return {
@@ -260,15 +505,13 @@ async def register_user(
 @app.get("/api/users/me")  # Без response_model
 async def read_users_me(
 	token: str = Depends(oauth2_scheme), 
-	db: Session = Depends(get_db)
+	db: AsyncSession = Depends(get_async_db)
 ):
 	"""Връща информация за текущия потребител"""
 	# Имплементирайте логиката директно тук, без да разчитате на get_current_user
 	token_data = decode_token(token)
 	
-	from app.crud import get_user
-	
-	user = get_user(db, int(token_data.user_id))
+	user = await crud.get_user_async(db, int(token_data.user_id))
 	if user is None:
 		raise HTTPException(
 			status_code=status.HTTP_401_UNAUTHORIZED,
@@ -303,6 +546,8 @@ async def update_user_role(
 	db = SessionLocal()
 	try:
 		user = crud.update_user_role(db, user_id, role)
+		from app.db.cache import invalidate_user_cache
+		await invalidate_user_cache(get_cache(), user_id)
 		return {
 			"id": user.id,
 			"username": user.username,
@@ -323,6 +568,8 @@ async def activate_user(
 ):
 	"""Активира или деактивира потребител (само за admin)"""
 	user = crud.update_user(db, user_id, {"is_active": is_active})
+	from app.db.cache import invalidate_user_cache
+	await invalidate_user_cache(get_cache(), user_id)
 	return {
 		"id": user.id,
 		"username": user.username,
@@ -333,76 +580,261 @@ async def activate_user(
 
 # --- Книги ---
 
+def make_etag(*parts) -> str:
+	"""Силен ETag от частите, които определят версията на отговора"""
+	return '"' + hashlib.sha1(":".join(str(part) for part in parts).encode()).hexdigest() + '"'
+
+def etag_matches(request: Request, etag: Optional[str]) -> bool:
+	"""Проверява дали If-None-Match на заявката съдържа etag (сравнението е слабо, според RFC 9110)"""
+	header = request.headers.get("If-None-Match")
+	if not etag or not header:
+		return False
+	tags = [tag.strip() for tag in header.split(",")]
+	return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def conditional_json(request: Request, etag: Optional[str], payload=None, headers: Dict[str, str] = None) -> Response:
+	"""
+	Връща 304 Not Modified, ако клиентът вече има тази версия, иначе JSON с ETag
+	
+	Args:
+		etag: ETag на текущата версия (None - без условни отговори)
+		payload: Тялото на отговора - не е нужно при 304
+		headers: Допълнителни header-и към отговора
+	"""
+	headers = dict(headers or {})
+	if etag:
+		headers.update({"ETag": etag, "Cache-Control": "no-cache"})
+	if etag_matches(request, etag):
+		return Response(status_code=304, headers=headers)
+	return JSONResponse(payload, headers=headers)
+
+# Колко секунди се пазят картите и детайлите на книгите в кеша - записите с
+# цена изтичат по-рано, ако междувременно започва или свършва промоция
+BOOK_CARD_TTL = 6 * 3600
+BOOK_DETAIL_TTL = 6 * 3600
+# Полета, чиято промяна засяга само картата на книгата, а не списъците с ID-та
+BOOK_CARD_ONLY_FIELDS = {"price", "stock_count"}
+
+def price_valid_until(book, now: datetime) -> Optional[float]:
+	"""
+	Връща кога (unix време) се сменя цената на книгата - следващото начало или
+	край на нейна промоция. None, ако няма предстоящи промени.
+	Изисква заредени book.promotions.
+	"""
+	# Промоцията е активна до end_date включително
+	boundaries = [
+		boundary
+		for promotion in book.promotions
+		for boundary in (promotion.start_date, promotion.end_date + timedelta(seconds=1))
+		if boundary > now
+	]
+	if not boundaries:
+		return None
+	return min(boundaries).replace(tzinfo=timezone.utc).timestamp()
+
+def books_valid_until(books, now: datetime) -> Optional[float]:
+	"""Най-ранната смяна на цена (unix време) сред книгите или None"""
+	deadlines = [until for until in (price_valid_until(book, now) for book in books) if until is not None]
+	return min(deadlines, default=None)
+
+def cards_valid_until(cards: List[dict]) -> Optional[float]:
+	"""
+	Кога изтича първата от показаните в картите промоции (unix време) или None
+	Картите не съдържат бъдещите промоции - тяхното начало покрива TTL-ът.
+	"""
+	ends = [
+		datetime.fromisoformat(card["promotion"]["end_date"]) + timedelta(seconds=1)
+		for card in cards if card.get("promotion")
+	]
+	if not ends:
+		return None
+	return min(ends).replace(tzinfo=timezone.utc).timestamp()
+
+def book_card(book) -> dict:
+	"""Форматира книга за списъците (картата, която се кешира за всяка книга)"""
+	# Проверяваме за активни промоции
+	promo = None
+	now = datetime.utcnow()
+	for promotion in book.promotions:
+		if promotion.start_date <= now <= promotion.end_date:
+			if promo is None or promotion.discount_percentage > promo.discount_percentage:
+				promo = promotion
+	
+	card = {
+		"id": book.id,
+		"title": book.title,
+		"isbn": book.isbn,
+		"publisher": book.publisher,
+		"price": book.price,
+		"in_stock": book.stock_count > 0,
+		"stock_count": book.stock_count,
+		"categories": [{"id": cat.id, "name": cat.name} for cat in book.categories],
+		"goodreads_rating": book.goodreads_rating,
+		"avg_rating": book.avg_rating,
+		"review_count": book.review_count
+	}
+	
+	if promo:
+		card["promotion"] = {
+			"discount_percentage": promo.discount_percentage,
+			"end_date": promo.end_date.isoformat()
+		}
+		card["discounted_price"] = book.price * (1 - promo.discount_percentage / 100)
+	
+	return card
+
+async def cache_book_cards(cache: RedisCache, books) -> Dict[int, dict]:
+	"""
+	Форматира и кешира картите на книгите с една pipeline заявка
+	Всяка карта изтича най-късно при следващата промяна на цената й.
+	
+	Returns:
+		Речник {book_id: карта}
+	"""
+	from app.db.cache import get_book_card_cache_key, capped_ttl
+	
+	now = datetime.utcnow()
+	cards = {}
+	ttls = {}
+	for book in books:
+		key = get_book_card_cache_key(book.id)
+		cards[book.id] = book_card(book)
+		ttls[key] = capped_ttl(BOOK_CARD_TTL, price_valid_until(book, now))
+	await cache.set_many(
+		{get_book_card_cache_key(book_id): card for book_id, card in cards.items()},
+		expires=BOOK_CARD_TTL,
+		ttls=ttls
+	)
+	return cards
+
+async def get_book_cards(cache: RedisCache, book_ids: List[int], known: Dict[int, dict] = None) -> List[dict]:
+	"""
+	Връща картите на книгите в реда на book_ids
+	
+	Липсващите в known се взимат от кеша с една MGET заявка, а останалите -
+	с една заявка към базата, след което се кешират.
+	Изтритите междувременно книги се пропускат.
+	"""
+	from app.db.cache import get_book_card_cache_key
+	
+	cards = dict(known or {})
+	missing = [book_id for book_id in book_ids if book_id not in cards]
+	if missing:
+		cached = await cache.get_many([get_book_card_cache_key(book_id) for book_id in missing])
+		cards.update({book_id: card for book_id, card in zip(missing, cached) if card is not None})
+		missing = [book_id for book_id in missing if book_id not in cards]
+	
+	if missing:
+		async with AsyncSessionLocal() as db:
+			books = await crud.get_books_by_ids_async(db, missing)
+		cards.update(await cache_book_cards(cache, books))
+	
+	return [cards[book_id] for book_id in book_ids if book_id in cards]
+
+# Брой книги във всеки раздел на началната страница
+HOME_SECTION_SIZE = 6
+
+async def compute_home_page() -> dict:
+	"""
+	Зарежда ID-тата на бестселърите и новите книги за началната страница
+	Картите им се кешират отделно, така че промяна в цена или наличност
+	не изисква преизчисляване на страницата.
+	"""
+	async with AsyncSessionLocal() as db:
+		bestsellers = await crud.get_bestsellers_async(db, HOME_SECTION_SIZE)
+		new_books = await crud.get_new_books_async(db, HOME_SECTION_SIZE)
+	
+	await cache_book_cards(get_cache(), [*bestsellers, *new_books])
+	return {
+		"bestsellers": [book.id for book in bestsellers],
+		"new_books": [book.id for book in new_books]
+	}
+
 @app.get("/api/books")
 async def list_books(
+	request: Request,
 	skip: int = 0,
 	limit: int = 100,
 	search: str = None,
 	category_id: int = None,
 	in_stock: bool = None,
-	db: Session = Depends(get_db),
+	sort_by: str = crud.RELEVANCE_SORT,
+	sort_desc: bool = False,
+	cursor: str = None,
 	cache: RedisCache = Depends(get_cache)
 ):
-	"""Връща списък с книги"""
-	# Проверяваме дали резултатът е в кеша
-	from app.db.cache import get_book_search_cache_key
+	"""
+	Връща една страница от списъка с книги
 	
-	cache_key = get_book_search_cache_key(
+	При search книгите по подразбиране са подредени по релевантност (ts_rank),
+	а без search - по заглавие.
+	Тялото е масив с картите на книгите, както преди курсорите. Курсорът за
+	следващата страница е в header-а X-Next-Cursor и в Link (rel="next") -
+	подава се като cursor. На последната страница ги няма.
+	skip се поддържа за съвместимост, но дълбоките OFFSET страници са бавни.
+	ETag-ът се сменя с поколенията на търсенето и на картите на книгите и при
+	началото или края на промоция за някоя от книгите в страницата.
+	"""
+	from app.db.cache import get_book_search_cache_key, CARDS_GENERATION
+	
+	# Кешира се само подреденият списък с ID-та - картите на книгите се пазят
+	# поотделно, така че промяна в цената или наличността сменя една карта
+	sort_by = crud.resolve_book_sort(sort_by, search)
+	cache_key = await get_book_search_cache_key(
+		cache,
 		query=search or "",
 		category_id=category_id,
-		in_stock=in_stock
-	)
-	
-	# Проверяваме кеша
-	cached_result = cache.get(cache_key)
-	if cached_result:
-		return cached_result
-	
-	# Извличаме книги от базата данни
-	books = crud.get_books(
-		db,
-		skip=skip,
+		in_stock=in_stock,
+		sort_by=sort_by,
+		sort_desc=sort_desc,
 		limit=limit,
-		search=search,
-		category_id=category_id,
-		in_stock=in_stock
+		cursor=cursor,
+		skip=0 if cursor else skip
 	)
 	
-	# Форматираме резултатите
-	result = []
-	for book in books:
-		# Проверяваме за активни промоции
-		promo = None
-		for promotion in book.promotions:
-			now = datetime.utcnow()
-			if promotion.start_date <= now <= promotion.end_date:
-				if promo is None or promotion.discount_percentage > promo.discount_percentage:
-					promo = promotion
-		
-		book_data = {
-			"id": book.id,
-			"title": book.title,
-			"publisher": book.publisher,
-			"price": book.price,
-			"in_stock": book.stock_count > 0,
-			"stock_count": book.stock_count,
-			"categories": [{"id": cat.id, "name": cat.name} for cat in book.categories],
-			"goodreads_rating": book.goodreads_rating
-		}
-		
-		if promo:
-			book_data["promotion"] = {
-				"discount_percentage": promo.discount_percentage,
-				"end_date": promo.end_date.isoformat()
-			}
-			book_data["discounted_price"] = book.price * (1 - promo.discount_percentage / 100)
+	# Картите, заредени от базата при преизчисляване на списъка в тази заявка
+	fresh_cards = {}
+	
+	async def compute():
+		# Може да се изпълни и след края на заявката, затова отваряме собствена сесия
+		async with AsyncSessionLocal() as db:
+			# Извличаме книги от базата данни
+			books, next_cursor = await crud.get_books_page_async(
+				db,
+				limit=limit,
+				cursor=cursor,
+				sort_by=sort_by,
+				sort_desc=sort_desc,
+				skip=skip,
+				search=search,
+				category_id=category_id,
+				in_stock=in_stock
+			)
 		
-		result.append(book_data)
+		cards = await cache_book_cards(cache, books)
+		fresh_cards.update(cards)
+		# Списъкът изтича с първата промяна на цена в страницата, за да се смени ETag-ът
+		now = datetime.utcnow()
+		boundaries = [until for until in (price_valid_until(book, now) for book in books) if until is not None]
+		until = min(boundaries) if boundaries else None
+		return Expiring({"ids": list(cards), "next_cursor": next_cursor, "until": until}, until)
 	
-	# Кешираме резултата за 10 минути
-	cache.set(cache_key, result, expires=600)
+	# Кешираме списъка за 10 минути (+1 минута, в която се връща старият,
+	# докато една заявка го преизчислява)
+	page = await cache.get_or_compute(cache_key, compute, expires=600, stale=60)
 	
-	return result
+	# Без Redis поколенията винаги са 0 и не могат да служат за версия
+	etag = None
+	if cache.redis:
+		etag = make_etag(cache_key, await cache.get_generation(CARDS_GENERATION), page.get("until"))
+	headers = {}
+	if page["next_cursor"]:
+		next_url = request.url.include_query_params(cursor=page["next_cursor"])
+		headers = {"X-Next-Cursor": page["next_cursor"], "Link": f'<{next_url}>; rel="next"'}
+	if etag_matches(request, etag):
+		return conditional_json(request, etag, headers=headers)
+	
+	return conditional_json(request, etag, await get_book_cards(cache, page["ids"], fresh_cards), headers)
 
 def date_filter(date_str):
     if isinstance(date_str, str):
@@ -419,23 +851,57 @@ def date_filter(date_str):
 templates = Jinja2Templates(directory="app/templates")
 templates.env.filters["date"] = date_filter
 
-@app.get("/api/books/{book_id}")
-async def get_book_detail(
-	book_id: int,
-	db: Session = Depends(get_db),
+# Минимална дължина на текста, за който се връщат предложения
+SUGGEST_MIN_LENGTH = 2
+
+# Трябва да е преди /api/books/{book_id}, иначе "suggest" се приема за ID
+@app.get("/api/books/suggest")
+async def suggest_books(
+	q: str,
+	limit: int = 10,
+	db: AsyncSession = Depends(get_async_db),
 	cache: RedisCache = Depends(get_cache)
 ):
-	"""Връща детайли за книга"""
-	# Проверяваме кеша
-	from app.db.cache import get_book_cache_key
-	cache_key = get_book_cache_key(book_id)
-	cached_result = cache.get(cache_key)
+	"""Връща заглавия, подходящи за въведения текст - толерантно към правописни грешки"""
+	from app.db.cache import get_book_suggest_cache_key
 	
-	if cached_result:
+	# Нормализираме текста, за да споделят кеша "Войн", "войн " и т.н.
+	prefix = " ".join(q.lower().split())
+	limit = max(1, min(limit, 20))
+	if len(prefix) < SUGGEST_MIN_LENGTH:
+		return []
+	
+	# Често търсените начала на заглавия се обслужват изцяло от кеша
+	cache_key = await get_book_suggest_cache_key(cache, prefix, limit)
+	cached_result = await cache.get(cache_key)
+	if cached_result is not None:
 		return cached_result
 	
-	# Взимаме книгата и активната промоция, ако има такава
-	book, active_promotion = crud.get_book_with_promotions(db, book_id)
+	rows = await crud.suggest_books_async(db, prefix, limit)
+	result = [
+		{"id": row.id, "title": row.title, "original_title": row.original_title}
+		for row in rows
+	]
+	
+	# Кешираме резултата за 5 минути
+	await cache.set(cache_key, result, expires=300)
+	
+	return result
+
+# Брой отзиви, които се връщат заедно с детайлите на книгата
+DETAIL_REVIEWS_LIMIT = 10
+
+async def compute_book_detail(book_id: int) -> Expiring:
+	"""
+	Зарежда детайлите на книга за кеша (get_book_detail и подгряването)
+	Отваря собствена сесия, защото може да се изпълни и след края на заявката.
+	Записът изтича най-късно при следващото начало или край на промоция.
+	"""
+	async with AsyncSessionLocal() as db:
+		# Взимаме книгата и активната промоция, ако има такава
+		book, active_promotion = await crud.get_book_with_promotions_async(db, book_id)
+		# Само последните отзиви - останалите са в /api/books/{book_id}/reviews
+		reviews = await crud.get_latest_book_reviews_async(db, book_id, DETAIL_REVIEWS_LIMIT)
 	
 	# Форматираме резултата
 	result = {
@@ -457,6 +923,9 @@ async def get_book_detail(
 		"categories": [{"id": cat.id, "name": cat.name} for cat in book.categories],
 		"goodreads_id": book.goodreads_id,
 		"goodreads_rating": book.goodreads_rating,
+		"review_count": book.review_count,
+		"avg_rating": book.avg_rating,
+		"updated_at": book.updated_at.isoformat() if book.updated_at else None,
 		"reviews": [
 			{
 				"id": review.id,
@@ -464,10 +933,10 @@ async def get_book_detail(
 				"comment": review.comment,
 				"user": review.user.username,
 				"created_at": review.created_at.isoformat()
-			} for review in book.reviews
+			} for review in reviews
 		]
 	}
-	
+
 	if active_promotion:
 		result["promotion"] = {
 			"id": active_promotion.id,
@@ -477,11 +946,40 @@ async def get_book_detail(
 			"description": active_promotion.description
 		}
 		result["discounted_price"] = book.price * (1 - active_promotion.discount_percentage / 100)
+
+	return Expiring(result, price_valid_until(book, datetime.utcnow()))
+
+@app.get("/api/books/{book_id}")
+async def get_book_detail(
+	book_id: int,
+	request: Request,
+	cache: RedisCache = Depends(get_cache)
+):
+	"""
+	Връща детайли за книга
 	
-	# Кешираме резултата за 1 час
-	cache.set(cache_key, result, expires=3600)
+	ETag-ът се определя от updated_at на книгата и прозореца на активната
+	промоция - при съвпадение с If-None-Match се връща 304 без тяло.
+	"""
+	from app.db.cache import get_book_cache_key, BOOK_VIEWS_KEY
 	
-	return result
+	# Кешираме резултата за 6 часа (или до промяна на промоцията) - при
+	# изтичане само една заявка го преизчислява, а останалите получават
+	# стария още до 5 минути
+	result = await cache.get_or_compute(
+		get_book_cache_key(book_id), lambda: compute_book_detail(book_id), expires=BOOK_DETAIL_TTL, stale=300
+	)
+	
+	# Броим прегледите едва след като книгата е намерена - най-гледаните
+	# книги се подгряват в кеша
+	await cache.increment_score(BOOK_VIEWS_KEY, book_id, max_members=BOOK_VIEWS_MAX_MEMBERS)
+	
+	promotion = result.get("promotion") or {}
+	etag = make_etag(
+		book_id, result.get("updated_at"),
+		promotion.get("id"), promotion.get("start_date"), promotion.get("end_date")
+	)
+	return conditional_json(request, etag, result)
 
 def get_db_session(): # аа избягване на fastapi.exceptions.FastAPIError: Invalid args for response field! по-долу
 	db = SessionLocal()
@@ -512,31 +1010,14 @@ async def create_book_endpoint(request: Request):
     category_ids = [int(id) for id in form_data.getlist("category_ids")] if "category_ids" in form_data else []
     
     # Проверка на аутентикацията/роля (имитираме Depends(check_moderator))
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse(
-            {"detail": "Not authenticated"}, 
-            status_code=401
-        )
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
-    token = auth_header.split(" ")[1]
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            # Проверяваме дали е модератор/админ
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized"}, 
-                    status_code=403
-                )
-            
             # Проверяваме за съществуваща книга с този ISBN
             existing_book = crud.get_book_by_isbn(db, isbn)
             if existing_book:
@@ -574,7 +1055,9 @@ async def create_book_endpoint(request: Request):
             # Инвалидираме кеша
             cache = get_cache()
             from app.db.cache import invalidate_book_cache
-            invalidate_book_cache(cache, book.id)
+            await invalidate_book_cache(cache, book.id)
+            # Каталогът се промени - подгряваме кеша отново
+            schedule_cache_warmup()
             
             # Добавяме background task за Goodreads
             if "background_tasks" in request.scope:
@@ -615,9 +1098,10 @@ async def update_book(
 	# Обновяваме книгата
 	updated_book = crud.update_book(db, book_id, update_data)
 	
-	# Инвалидираме кеша
+	# Инвалидираме кеша - промяна само в цената или наличността сменя
+	# картата на книгата, без да изтрива кешираните търсения
 	from app.db.cache import invalidate_book_cache
-	invalidate_book_cache(cache, book_id)
+	await invalidate_book_cache(cache, book_id, search=not set(update_data) <= BOOK_CARD_ONLY_FIELDS)
 	
 	# Връщаме обновената книга
 	return {
@@ -633,38 +1117,23 @@ async def delete_book(request: Request):
     book_id = int(request.path_params["book_id"])
     
     # Автентикация (имитираме Depends(check_admin))
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse(
-            {"detail": "Not authenticated"}, 
-            status_code=401
-        )
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя и проверяваме дали е админ
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role != UserRole.ADMIN:
-                return JSONResponse(
-                    {"detail": "Not authorized - admin role required"}, 
-                    status_code=403
-                )
-            
             # Изтриваме книгата
             crud.delete_book(db, book_id)
             
             # Инвалидираме кеша
             cache = get_cache()
             from app.db.cache import invalidate_book_cache
-            invalidate_book_cache(cache, book_id)
+            await invalidate_book_cache(cache, book_id)
+            # Каталогът се промени - подгряваме кеша отново
+            schedule_cache_warmup()
             
             # Връщаме успешен отговор
             return JSONResponse({"message": "Book deleted successfully"})
@@ -688,38 +1157,21 @@ async def update_book_from_goodreads(request: Request):
     book_id = int(request.path_params["book_id"])
     
     # Проверка на аутентикацията (имитираме Depends(check_moderator))
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse(
-            {"detail": "Not authenticated"}, 
-            status_code=401
-        )
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя и проверяваме дали е модератор/админ
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
             # Обновяваме информацията от Goodreads
             result = await manual_update_book(db, book_id)
             
             # Инвалидираме кеша
             cache = get_cache()
             from app.db.cache import invalidate_book_cache
-            invalidate_book_cache(cache, book_id)
+            await invalidate_book_cache(cache, book_id)
             
             # Връщаме резултата
             return JSONResponse(result)
@@ -741,22 +1193,12 @@ app.routes.append(
 
 # --- Категории ---
 
-@app.get("/api/categories")
-async def list_categories(
-	db: Session = Depends(get_db),
-	cache: RedisCache = Depends(get_cache)
-):
-	"""Връща списък с всички категории"""
-	# Проверяваме кеша
-	from app.db.cache import get_category_cache_key
-	cache_key = get_category_cache_key()
-	cached_result = cache.get(cache_key)
-	
-	if cached_result:
-		return cached_result
-	
-	# Взимаме категориите от базата данни
-	categories = crud.get_categories(db)
+async def compute_categories() -> list:
+	"""Зарежда списъка с категории за кеша (list_categories и подгряването)"""
+	async with AsyncSessionLocal() as db:
+		# Взимаме категориите от базата данни
+		categories = await crud.get_categories_async(db)
+		book_counts = await crud.get_category_book_counts_async(db)
 	
 	# Форматираме резултата
 	result = []
@@ -769,14 +1211,28 @@ async def list_categories(
 			"name": category.name,
 			"description": category.description,
 			"subcategory_ids": subcategory_ids,
-			"book_count": len(category.books)
+			"book_count": book_counts.get(category.id, 0)
 		})
 	
-	# Кешираме резултата за 1 час
-	cache.set(cache_key, result, expires=3600)
-	
 	return result
 
+@app.get("/api/categories")
+async def list_categories(
+	request: Request,
+	cache: RedisCache = Depends(get_cache)
+):
+	"""Връща списък с всички категории - ETag-ът се сменя с поколението на каталога"""
+	from app.db.cache import get_category_cache_key, CATALOG_GENERATION
+	
+	# Без Redis поколението винаги е 0 и не може да служи за версия
+	etag = make_etag("categories", await cache.get_generation(CATALOG_GENERATION)) if cache.redis else None
+	if etag_matches(request, etag):
+		return conditional_json(request, etag)
+	
+	# Кешираме резултата за 1 час (+5 минути stale-while-revalidate)
+	result = await cache.get_or_compute(get_category_cache_key(), compute_categories, expires=3600, stale=300)
+	return conditional_json(request, etag, result)
+
 async def create_category_endpoint(request: Request):
     # Извличаме form data
     form_data = await request.form()
@@ -785,28 +1241,14 @@ async def create_category_endpoint(request: Request):
     parent_id = int(form_data.get("parent_id")) if form_data.get("parent_id") else None
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя и проверяваме дали е модератор/админ
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
             # Проверяваме дали категорията съществува
             existing_category = crud.get_category_by_name(db, name)
             if existing_category:
@@ -825,7 +1267,9 @@ async def create_category_endpoint(request: Request):
             # Инвалидираме кеша
             cache = get_cache()
             from app.db.cache import invalidate_category_cache
-            invalidate_category_cache(cache, category.id)
+            await invalidate_category_cache(cache, category.id)
+            # Каталогът се промени - подгряваме кеша отново
+            schedule_cache_warmup()
             
             return JSONResponse({
                 "id": category.id,
@@ -850,28 +1294,14 @@ async def update_category_endpoint(request: Request):
     description = form_data.get("description")
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя и проверяваме дали е модератор/админ
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
             # Подготвяме данните за обновяване
             update_data = {}
             if name is not None:
@@ -885,7 +1315,9 @@ async def update_category_endpoint(request: Request):
             # Инвалидираме кеша
             cache = get_cache()
             from app.db.cache import invalidate_category_cache
-            invalidate_category_cache(cache, category_id)
+            await invalidate_category_cache(cache, category_id)
+            # Каталогът се промени - подгряваме кеша отново
+            schedule_cache_warmup()
             
             return JSONResponse({
                 "id": category.id,
@@ -906,36 +1338,24 @@ async def add_subcategory_endpoint(request: Request):
     child_id = int(request.path_params["child_id"])
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя и проверяваме дали е модератор/админ
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
             # Добавяме подкатегорията
             category = crud.add_subcategory(db, parent_id, child_id)
             
             # Инвалидираме кеша
             cache = get_cache()
             from app.db.cache import invalidate_category_cache
-            invalidate_category_cache(cache, parent_id)
-            invalidate_category_cache(cache, child_id)
+            await invalidate_category_cache(cache, parent_id)
+            await invalidate_category_cache(cache, child_id)
+            # Каталогът се промени - подгряваме кеша отново
+            schedule_cache_warmup()
             
             return JSONResponse({
                 "parent_id": parent_id,
@@ -966,32 +1386,20 @@ async def create_review_endpoint(request: Request):
     comment = form_data.get("comment")
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request)
+    if denied:
+        return denied
+    current_user = request.state.principal
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
-        
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if not current_user:
-                return JSONResponse({"detail": "User not found"}, status_code=404)
-            
+        async with AsyncSessionLocal() as db:
             # Създаваме отзива
-            review = crud.create_review(db, current_user.id, book_id, rating, comment)
+            review = await crud.create_review_async(db, current_user.id, book_id, rating, comment)
             
-            # Инвалидираме кеша
+            # Инвалидираме кеша - отзивът променя само картата на книгата
             cache = get_cache()
             from app.db.cache import invalidate_book_cache
-            invalidate_book_cache(cache, book_id)
+            await invalidate_book_cache(cache, book_id, search=False)
             
             return JSONResponse({
                 "id": review.id,
@@ -1000,9 +1408,6 @@ async def create_review_endpoint(request: Request):
                 "message": "Review created successfully"
             })
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1016,11 +1421,9 @@ async def get_book_reviews_endpoint(request: Request):
     limit = int(request.query_params.get("limit", 100))
     
     try:
-        db = SessionLocal()
-        
-        try:
+        async with AsyncSessionLocal() as db:
             # Взимаме отзивите
-            reviews = crud.get_book_reviews(db, book_id, skip, limit)
+            reviews = await crud.get_book_reviews_async(db, book_id, skip, limit)
             
             # Форматираме резултата
             result = [{
@@ -1035,9 +1438,6 @@ async def get_book_reviews_endpoint(request: Request):
             
             return JSONResponse(result)
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1057,27 +1457,15 @@ async def create_order_endpoint(request: Request):
     full_name = form_data.get("full_name")
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request)
+    if denied:
+        return denied
+    current_user = request.state.principal
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
-        
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if not current_user:
-                return JSONResponse({"detail": "User not found"}, status_code=404)
-            
+        async with AsyncSessionLocal() as db:
             # Създаваме поръчката
-            order = crud.create_order(
+            order = await crud.create_order_async(
                 db,
                 user_id=current_user.id,
                 items=items,
@@ -1085,6 +1473,12 @@ async def create_order_endpoint(request: Request):
                 phone=phone
             )
             
+            # Наличността на поръчаните книги се промени, а потребителят може
+            # да е станал VIP
+            from app.db.cache import invalidate_book_cards, invalidate_user_cache
+            await invalidate_book_cards(get_cache(), [item["book_id"] for item in items])
+            await invalidate_user_cache(get_cache(), current_user.id)
+            
             return JSONResponse({
                 "id": order.id,
                 "total_price": order.total_price,
@@ -1092,9 +1486,6 @@ async def create_order_endpoint(request: Request):
                 "message": "Order created successfully"
             })
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1109,14 +1500,12 @@ async def create_guest_order_endpoint(request: Request):
     full_name = form_data.get("full_name")
     
     try:
-        db = SessionLocal()
-        
-        try:
+        async with AsyncSessionLocal() as db:
             # Създаваме временен потребител
-            temp_user = crud.create_temp_user(db, email, phone, full_name)
+            temp_user = await crud.create_temp_user_async(db, email, phone, full_name)
             
             # Създаваме поръчката
-            order = crud.create_order(
+            order = await crud.create_order_async(
                 db,
                 temp_user_id=temp_user.id,
                 items=items,
@@ -1124,6 +1513,10 @@ async def create_guest_order_endpoint(request: Request):
                 phone=phone
             )
             
+            # Наличността на поръчаните книги се промени
+            from app.db.cache import invalidate_book_cards
+            await invalidate_book_cards(get_cache(), [item["book_id"] for item in items])
+            
             return JSONResponse({
                 "id": order.id,
                 "total_price": order.total_price,
@@ -1132,36 +1525,21 @@ async def create_guest_order_endpoint(request: Request):
                 "order_reference": f"GU-{order.id}"
             })
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
 # 3. Получаване на поръчки на потребител
 async def get_user_orders_endpoint(request: Request):
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request)
+    if denied:
+        return denied
+    current_user = request.state.principal
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
-        
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if not current_user:
-                return JSONResponse({"detail": "User not found"}, status_code=404)
-            
+        async with AsyncSessionLocal() as db:
             # Взимаме поръчките
-            orders = crud.get_user_orders(db, current_user.id)
+            orders = await crud.get_user_orders_async(db, current_user.id)
             
             # Форматираме резултата
             result = [{
@@ -1175,9 +1553,6 @@ async def get_user_orders_endpoint(request: Request):
             
             return JSONResponse(result)
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1187,27 +1562,15 @@ async def get_order_details_endpoint(request: Request):
     order_id = int(request.path_params["order_id"])
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request)
+    if denied:
+        return denied
+    current_user = request.state.principal
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
-        
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if not current_user:
-                return JSONResponse({"detail": "User not found"}, status_code=404)
-            
+        async with AsyncSessionLocal() as db:
             # Взимаме поръчката
-            order = crud.get_order(db, order_id)
+            order = await crud.get_order_async(db, order_id)
             
             # Проверяваме дали поръчката съществува
             if not order:
@@ -1244,9 +1607,6 @@ async def get_order_details_endpoint(request: Request):
             
             return JSONResponse(result)
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1260,28 +1620,14 @@ async def update_order_status_endpoint(request: Request):
     status = form_data.get("status")
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
             # Конвертираме статуса към enum
             order_status = OrderStatus(status)
             
@@ -1306,27 +1652,15 @@ async def cancel_order_endpoint(request: Request):
     order_id = int(request.path_params["order_id"])
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request)
+    if denied:
+        return denied
+    current_user = request.state.principal
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
-        
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if not current_user:
-                return JSONResponse({"detail": "User not found"}, status_code=404)
-            
+        async with AsyncSessionLocal() as db:
             # Взимаме поръчката
-            order = crud.get_order(db, order_id)
+            order = await crud.get_order_async(db, order_id)
             
             # Проверяваме дали поръчката съществува
             if not order:
@@ -1341,8 +1675,14 @@ async def cancel_order_endpoint(request: Request):
                     status_code=403
                 )
             
-            # Отказваме поръчката
-            cancelled_order = crud.cancel_order(db, order_id)
+            # Отказваме поръчката - артикулите се взимат преди това, защото
+            # след commit релациите не могат да се заредят в async сесия
+            book_ids = [item.book_id for item in order.items]
+            cancelled_order = await crud.cancel_order_async(db, order_id)
+            
+            # Наличността на книгите в поръчката се възстанови
+            from app.db.cache import invalidate_book_cards
+            await invalidate_book_cards(get_cache(), book_ids)
             
             return JSONResponse({
                 "id": cancelled_order.id,
@@ -1350,9 +1690,6 @@ async def cancel_order_endpoint(request: Request):
                 "message": "Order cancelled successfully"
             })
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1378,28 +1715,15 @@ async def create_promotion_endpoint(request: Request):
     description = form_data.get("description")
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
+    current_user = request.state.principal
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
         db = SessionLocal()
         
         try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
             # Създаваме промоцията
             promotion = crud.create_promotion(
                 db,
@@ -1411,10 +1735,10 @@ async def create_promotion_endpoint(request: Request):
                 created_by=current_user.id
             )
             
-            # Инвалидираме кеша
+            # Инвалидираме кеша - промоцията променя само цената в картата на книгата
             cache = get_cache()
             from app.db.cache import invalidate_book_cache
-            invalidate_book_cache(cache, book_id)
+            await invalidate_book_cache(cache, book_id, search=False)
             
             return JSONResponse({
                 "id": promotion.id,
@@ -1434,11 +1758,9 @@ async def create_promotion_endpoint(request: Request):
 # 2. Получаване на активни промоции
 async def get_active_promotions_endpoint(request: Request):
     try:
-        db = SessionLocal()
-        
-        try:
+        async with AsyncSessionLocal() as db:
             # Взимаме активните промоции
-            promotions = crud.get_active_promotions(db)
+            promotions = await crud.get_active_promotions_async(db)
             
             # Форматираме резултата
             result = [{
@@ -1455,9 +1777,6 @@ async def get_active_promotions_endpoint(request: Request):
             
             return JSONResponse(result)
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1467,11 +1786,9 @@ async def get_book_promotions_endpoint(request: Request):
     book_id = int(request.path_params["book_id"])
     
     try:
-        db = SessionLocal()
-        
-        try:
+        async with AsyncSessionLocal() as db:
             # Взимаме промоциите за книгата
-            promotions = crud.get_book_promotions(db, book_id)
+            promotions = await crud.get_book_promotions_async(db, book_id)
             
             # Форматираме резултата
             result = [{
@@ -1489,9 +1806,6 @@ async def get_book_promotions_endpoint(request: Request):
             
             return JSONResponse(result)
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1503,58 +1817,44 @@ app.routes.append(Route("/api/books/{book_id}/promotions", get_book_promotions_e
 # --- Админски функции ---
 
 async def get_bestsellers_endpoint(request: Request):
-    # Извличаме query параметри
-    limit = int(request.query_params.get("limit", 10))
-    
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
+        # Извличаме query параметри
+        limit = int(request.query_params.get("limit", 10))
+        # По желание - само продажбите за последните N дни, без days - за цялото време
+        days = request.query_params.get("days")
+        if days:
+            if not days.isdigit() or int(days) < 1:
+                return JSONResponse({"detail": "days must be a positive integer"}, status_code=400)
+            days = int(days)
+        else:
+            days = None
         
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
-            # Проверяваме кеша
-            cache = get_cache()
-            cache_key = "bestsellers"
-            cached_result = cache.get(cache_key)
-            
-            if cached_result:
-                return JSONResponse(cached_result)
-            
-            # Взимаме бестселърите
-            bestsellers = crud.get_bestsellers(db, limit)
+        # Проверяваме кеша
+        cache = get_cache()
+        from app.db.cache import get_bestsellers_cache_key
+        cache_key = await get_bestsellers_cache_key(cache, limit, days)
+        
+        async def compute():
+            async with AsyncSessionLocal() as db:
+                # Взимаме бестселърите
+                bestsellers = await crud.get_bestsellers_async(db, limit, profile=None, days=days)
             
             # Форматираме резултата
-            result = [{
+            return [{
                 "id": book.id,
                 "title": book.title,
                 "price": book.price,
                 "stock_count": book.stock_count
             } for book in bestsellers]
-            
-            # Кешираме резултата
-            cache.set(cache_key, result, expires=3600)
-            
-            return JSONResponse(result)
-            
-        finally:
-            db.close()
+        
+        # Кешираме резултата за 1 час - тежката агрегация се пуска само от една
+        # заявка, докато останалите получават старите данни
+        return JSONResponse(await cache.get_or_compute(cache_key, compute, expires=3600, stale=300))
             
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
@@ -1565,53 +1865,31 @@ async def get_top_rated_endpoint(request: Request):
     limit = int(request.query_params.get("limit", 10))
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN, UserRole.MODERATOR])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
+        # Проверяваме кеша
+        cache = get_cache()
+        cache_key = "top_rated"
         
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role not in [UserRole.ADMIN, UserRole.MODERATOR]:
-                return JSONResponse(
-                    {"detail": "Not authorized - moderator or admin role required"}, 
-                    status_code=403
-                )
-            
-            # Проверяваме кеша
-            cache = get_cache()
-            cache_key = "top_rated"
-            cached_result = cache.get(cache_key)
-            
-            if cached_result:
-                return JSONResponse(cached_result)
-            
-            # Взимаме най-високо оценените книги
-            top_rated = crud.get_top_rated_books(db, limit)
+        async def compute():
+            async with AsyncSessionLocal() as db:
+                # Взимаме най-високо оценените книги
+                top_rated = await crud.get_top_rated_books_async(db, limit)
             
             # Форматираме резултата
-            result = [{
+            return [{
                 "id": book.id,
                 "title": book.title,
+                "avg_rating": book.avg_rating,
+                "review_count": book.review_count,
                 "goodreads_rating": book.goodreads_rating
             } for book in top_rated]
-            
-            # Кешираме резултата
-            cache.set(cache_key, result, expires=3600)
-            
-            return JSONResponse(result)
-            
-        finally:
-            db.close()
+        
+        # Кешираме резултата за 1 час (+5 минути stale-while-revalidate)
+        return JSONResponse(await cache.get_or_compute(cache_key, compute, expires=3600, stale=300))
             
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
@@ -1623,30 +1901,14 @@ async def get_revenue_endpoint(request: Request):
     end_date = datetime.fromisoformat(request.query_params.get("end_date"))
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
-        
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role != UserRole.ADMIN:
-                return JSONResponse(
-                    {"detail": "Not authorized - admin role required"}, 
-                    status_code=403
-                )
-            
+        async with AsyncSessionLocal() as db:
             # Вземаме приходите
-            revenue = crud.get_revenue_by_period(db, start_date, end_date)
+            revenue = await crud.get_revenue_by_period_async(db, start_date, end_date)
             
             return JSONResponse({
                 "start_date": start_date.isoformat(),
@@ -1654,9 +1916,6 @@ async def get_revenue_endpoint(request: Request):
                 "revenue": revenue
             })
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
@@ -1667,30 +1926,14 @@ async def get_revenue_by_category_endpoint(request: Request):
     end_date = datetime.fromisoformat(request.query_params.get("end_date"))
     
     # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse({"detail": "Not authenticated"}, status_code=401)
-    
-    token = auth_header.split(" ")[1]
+    denied = await require_principal(request, [UserRole.ADMIN])
+    if denied:
+        return denied
     
     try:
-        # Проверяваме токена
-        token_data = decode_token(token)
-        db = SessionLocal()
-        
-        try:
-            # Взимаме потребителя
-            from app.crud import get_user
-            current_user = get_user(db, int(token_data.user_id))
-            
-            if current_user.role != UserRole.ADMIN:
-                return JSONResponse(
-                    {"detail": "Not authorized - admin role required"}, 
-                    status_code=403
-                )
-            
+        async with AsyncSessionLocal() as db:
             # Вземаме приходите по категории
-            revenues = crud.get_revenue_by_category(db, start_date, end_date)
+            revenues = await crud.get_revenue_by_category_async(db, start_date, end_date)
             
             # Форматираме резултата
             result = [{
@@ -1701,42 +1944,158 @@ async def get_revenue_by_category_endpoint(request: Request):
             
             return JSONResponse(result)
             
-        finally:
-            db.close()
+    except Exception as e:
+        return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
+
+# 5. Статистика за connection pool-овете към базата данни
+async def get_db_pool_stats_endpoint(request: Request):
+    # Проверка на аутентикацията
+    denied = await require_principal(request, [UserRole.ADMIN])
+    if denied:
+        return denied
+    
+    try:
+        # Статистиката се чете след затваряне на сесията, за да не се брои нейната връзка
+        return JSONResponse({
+            "settings": POOL_SETTINGS,
+            "sync": pool_stats(engine),
+            "async": pool_stats(async_engine),
+            "replicas": [pool_stats(replica) for replica in replica_engines],
+            "async_replicas": [pool_stats(replica) for replica in async_replica_engines]
+        })
+            
+    except Exception as e:
+        return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
+
+# 6. Статистика за кеша - операции, попадения, латентност и размер по префикс на ключа
+async def get_cache_stats_endpoint(request: Request):
+    # Проверка на аутентикацията
+    denied = await require_principal(request, [UserRole.ADMIN])
+    if denied:
+        return denied
+    
+    try:
+        cache = get_cache()
+        return JSONResponse({
+            "codec": {
+                "serializer": cache.codec.serializer,
+                "compression": cache.codec.compression,
+                "compress_min_bytes": cache.codec.compress_min_bytes
+            },
+            "mode": cache.metrics.mode(),
+            "prefixes": cache.metrics.snapshot()
+        })
             
     except Exception as e:
         return JSONResponse({"detail": f"Error: {str(e)}"}, status_code=500)
 
+# 7. Статистиката за кеша във формат за Prometheus
+# Адреси (или мрежи) на Prometheus сървърите, които четат /metrics без токен
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.getenv("METRICS_ALLOWED_IPS", "").split(",") if network.strip()
+]
+
+def metrics_client_allowed(request: Request) -> bool:
+    """Проверява дали заявката идва от адрес в METRICS_ALLOWED_IPS"""
+    if not request.client or not METRICS_ALLOWED_NETWORKS:
+        return False
+    try:
+        address = ipaddress.ip_address(request.client.host)
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+async def metrics_endpoint(request: Request):
+    # Без токен - само от позволените адреси, иначе се изисква admin
+    if not metrics_client_allowed(request):
+        denied = await require_principal(request, [UserRole.ADMIN])
+        if denied:
+            return denied
+    
+    return PlainTextResponse(get_cache().metrics.prometheus(), media_type="text/plain; version=0.0.4")
+
 # Добавяме маршрутите
 app.routes.append(Route("/api/admin/bestsellers", get_bestsellers_endpoint, methods=["GET"]))
 app.routes.append(Route("/api/admin/top-rated", get_top_rated_endpoint, methods=["GET"]))
 app.routes.append(Route("/api/admin/revenue", get_revenue_endpoint, methods=["GET"]))
 app.routes.append(Route("/api/admin/revenue-by-category", get_revenue_by_category_endpoint, methods=["GET"]))
+app.routes.append(Route("/api/admin/db-pool", get_db_pool_stats_endpoint, methods=["GET"]))
+app.routes.append(Route("/api/admin/cache", get_cache_stats_endpoint, methods=["GET"]))
+app.routes.append(Route("/metrics", metrics_endpoint, methods=["GET"]))
 
 # --- Уеб интерфейс ---
 
+# Колко секунди се пази рендерираният HTML на storefront страниците
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", "120"))
+
+def is_error_page(response) -> bool:
+    """Проверява дали storefront отговорът е неуспешен или е страницата с грешка"""
+    template = getattr(response, "template", None)
+    return response.status_code != 200 or (template is not None and template.name == "error.html")
+
+def cached_page(expires: int = PAGE_CACHE_TTL, params: tuple = ()):
+    """
+    Декоратор за storefront страници - кешира рендерирания HTML за анонимни
+    посетители, така че попаденията не стигат нито до базата, нито до Jinja
+    
+    Args:
+        expires: Време на живот на кеша в секунди
+        params: Query параметрите, които страницата чете
+    
+    Ключът включва пътя, изброените в params query параметри и поколенията
+    на каталога и на картите на книгите, които се сменят при всяка промяна
+    в книга, категория или наличност. Страницата може да запише в
+    request.state.page_valid_until кога се сменя цена в нея (unix време) -
+    тогава записът изтича най-късно в този момент.
+    Останалите параметри не влизат в ключа, за да не може произволен
+    параметър да заобиколи кеша. Заявки с Authorization header и страниците
+    с грешка не се кешират.
+    """
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request: Request):
+            if request.headers.get("Authorization"):
+                return await endpoint(request)
+            
+            from app.db.cache import get_page_cache_key, capped_ttl
+            cache = get_cache()
+            page_params = [(name, value) for name, value in request.query_params.multi_items() if name in params]
+            cache_key = await get_page_cache_key(cache, request.url.path, page_params)
+            html = await cache.get(cache_key)
+            if html is not None:
+                return HTMLResponse(html)
+            
+            response = await endpoint(request)
+            if not is_error_page(response):
+                until = getattr(request.state, "page_valid_until", None)
+                await cache.set(cache_key, response.body.decode(), expires=capped_ttl(expires, until))
+            return response
+        return wrapper
+    return decorator
+
 # 1. Начална страница
+@cached_page()
 async def home_endpoint(request: Request):
     try:
-        db = SessionLocal()
+        # Взимаме бестселърите и новите книги - ID-тата са в кеша, а картите
+        # на книгите се зареждат с една MGET заявка
+        cache = get_cache()
+        from app.db.cache import HOME_KEY
+        page = await cache.get_or_compute(HOME_KEY, compute_home_page, expires=600, stale=60)
+        bestsellers = await get_book_cards(cache, page["bestsellers"])
+        new_books = await get_book_cards(cache, page["new_books"])
+        request.state.page_valid_until = cards_valid_until([*bestsellers, *new_books])
         
-        try:
-            # Взимаме бестселърите и новите книги
-            bestsellers = crud.get_bestsellers(db, 6)
-            new_books = db.query(Book).order_by(Book.created_at.desc()).limit(6).all()
-            
-            # Използваме Jinja2Templates
-            return templates.TemplateResponse(
-                "index.html",
-                {
-                    "request": request,
-                    "bestsellers": bestsellers,
-                    "new_books": new_books
-                }
-            )
-            
-        finally:
-            db.close()
+        # Използваме Jinja2Templates
+        return templates.TemplateResponse(
+            "index.html",
+            {
+                "request": request,
+                "bestsellers": bestsellers,
+                "new_books": new_books
+            }
+        )
             
     except Exception as e:
         return templates.TemplateResponse(
@@ -1746,15 +2105,30 @@ async def home_endpoint(request: Request):
 
 # 2. Страница с детайли за книга
 async def book_detail_page_endpoint(request: Request):
+    response = await render_book_detail_page(request)
+    
+    # Броим прегледите извън кеша на страницата, за да се броят и попаденията
+    # в него, но само за успешно показана книга. Най-гледаните книги се
+    # подгряват в кеша
+    if not is_error_page(response):
+        from app.db.cache import BOOK_VIEWS_KEY
+        await get_cache().increment_score(
+            BOOK_VIEWS_KEY, int(request.path_params["book_id"]), max_members=BOOK_VIEWS_MAX_MEMBERS
+        )
+    
+    return response
+
+@cached_page()
+async def render_book_detail_page(request: Request):
     # Извличаме book_id от path параметрите
     book_id = int(request.path_params["book_id"])
     
     try:
-        db = SessionLocal()
-        
-        try:
+        async with AsyncSessionLocal() as db:
             # Взимаме книгата
-            book, promotion = crud.get_book_with_promotions(db, book_id)
+            book, promotion = await crud.get_book_with_promotions_async(db, book_id)
+            reviews = await crud.get_latest_book_reviews_async(db, book_id, DETAIL_REVIEWS_LIMIT)
+            request.state.page_valid_until = books_valid_until([book], datetime.utcnow())
             
             # Използваме Jinja2Templates
             return templates.TemplateResponse(
@@ -1762,13 +2136,11 @@ async def book_detail_page_endpoint(request: Request):
                 {
                     "request": request,
                     "book": book,
+                    "reviews": reviews,
                     "promotion": promotion
                 }
             )
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return templates.TemplateResponse(
             "error.html",
@@ -1776,6 +2148,12 @@ async def book_detail_page_endpoint(request: Request):
         )
 
 # 3. Страница за търсене
+# Брой книги на страница в /search
+SEARCH_PAGE_SIZE = 20
+
+@cached_page(params=(
+    "query", "category_id", "min_price", "max_price", "in_stock", "sort_by", "sort_desc", "cursor"
+))
 async def search_page_endpoint(request: Request):
     # Извличаме query параметри
     query = request.query_params.get("query")
@@ -1784,7 +2162,7 @@ async def search_page_endpoint(request: Request):
     min_price = None
     max_price = None
     in_stock = True
-    sort_by = "title"  # по подразбиране
+    sort_by = crud.RELEVANCE_SORT  # по подразбиране (без търсене - по заглавие)
     sort_desc = False  # по подразбиране
     
     if request.query_params.get("min_price"):
@@ -1809,12 +2187,12 @@ async def search_page_endpoint(request: Request):
         sort_desc = request.query_params.get("sort_desc") == "true"
     
     try:
-        db = SessionLocal()
-        
-        try:
+        async with AsyncSessionLocal() as db:
             # Взимаме резултатите от търсенето
-            books = crud.get_books(
+            books, next_cursor = await crud.get_books_page_async(
                 db,
+                limit=SEARCH_PAGE_SIZE,
+                cursor=request.query_params.get("cursor"),
                 search=query,
                 category_id=category_id,
                 min_price=min_price,
@@ -1824,8 +2202,10 @@ async def search_page_endpoint(request: Request):
                 sort_desc=sort_desc
             )
             
+            request.state.page_valid_until = books_valid_until(books, datetime.utcnow())
+            
             # Взимаме всички категории за филтриране
-            categories = crud.get_categories(db)
+            categories = await crud.get_categories_async(db)
             
             # Използваме Jinja2Templates
             return templates.TemplateResponse(
@@ -1836,13 +2216,12 @@ async def search_page_endpoint(request: Request):
                     "categories": categories,
                     "query": query,
                     "category_id": category_id,
+                    "next_cursor": next_cursor,
+                    "next_page_url": str(request.url.include_query_params(cursor=next_cursor)) if next_cursor else None,
                     "now": datetime.utcnow()  # For promotion checks
                 }
             )
             
-        finally:
-            db.close()
-            
     except Exception as e:
         return templates.TemplateResponse(
             "error.html",
@@ -1872,26 +2251,11 @@ async def forgotten_password_page_endpoint(request: Request):
 
 # 7. Страница за поръчка
 async def order_page_endpoint(request: Request):
-    # Проверка на аутентикацията
-    auth_header = request.headers.get("Authorization")
-    current_user = None
-    
-    if auth_header and auth_header.startswith("Bearer "):
-        token = auth_header.split(" ")[1]
-        
-        try:
-            # Проверяваме токена
-            token_data = decode_token(token)
-            db = SessionLocal()
-            
-            try:
-                # Взимаме потребителя
-                from app.crud import get_user
-                current_user = get_user(db, int(token_data.user_id))
-            finally:
-                db.close()
-        except:
-            pass
+    # Потребителят е по желание - страницата работи и за гости
+    try:
+        current_user = await get_request_user(request)
+    except Exception:
+        current_user = None
     
     return templates.TemplateResponse(
         "order.html",
@@ -1981,7 +2345,7 @@ async def admin_page_endpoint(request: Request):
         # Данни за панела
         is_admin = True
         orders = db.query(Order).order_by(Order.created_at.desc()).limit(10).all()
-        books = db.query(Book).order_by(Book.created_at.desc()).limit(10).all()
+        books = crud.get_books(db, limit=10, sort_by="created_at", sort_desc=True, profile="admin")
         
         return templates.TemplateResponse(
             "admin.html",
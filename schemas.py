@@ -82,6 +82,8 @@ class BookListItem(BookBase):
     stock_count: int
     categories: List[CategoryBase]
     goodreads_rating: Optional[float] = None
+    avg_rating: Optional[float] = None
+    review_count: int = 0
     promotion: Optional[PromotionInfo] = None
     discounted_price: Optional[float] = None
     
@@ -115,6 +117,8 @@ class BookDetail(BookBase):
     categories: List[CategoryBase]
     goodreads_id: Optional[str] = None
     goodreads_rating: Optional[float] = None
+    review_count: int = 0
+    avg_rating: Optional[float] = None
     reviews: List[ReviewInfo]
     promotion: Optional[PromotionInfo] = None
     discounted_price: Optional[float] = None
@@ -15,8 +15,43 @@ document.addEventListener('DOMContentLoaded', function() {
     if (logoutBtn) {
         logoutBtn.addEventListener('click', logout);
     }
+    
+    // Предложения при писане в полето за търсене
+    initSearchSuggestions();
 });
 
+// Функция за предложения на заглавия в полето за търсене
+function initSearchSuggestions() {
+    const input = document.getElementById('searchInput');
+    const list = document.getElementById('searchSuggestions');
+    if (!input || !list) return;
+    
+    let timer = null;
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        const q = input.value.trim();
+        if (q.length < 2) {
+            list.innerHTML = '';
+            return;
+        }
+        
+        // Изчакваме потребителят да спре да пише, за да не пращаме заявка за всеки символ
+        timer = setTimeout(() => {
+            fetch(`/api/books/suggest?q=${encodeURIComponent(q)}`)
+                .then(response => response.ok ? response.json() : [])
+                .then(suggestions => {
+                    list.innerHTML = '';
+                    suggestions.forEach(book => {
+                        const option = document.createElement('option');
+                        option.value = book.title;
+                        list.appendChild(option);
+                    });
+                })
+                .catch(error => console.error('Error loading suggestions:', error));
+        }, 150);
+    });
+}
+
 // Функция за зареждане на данни за потребителя
 function loadUserData() {
     // Проверка за наличие на токен
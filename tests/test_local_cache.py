@@ -0,0 +1,54 @@
+import asyncio
+import secrets
+
+from app.db.cache import LocalCache, RedisCache
+
+
+def test_evicts_least_recently_used_by_size():
+    cache = LocalCache(max_entries=100, ttl=60, max_bytes=10, sizeof=len)
+    cache.set("a", "xxxx")
+    cache.set("b", "xxxx")
+    cache.get("a")  # "b" е най-отдавна използваният
+    cache.set("c", "xxxx")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "xxxx"
+    assert cache.get("c") == "xxxx"
+    assert cache.size == 8
+
+
+def test_size_follows_replace_and_delete():
+    cache = LocalCache(max_entries=100, ttl=60, max_bytes=10, sizeof=len)
+    cache.set("a", "xxxx")
+    cache.set("a", "xx")
+    assert cache.size == 2
+
+    cache.delete("a")
+    assert cache.size == 0
+
+
+def test_skips_value_larger_than_budget():
+    cache = LocalCache(max_entries=100, ttl=60, max_bytes=10, sizeof=len)
+    cache.set("a", "xxxx")
+    cache.set("big", "x" * 11)
+
+    assert cache.get("big") is None
+    assert cache.get("a") == "xxxx"
+
+
+def test_degraded_fallback_is_bounded_by_encoded_size():
+    cache = RedisCache(fallback_max_entries=1000, fallback_max_bytes=4096)
+    cache.redis = None  # degraded режим
+    # Случайно съдържание, за да не се свие от компресията на кодека
+    pages = [f"<html>{secrets.token_hex(1000)}</html>" for _ in range(50)]
+
+    async def fill():
+        for i, page in enumerate(pages):
+            await cache.set(f"page:{i}", page)
+
+    asyncio.run(fill())
+
+    assert 0 < len(cache.fallback) < 50
+    assert cache.fallback.size <= 4096
+    assert asyncio.run(cache.get("page:0")) is None
+    assert asyncio.run(cache.get("page:49")) == pages[49]